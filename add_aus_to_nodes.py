@@ -1,29 +1,45 @@
 #!/usr/bin/env python3
 """
 Parses titledb.xml, generates AUIDs for each AU entry, and submits them to LOCKSS nodes.
+
+Only the AUIDs a node doesn't already hold are submitted to it. What a node holds comes from its
+AU listing ([LOCKSS] au_list_path) when configured and reachable, otherwise from the local
+submission record of what was successfully submitted to it before. --dry-run prints each
+node's diff without submitting anything.
 """
 
+import argparse
 import configparser
+import json
 import os
 import re
+import sys
+import time
 import urllib.parse
-import xml.etree.ElementTree as ET
+from typing import Optional
 
 import requests
 from requests.auth import HTTPBasicAuth
 from lockss.pybasic.auidutil import AuidGenerator
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ledger
+import titledb_index
+
 # =============================================================================
 # Configuration Loading
 # =============================================================================
 
 config = configparser.ConfigParser()
-config.read(os.path.join(os.path.dirname(__file__), 'config.ini'))
+config.read(os.environ.get('PREPROCESS_CONFIG') or os.path.join(os.path.dirname(__file__), 'config.ini'))  #PREPROCESS_CONFIG points a run at another config, eg scripts/test_add_aus_to_nodes.py
 
 TITLEDB_URL = config['DEFAULT']['titledb_url']
 LOCKSS_SERVERS = [s.strip() for s in config['LOCKSS']['servers'].split(',')]
 LOCKSS_USER = config['LOCKSS']['username']
 LOCKSS_PASS = config['LOCKSS']['password']
+AU_LIST_PATH = config.get('LOCKSS', 'au_list_path', fallback='').strip()  # blank: rely on the submission record
+SUBMISSION_RECORD = (config.get('LOCKSS', 'submission_record', fallback='').strip()
+                     or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'submitted_auids.json'))
 
 # =============================================================================
 # AUID Encoding Fix (LOCKSS requires periods encoded as %2E, uppercase hex)
@@ -43,42 +59,25 @@ AuidGenerator.encode_component = staticmethod(_encode_component)
 # Core Functions
 # =============================================================================
 
-def fetch_titledb() -> str:
-    """Fetch titledb.xml content from configured URL."""
-    response = requests.get(TITLEDB_URL, timeout=30)
+def fetch_titledb():
+    """Open titledb.xml at the configured URL as a stream, parsed as it downloads."""
+    response = requests.get(TITLEDB_URL, timeout=30, stream=True)
     response.raise_for_status()
-    return response.text
+    response.raw.decode_content = True  #undo any gzip transfer encoding
+    return response.raw
 
 
-def parse_titledb(xml_content: str) -> list[tuple[str, str, dict]]:
+def parse_titledb(source) -> list[tuple[str, str, dict]]:
     """
-    Parse titledb XML and extract AU entries where pub_down='false'.
+    Parse titledb XML (a path or binary stream) and extract AU entries where pub_down='false'.
     Returns list of (name, plugin, params) tuples.
     """
-    root = ET.fromstring(xml_content)
     entries = []
 
-    for au in root.findall('.//property'):
-        name = au.get('name')
-        if not name:
-            continue
-
-        plugin, params, pub_down = None, {}, None
-
-        # Extract plugin ID and parameters from child properties
-        for child in au.findall('property'):
-            cname, cval = child.get('name'), child.get('value')
-
-            if cname == 'plugin':
-                plugin = cval
-            elif cname and cname.startswith('param.'):
-                # Params have nested key/value properties
-                pdata = {p.get('name'): p.get('value') for p in child.findall('property')}
-                key, val = pdata.get('key'), pdata.get('value')
-                if key == 'pub_down':
-                    pub_down = val
-                elif key and val:
-                    params[key] = val
+    for name, entry in titledb_index.iter_entries(source):
+        plugin = entry['fields'].get('plugin')
+        params = titledb_index.param_values(entry)
+        pub_down = params.pop('pub_down', None)
 
         # Only include AUs with plugin, params, and pub_down=false
         if plugin and params and pub_down == 'false':
@@ -87,6 +86,25 @@ def parse_titledb(xml_content: str) -> list[tuple[str, str, dict]]:
     return entries
 
 
+def filter_staged(entries: list[tuple[str, str, dict]]) -> list[tuple[str, str, dict]]:
+    """
+    Keep only the AUs the local processing ledger records as staged.
+    Everything is kept if there is no ledger (eg run on a host other than the preprocess one).
+    """
+    conn = ledger.connect_readonly(ledger.ledger_path(config))
+    if conn is None:
+        print("No processing ledger found, submitting every titledb entry")
+        return entries
+
+    staged = ledger.staged_au_names(conn)
+    conn.close()
+    kept = [entry for entry in entries if entry[0] in staged]
+    for name, _, _ in entries:
+        if name not in staged:
+            print(f"Skipping {name}: not staged according to the ledger")
+    return kept
+
+
 def generate_auids(entries: list[tuple[str, str, dict]]) -> list[str]:
     """Generate AUIDs from AU entries. Prints details for each."""
     auids = []
@@ -97,31 +115,150 @@ def generate_auids(entries: list[tuple[str, str, dict]]) -> list[str]:
     return auids
 
 
-def submit_auids(auids: list[str]) -> None:
-    """Submit AUIDs to all configured LOCKSS servers."""
+def load_submission_record() -> dict[str, dict[str, str]]:
+    """Server -> {AUID: time it was submitted}, empty if nothing has been recorded yet."""
+    try:
+        with open(SUBMISSION_RECORD, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_submission_record(record: dict[str, dict[str, str]]) -> None:
+    """Write the submission record atomically (temp file + rename)."""
+    with open(SUBMISSION_RECORD + '.tmp', 'w') as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(SUBMISSION_RECORD + '.tmp', SUBMISSION_RECORD)
+
+
+def _auid_of(item) -> Optional[str]:
+    #an AUID given as a string, or in an AU object's auId/auid/id field
+    if isinstance(item, dict):
+        item = item.get('auId') or item.get('auid') or item.get('id')
+    return item if isinstance(item, str) and item else None
+
+
+def parse_au_listing(data) -> Optional[set[str]]:
+    """
+    AUIDs from a node's AU listing: a JSON list of AUIDs, or of AU objects with an auId/auid/id
+    field, optionally wrapped in an object under aus/auIds. None if the listing isn't in one of
+    these shapes, rather than guessing.
+    """
+    if isinstance(data, dict):
+        data = next((data[key] for key in ('aus', 'auIds', 'auids') if key in data), None)
+    if not isinstance(data, list):
+        return None
+    auids = {_auid_of(item) for item in data}
+    if None in auids:
+        return None
+    return auids
+
+
+def accepted_auids(submitted: list[str], data) -> Optional[set[str]]:
+    """
+    The submitted AUIDs a node reports as added or already present, from its /ws/aus/add response:
+    a JSON list of per-AU results ({"id": ..., "isSuccess": ..., "message": ...}), or an object
+    keyed on AUID. None if the response isn't in one of these shapes.
+    """
+    if isinstance(data, dict) and not any(key in data for key in ('id', 'auId', 'auid')):
+        data = [dict(result, id=auid) if isinstance(result, dict) else {'id': auid, 'isSuccess': result}
+                for auid, result in data.items()]
+    if not isinstance(data, list):
+        return None
+    accepted = set()
+    for result in data:
+        if not isinstance(result, dict) or _auid_of(result) is None:
+            return None
+        success = result.get('isSuccess', result.get('success'))
+        message = str(result.get('message') or '')
+        if success is True or 'already exists' in message.lower():
+            accepted.add(_auid_of(result))
+    return accepted & set(submitted)
+
+
+def node_auids(server: str, auth: HTTPBasicAuth, record: dict) -> tuple[set[str], str]:
+    """
+    The AUIDs a node already holds, from its AU listing if configured, reachable and recognised,
+    otherwise from the submission record.
+
+    Returns:
+        tuple: (AUIDs, where they came from)
+    """
+    if AU_LIST_PATH:
+        url = f"{server}{AU_LIST_PATH}"
+        try:
+            resp = requests.get(url, auth=auth, timeout=60)
+            resp.raise_for_status()
+            auids = parse_au_listing(resp.json())
+            if auids is not None:
+                return auids, url
+            print(f"Warning: The AU listing from {url} isn't in a recognised format, using the submission record")
+        except (requests.RequestException, ValueError) as e:
+            print(f"Could not list the AUs on {server} ({e}), using the submission record")
+    return set(record.get(server, {})), "submission record"
+
+
+def submit_auids(auids: list[str], dry_run: bool = False) -> None:
+    """Submit to each configured LOCKSS server the AUIDs it doesn't already hold."""
     auth = HTTPBasicAuth(LOCKSS_USER, LOCKSS_PASS)
+    record = load_submission_record()
 
     for server in LOCKSS_SERVERS:
+        held, source = node_auids(server, auth, record)
+        missing = [auid for auid in auids if auid not in held]
+        print(f"\n{server}: {len(auids) - len(missing)} of {len(auids)} AUIDs already held "
+              f"(per {source}), {len(missing)} to submit")
+
+        if dry_run:
+            for auid in missing:
+                print(f"  + {auid}")
+            continue
+        if not missing:
+            continue
+
         url = f"{server}/ws/aus/add"
-        print(f"\nSubmitting {len(auids)} AUIDs to {url}...")
+        print(f"Submitting {len(missing)} AUIDs to {url}...")
         try:
-            resp = requests.post(url, json=auids, auth=auth, timeout=60)
+            resp = requests.post(url, json=missing, auth=auth, timeout=60)
             print(f"Status: {resp.status_code} | Response: {resp.text}")
         except requests.RequestException as e:
             print(f"Error: {e}")
+            continue
+        if not resp.ok:
+            continue
+
+        #only the AUs the node reports as added (or already there) are recorded, the rest are retried next run
+        try:
+            accepted = accepted_auids(missing, resp.json())
+        except ValueError:
+            accepted = None
+        if accepted is None:
+            print(f"Warning: The response from {url} has no per-AU results, nothing recorded; these AUIDs will be submitted again next run")
+            continue
+        if len(accepted) < len(missing):
+            print(f"{len(missing) - len(accepted)} of {len(missing)} AUIDs were not accepted by {server}, they will be submitted again next run")
+        submitted = time.strftime('%Y-%m-%dT%H:%M:%S')
+        record.setdefault(server, {}).update((auid, submitted) for auid in accepted)
+        save_submission_record(record)
 
 # =============================================================================
 # Entry Point
 # =============================================================================
 
 def main():
+    parser = argparse.ArgumentParser(description="Submit the staged AUs in titledb.xml to the LOCKSS nodes that don't hold them yet")
+    parser.add_argument('--dry-run', action='store_true', help="print each node's diff without submitting anything")
+    args = parser.parse_args()
+
     print(f"Fetching titledb from: {TITLEDB_URL}")
-    entries = parse_titledb(fetch_titledb())
+    with fetch_titledb() as stream:
+        entries = parse_titledb(stream)
+    entries = filter_staged(entries)
     print(f"Found {len(entries)} AU entries\n{'='*80}")
 
     auids = generate_auids(entries)
     if auids:
-        submit_auids(auids)
+        submit_auids(auids, dry_run=args.dry_run)
     else:
         print("No AUIDs to submit.")
 
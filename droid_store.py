@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+SQLite store for the central DROID log.
+
+Every AU's droid_report.csv is appended to a single droid_files table, with the package columns
+preprocess.py adds (Package_Name, Source_Organization, External-Identifier, Date). The table is
+indexed on PUID, Package_Name and Source_Organization so questions like "which AUs contain
+fmt/X" don't need a scan of every file row ever logged.
+
+Columns follow the DROID report header; columns a newer DROID adds are added to the table the
+first time they are seen. export_csv writes the store back out in the flat droid_log CSV shape.
+"""
+
+import csv
+import sqlite3
+
+PACKAGE_COLUMNS = ['Package_Name', 'Source_Organization', 'External-Identifier', 'Date']
+
+# DROID 6.x CSV report columns, in report order
+DROID_COLUMNS = [
+    'ID', 'PARENT_ID', 'URI', 'FILE_PATH', 'NAME', 'METHOD', 'STATUS', 'SIZE', 'TYPE', 'EXT',
+    'LAST_MODIFIED', 'EXTENSION_MISMATCH', 'HASH', 'FORMAT_COUNT', 'PUID', 'MIME_TYPE',
+    'FORMAT_NAME', 'FORMAT_VERSION',
+]
+
+INDEXED_COLUMNS = ['PUID', 'Package_Name', 'Source_Organization']
+BATCH_ROWS = 5000
+
+# =============================================================================
+# Connection and schema
+# =============================================================================
+
+def _quote(column: str) -> str:
+    return '"' + column.replace('"', '""') + '"'
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Open (creating if needed) the store."""
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')  # readers (the query CLI) don't block the writer
+    columns = ', '.join(f"{_quote(c)} TEXT" for c in DROID_COLUMNS + PACKAGE_COLUMNS)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS droid_files (row_id INTEGER PRIMARY KEY, {columns})")
+    for column in INDEXED_COLUMNS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_droid_files_{column.lower()} ON droid_files ({_quote(column)})")
+    conn.commit()
+    return conn
+
+
+def table_columns(conn: sqlite3.Connection) -> list[str]:
+    """Data columns in table order (without row_id)."""
+    return [row[1] for row in conn.execute('PRAGMA table_info(droid_files)') if row[1] != 'row_id']
+
+
+def _ensure_columns(conn: sqlite3.Connection, header: list[str]) -> None:
+    existing = set(table_columns(conn))
+    for column in header:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE droid_files ADD COLUMN {_quote(column)} TEXT")
+            existing.add(column)
+
+# =============================================================================
+# Writing
+# =============================================================================
+
+def _insert_rows(conn: sqlite3.Connection, header: list[str], rows) -> int:
+    """Insert rows in batches, streaming from any iterable. Returns the row count."""
+    _ensure_columns(conn, header)
+    sql = (f"INSERT INTO droid_files ({', '.join(_quote(c) for c in header)}) "
+           f"VALUES ({', '.join('?' for _ in header)})")
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row[:len(header)] + [''] * (len(header) - len(row)))
+        if len(batch) == BATCH_ROWS:
+            conn.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def append_report(conn: sqlite3.Connection, report_path: str, package_name: str,
+                  publisher: str, title: str, date: str) -> int:
+    """Stream one AU's droid_report.csv into the store in a single transaction."""
+    with open(report_path, 'r', newline='', encoding='utf-8') as report, conn:
+        reader = csv.reader(report)
+        header = next(reader, None)
+        if header is None:
+            return 0
+        extra = [package_name, publisher, title, date]
+        return _insert_rows(conn, header + PACKAGE_COLUMNS, (row + extra for row in reader))
+
+
+def import_csv(conn: sqlite3.Connection, csv_path: str) -> int:
+    """Load an existing flat droid_log CSV (DROID columns + package columns) into the store."""
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f, conn:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return 0
+        return _insert_rows(conn, header, reader)
+
+# =============================================================================
+# Queries and export
+# =============================================================================
+
+def aus_with_puid(conn: sqlite3.Connection, puid: str) -> list[tuple]:
+    """(Package_Name, Source_Organization, file count) for every AU holding a PUID."""
+    return conn.execute(
+        'SELECT Package_Name, Source_Organization, COUNT(*) FROM droid_files '
+        'WHERE PUID = ? GROUP BY Package_Name, Source_Organization ORDER BY Package_Name', (puid,)).fetchall()
+
+
+def formats_in_au(conn: sqlite3.Connection, package_name: str) -> list[tuple]:
+    """(PUID, FORMAT_NAME, file count) for one AU."""
+    return conn.execute(
+        'SELECT PUID, FORMAT_NAME, COUNT(*) FROM droid_files '
+        'WHERE Package_Name = ? GROUP BY PUID, FORMAT_NAME ORDER BY COUNT(*) DESC', (package_name,)).fetchall()
+
+
+def aus_for_organization(conn: sqlite3.Connection, organization: str) -> list[tuple]:
+    """(Package_Name, file count, Date) for every AU from a Source-Organization."""
+    return conn.execute(
+        'SELECT Package_Name, COUNT(*), MAX(Date) FROM droid_files '
+        'WHERE Source_Organization = ? GROUP BY Package_Name ORDER BY Package_Name', (organization,)).fetchall()
+
+
+def export_csv(conn: sqlite3.Connection, out_path: str, where: str = '', params: tuple = ()) -> int:
+    """Write the store (or a filtered part of it) in the flat droid_log CSV shape, streaming."""
+    columns = table_columns(conn)
+    # flat log shape: DROID columns first, package columns last
+    columns = [c for c in columns if c not in PACKAGE_COLUMNS] + PACKAGE_COLUMNS
+    cursor = conn.execute(
+        f"SELECT {', '.join(_quote(c) for c in columns)} FROM droid_files {where} ORDER BY row_id", params)
+    count = 0
+    with open(out_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        while rows := cursor.fetchmany(BATCH_ROWS):
+            writer.writerows(['' if v is None else v for v in row] for row in rows)
+            count += len(rows)
+    return count
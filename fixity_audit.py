@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Deep fixity audit of staged AU tarballs (scripts/validate_staging.py --deep).
+
+Each tarball is read once, sequentially, in large reads. Every payload member is re-hashed and
+compared with the bag's own manifest-sha256.txt, and the tarball as a whole is hashed so it can
+be compared with the digest preprocess.py recorded in the ledger when the AU was staged. Reads
+are throttled to a bytes-per-second budget so an audit can run on a serving node.
+
+Results go to an append-only JSON lines audit log, one line per AU as soon as it is done:
+
+    {"event": "start", "audit": ...}                       an audit begins
+    {"event": "au", "audit": ..., "au": ..., ...}          one AU audited (digests, problems)
+    {"event": "finish", "audit": ...}                      every AU was audited
+
+An audit without a finish line was interrupted; the next --deep run resumes it, skipping the
+AUs it already covered (unless their tarball changed since).
+"""
+
+import hashlib
+import json
+import os
+import tarfile
+import time
+import uuid
+from typing import Optional
+
+READ_SIZE = 16 * 1024 * 1024  # bytes per read from the tarball, large sequential reads suit spinning disks and NFS
+
+OK = 'ok'
+BITROT = 'bitrot'  # payload or tarball no longer matches its recorded digest
+ERROR = 'error'    # tarball missing, unreadable or not a bag
+
+# =============================================================================
+# Hashing
+# =============================================================================
+
+class ThrottledReader:
+    """Sequential reader that hashes the whole file and keeps to a bytes-per-second budget."""
+
+    def __init__(self, path: str, bytes_per_second: Optional[float]):
+        self.file = open(path, 'rb', buffering=0)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.bytes_per_second = bytes_per_second
+        self.sha256 = hashlib.sha256()
+        self.buffer = b''
+        self.position = 0
+        self.bytes_read = 0
+        self.start = time.monotonic()
+
+    def _fill(self) -> bool:
+        chunk = self.file.read(READ_SIZE)
+        if not chunk:
+            return False
+        self.sha256.update(chunk)
+        self.bytes_read += len(chunk)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        if self.bytes_per_second:
+            #sleep off any lead over the budget
+            ahead = self.bytes_read / self.bytes_per_second - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            while self._fill():
+                pass
+            size = len(self.buffer) - self.position
+        while len(self.buffer) - self.position < size and self._fill():
+            pass
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def drain(self) -> None:
+        #the rest of the file (end-of-archive padding), so the tarball digest covers every byte
+        self.position = len(self.buffer)
+        while self._fill():
+            self.position = len(self.buffer)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def parse_manifest(data: bytes) -> dict[str, str]:
+    """manifest-sha256.txt as {payload path: digest}, paths relative to the bag"""
+    expected = {}
+    for line in data.decode('utf-8').splitlines():
+        if not line.strip():
+            continue
+        digest, _, path = line.strip().partition(' ')
+        path = path.strip().lstrip('*')
+        #BagIt percent-encodes CR, LF and % in manifest paths
+        expected[path.replace('%0A', '\n').replace('%0D', '\r').replace('%25', '%')] = digest.lower()
+    return expected
+
+
+def audit_tarball(tar_path: str, bag_name: str, bytes_per_second: Optional[float] = None) -> dict:
+    """
+    Re-hash an AU tarball's payload against the bag's manifest-sha256.txt in one sequential pass
+
+    Runs in a worker process. Returns a JSON-serializable record: the tarball's size, mtime and
+    sha256, the number of payload files checked, status (ok, bitrot or error) and the problems found.
+    """
+    record = {'tar_path': tar_path, 'status': OK, 'problems': [], 'payload_files': 0}
+    started = time.monotonic()
+    try:
+        stat = os.stat(tar_path)
+        record.update(tar_size=stat.st_size, tar_mtime_ns=stat.st_mtime_ns)
+        reader = ThrottledReader(tar_path, bytes_per_second)
+    except OSError as error:
+        record.update(status=ERROR, problems=[f"cannot read tarball: {error}"])
+        return record
+
+    digests = {}
+    manifest = None
+    payload_prefix = bag_name + '/data/'
+    try:
+        try:
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    if member.name == bag_name + '/manifest-sha256.txt':
+                        with tar.extractfile(member) as src:
+                            manifest = src.read()
+                    elif member.name.startswith(payload_prefix):
+                        sha256 = hashlib.sha256()
+                        with tar.extractfile(member) as src:
+                            while chunk := src.read(READ_SIZE):
+                                sha256.update(chunk)
+                        digests[member.name[len(bag_name) + 1:]] = sha256.hexdigest()
+            reader.drain()
+        finally:
+            reader.close()
+    except Exception as error:  #a damaged tarball can fail in any number of ways, it's this AU's result, not the audit's
+        record.update(status=ERROR, problems=[f"tarball unreadable after {reader.bytes_read} bytes: {error}"])
+        return record
+
+    record['tar_sha256'] = reader.sha256.hexdigest()
+    record['payload_files'] = len(digests)
+    record['seconds'] = round(time.monotonic() - started, 3)
+    if manifest is None:
+        record.update(status=ERROR, problems=["manifest-sha256.txt not found in tarball"])
+        return record
+
+    try:
+        expected = parse_manifest(manifest)
+    except Exception as error:  #eg a flipped byte that isn't valid UTF-8 any more
+        record.update(status=BITROT, problems=[f"manifest-sha256.txt is unreadable: {error}"])
+        return record
+    for path, digest in expected.items():
+        actual = digests.pop(path, None)
+        if actual is None:
+            record['problems'].append(f"missing from payload: {path}")
+        elif actual != digest:
+            record['problems'].append(f"checksum mismatch: {path}")
+    record['problems'].extend(f"not listed in manifest: {path}" for path in sorted(digests))
+    if record['problems']:
+        record['status'] = BITROT
+    return record
+
+# =============================================================================
+# Audit log
+# =============================================================================
+
+def _append(log_path: str, event: dict) -> None:
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(event) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_log(log_path: str) -> list[dict]:
+    """Every event in the audit log; a line cut short by a crash is skipped."""
+    events = []
+    try:
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return events
+
+
+def open_audit(log_path: str, restart: bool = False) -> tuple[str, dict[str, dict]]:
+    """
+    Resume the last audit if it was interrupted, otherwise (or with restart) start a new one
+
+    Returns:
+        tuple: (audit id, records of the AUs it has already covered keyed on AU name)
+    """
+    events = read_log(log_path)
+    starts = [e for e in events if e.get('event') == 'start']
+    if starts and not restart:
+        audit_id = starts[-1]['audit']
+        if not any(e.get('event') == 'finish' and e.get('audit') == audit_id for e in events):
+            return audit_id, {e['au']: e for e in events if e.get('event') == 'au' and e.get('audit') == audit_id}
+    audit_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    _append(log_path, {'event': 'start', 'audit': audit_id, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    return audit_id, {}
+
+
+def previous_records(log_path: str, audit_id: str) -> dict[str, dict]:
+    """Each AU's most recent record from earlier audits, to spot a tarball whose digest has changed."""
+    latest = {}
+    for event in read_log(log_path):
+        if event.get('event') == 'au' and event.get('audit') != audit_id and event.get('tar_sha256'):
+            latest[event['au']] = event
+    return latest
+
+
+def record_au(log_path: str, audit_id: str, au_name: str, record: dict) -> None:
+    _append(log_path, {'event': 'au', 'audit': audit_id, 'au': au_name,
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **record})
+
+
+def finish_audit(log_path: str, audit_id: str) -> None:
+    _append(log_path, {'event': 'finish', 'audit': audit_id, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+
+def unchanged(record: dict, tar_path: str) -> bool:
+    """True if the tarball is the same size and mtime as when the record was made."""
+    try:
+        stat = os.stat(tar_path)
+    except OSError:
+        return False
+    return record.get('tar_size') == stat.st_size and record.get('tar_mtime_ns') == stat.st_mtime_ns
+
+
+def parse_rate(text: str) -> Optional[float]:
+    """A bytes-per-second budget such as 50M, 1.5G or 800000; blank or 0 is unthrottled."""
+    text = (text or '').strip().upper().removesuffix('/S').removesuffix('B')
+    if not text:
+        return None
+    multiplier = 1
+    if text[-1] in 'KMGT':
+        multiplier = 1024 ** ('KMGT'.index(text[-1]) + 1)
+        text = text[:-1]
+    rate = float(text) * multiplier
+    return rate or None
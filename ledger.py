@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+SQLite processing ledger, the record of every AU preprocess.py has handled.
+
+One row per AU per attempt: name, size, status, publisher, External-Identifier, LOCKSS AU id,
+tarball sha256, start/finish times and per-stage timings. Indexed on AU name, publisher and
+status, so "was this AU already staged?" or "all failures for a publisher" are lookups rather
+than a scan of log.csv. log.csv (and log.html, built from it) are exports of this table.
+
+AUs still moving through the pipeline also have a checkpoint: their state after the last stage
+they completed, so a run that was killed part way is resumed where it stopped rather than
+rescanned and re-extracted. The checkpoint is cleared once every stage is done.
+
+Used by preprocess.py (writer), scripts/validate_staging.py and add_aus_to_nodes.py (readers).
+"""
+
+import csv
+import json
+import os
+import sqlite3
+from typing import Optional
+
+STAGED = 'Staged'
+
+# log.csv shape, one line per attempt
+LOG_HEADERS = ["Date", "Package Name", "Source-Organization", "External-Identifier", "Size (B)", "Status", "LOCKSS AU Id"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS au_attempts (
+    attempt_id INTEGER PRIMARY KEY,
+    au_name TEXT NOT NULL,
+    size INTEGER,
+    status TEXT,
+    publisher TEXT,
+    external_identifier TEXT,
+    au_id TEXT,
+    tar_sha256 TEXT,
+    source_path TEXT,
+    started TEXT,
+    finished TEXT,
+    stage_timings TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_au_attempts_au_name ON au_attempts (au_name);
+CREATE INDEX IF NOT EXISTS idx_au_attempts_publisher ON au_attempts (publisher);
+CREATE INDEX IF NOT EXISTS idx_au_attempts_status ON au_attempts (status);
+CREATE TABLE IF NOT EXISTS au_checkpoints (
+    au_name TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated TEXT
+);
+"""
+
+BUSY_TIMEOUT = 30  # seconds, worker processes write checkpoints alongside the main process
+
+# =============================================================================
+# Connection
+# =============================================================================
+
+def ledger_path(config) -> str:
+    """[DEFAULT] ledger from config.ini, or ledger.sqlite next to preprocess.py."""
+    path = config.get('DEFAULT', 'ledger', fallback='').strip()
+    return path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ledger.sqlite')
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open (creating if needed) the ledger."""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def connect_readonly(path: str) -> Optional[sqlite3.Connection]:
+    """Open an existing ledger for reading, None if there isn't one."""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+# =============================================================================
+# Writing
+# =============================================================================
+
+def record_attempt(conn: sqlite3.Connection, au_name: str, size: int, status: str, publisher: str,
+                   external_identifier: str, au_id: str, tar_sha256: Optional[str] = None,
+                   source_path: Optional[str] = None, started: Optional[str] = None,
+                   finished: Optional[str] = None, stage_timings: Optional[dict] = None) -> int:
+    """Add one attempt. Returns its attempt_id."""
+    with conn:
+        cursor = conn.execute(
+            'INSERT INTO au_attempts (au_name, size, status, publisher, external_identifier, au_id, '
+            'tar_sha256, source_path, started, finished, stage_timings) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (au_name, size, status, publisher, external_identifier, au_id, tar_sha256, source_path,
+             started, finished, json.dumps(stage_timings or {})))
+    return cursor.lastrowid
+
+
+def update_timings(conn: sqlite3.Connection, attempt_id: int, stage_timings: dict) -> None:
+    """Replace an attempt's stage timings (stages after the row was written, eg the email)."""
+    with conn:
+        conn.execute('UPDATE au_attempts SET stage_timings = ? WHERE attempt_id = ?',
+                     (json.dumps(stage_timings), attempt_id))
+
+
+def import_log_csv(conn: sqlite3.Connection, csv_path: str) -> int:
+    """Seed an empty ledger from an existing log.csv (no digests or timings, those weren't logged)."""
+    count = 0
+    with open(csv_path, 'r', newline='') as f, conn:
+        for row in csv.DictReader(f):
+            conn.execute(
+                'INSERT INTO au_attempts (au_name, size, status, publisher, external_identifier, au_id, finished) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (row.get('Package Name', ''), int(row.get('Size (B)') or 0), row.get('Status', ''),
+                 row.get('Source-Organization', ''), row.get('External-Identifier', ''),
+                 row.get('LOCKSS AU Id', ''), row.get('Date', '')))
+            count += 1
+    return count
+
+
+def is_empty(conn: sqlite3.Connection) -> bool:
+    return conn.execute('SELECT 1 FROM au_attempts LIMIT 1').fetchone() is None
+
+# =============================================================================
+# Checkpoints
+# =============================================================================
+
+def save_checkpoint(conn: sqlite3.Connection, au_name: str, state: dict) -> None:
+    """Replace an AU's checkpoint with its current state."""
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO au_checkpoints (au_name, state, updated) VALUES (?, ?, datetime('now'))",
+                     (au_name, json.dumps(state)))
+
+
+def load_checkpoints(conn: sqlite3.Connection) -> dict[str, dict]:
+    """Every unfinished AU's last saved state, keyed on AU name, oldest first."""
+    rows = conn.execute('SELECT au_name, state FROM au_checkpoints ORDER BY updated, au_name')
+    return {row['au_name']: json.loads(row['state']) for row in rows}
+
+
+def clear_checkpoint(conn: sqlite3.Connection, au_name: str) -> None:
+    with conn:
+        conn.execute('DELETE FROM au_checkpoints WHERE au_name = ?', (au_name,))
+
+# =============================================================================
+# Reading
+# =============================================================================
+
+def latest_attempt(conn: sqlite3.Connection, au_name: str) -> Optional[sqlite3.Row]:
+    """Most recent attempt for an AU, None if it has never been processed."""
+    return conn.execute('SELECT * FROM au_attempts WHERE au_name = ? ORDER BY attempt_id DESC LIMIT 1',
+                        (au_name,)).fetchone()
+
+
+def is_staged(conn: sqlite3.Connection, au_name: str) -> bool:
+    """True if any attempt staged the AU."""
+    return conn.execute('SELECT 1 FROM au_attempts WHERE au_name = ? AND status = ? LIMIT 1',
+                        (au_name, STAGED)).fetchone() is not None
+
+
+def staged_au_names(conn: sqlite3.Connection) -> set[str]:
+    return {row[0] for row in conn.execute('SELECT DISTINCT au_name FROM au_attempts WHERE status = ?', (STAGED,))}
+
+
+def history(conn: sqlite3.Connection, au_name: str) -> list[sqlite3.Row]:
+    return conn.execute('SELECT * FROM au_attempts WHERE au_name = ? ORDER BY attempt_id', (au_name,)).fetchall()
+
+
+def failures(conn: sqlite3.Connection, publisher: Optional[str] = None) -> list[sqlite3.Row]:
+    """Every attempt that didn't stage, optionally for one publisher (Source-Organization)."""
+    if publisher is None:
+        return conn.execute('SELECT * FROM au_attempts WHERE status != ? ORDER BY attempt_id', (STAGED,)).fetchall()
+    return conn.execute('SELECT * FROM au_attempts WHERE status != ? AND publisher = ? ORDER BY attempt_id',
+                        (STAGED, publisher)).fetchall()
+
+# =============================================================================
+# Export
+# =============================================================================
+
+def log_row(attempt: sqlite3.Row) -> list[str]:
+    """An attempt as a log.csv row."""
+    return [attempt['finished'] or '', attempt['au_name'], attempt['publisher'] or '',
+            attempt['external_identifier'] or '', str(attempt['size'] or 0), attempt['status'] or '',
+            attempt['au_id'] or '']
+
+
+def export_log_csv(conn: sqlite3.Connection, csv_path: str) -> int:
+    """Regenerate log.csv from the ledger (atomic: temp file + rename)."""
+    count = 0
+    with open(csv_path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LOG_HEADERS)
+        for attempt in conn.execute('SELECT * FROM au_attempts ORDER BY attempt_id'):
+            writer.writerow(log_row(attempt))
+            count += 1
+    os.replace(csv_path + '.tmp', csv_path)
+    return count
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Run metrics for preprocess.py: per-AU, per-stage duration, bytes read and written, and outcome.
+
+Two outputs, both optional ([METRICS] in config.ini):
+
+    textfile    Prometheus textfile-collector file (node_exporter --collector.textfile.directory).
+                Counters and the stage duration histogram are cumulative across runs; their
+                totals are kept in a JSON file next to it, so AUs per hour and stage latency
+                percentiles can be graphed with rate() and histogram_quantile().
+    event_log   JSON lines, one event per stage, per AU and per run, for ad hoc analysis.
+
+Bytes are the process's read/write syscall counters from /proc/self/io (rchar/wchar), which
+include the tools it has waited for (clamscan, DROID). Where /proc isn't available they are
+left out.
+"""
+
+import json
+import os
+import time
+from typing import Optional
+
+# stage duration histogram buckets, seconds; AUs range from a few KB to 50GB
+DURATION_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200]
+
+OK = 'ok'
+FAILED = 'failed'  # the stage rejected the AU (virus, fixity, size, ...)
+ERROR = 'error'    # the stage raised
+
+# =============================================================================
+# I/O counters
+# =============================================================================
+
+def io_counters() -> Optional[tuple[int, int]]:
+    """(bytes read, bytes written) by this process and its reaped children so far, None without /proc."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+# =============================================================================
+# Collection
+# =============================================================================
+
+def _state_path(textfile: str) -> str:
+    return textfile + '.state.json'
+
+
+def _empty_state() -> dict:
+    return {'aus': {}, 'au_bytes': {}, 'stages': {}}
+
+
+def _load_state(textfile: str) -> dict:
+    try:
+        with open(_state_path(textfile), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return _empty_state()
+
+
+class RunMetrics:
+    """Collects one run's metrics, writing events as they happen and the textfile at the end."""
+
+    def __init__(self, textfile: Optional[str], event_log: Optional[str]):
+        self.textfile = textfile
+        self.event_log = event_log
+        self.start = time.time()
+        self.state = _load_state(textfile) if textfile else _empty_state()
+        self.run_aus = {}  # outcome -> count, this run only
+
+    def _event(self, event: dict) -> None:
+        if not self.event_log:
+            return
+        line = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), **event}) + '\n'
+        with open(self.event_log, 'a', encoding='utf-8') as f:
+            f.write(line)  #one write per event, so lines from concurrent runs don't interleave
+
+    def stage(self, au: Optional[str], stage: str, seconds: float, io: Optional[list[int]], outcome: str) -> None:
+        """One stage of one AU (au is None for run-wide stages, eg the titledb commit)."""
+        stats = self.state['stages'].setdefault(stage, {
+            'count': 0, 'sum': 0.0, 'buckets': [0] * len(DURATION_BUCKETS),
+            'bytes_read': 0, 'bytes_written': 0, 'outcomes': {}})
+        stats['count'] += 1
+        stats['sum'] += seconds
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+        if io is not None:
+            stats['bytes_read'] += io[0]
+            stats['bytes_written'] += io[1]
+        stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + 1
+
+        event = {'event': 'stage', 'au': au, 'stage': stage, 'seconds': round(seconds, 3), 'outcome': outcome}
+        if io is not None:
+            event.update(bytes_read=io[0], bytes_written=io[1])
+        self._event(event)
+
+    def au(self, au: str, status: str, size: int, seconds: float, staged: bool) -> None:
+        """An AU's attempt is finished (staged or rejected)."""
+        outcome = 'staged' if staged else FAILED
+        self.state['aus'][outcome] = self.state['aus'].get(outcome, 0) + 1
+        self.state['au_bytes'][outcome] = self.state['au_bytes'].get(outcome, 0) + size
+        self.run_aus[outcome] = self.run_aus.get(outcome, 0) + 1
+        self._event({'event': 'au', 'au': au, 'status': status, 'outcome': outcome, 'size': size,
+                     'seconds': round(seconds, 3)})
+
+    def finish(self) -> None:
+        """End of the run: the run event, then the textfile and its state."""
+        duration = time.time() - self.start
+        if self.run_aus:  #a cron run that found nothing isn't worth a line
+            self._event({'event': 'run', 'seconds': round(duration, 3), **{f"aus_{k}": v for k, v in self.run_aus.items()}})
+        if self.textfile:
+            self.state['last_run'] = {'timestamp': self.start, 'seconds': duration, 'aus': self.run_aus}
+            write_textfile(self.textfile, self.state)
+
+# =============================================================================
+# Prometheus textfile
+# =============================================================================
+
+def _atomic_write(path: str, content: str) -> None:
+    #node_exporter may read the file at any moment, it must never see half of it
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def render_textfile(state: dict) -> str:
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric('preprocess_aus_total', 'counter', 'AUs processed, by outcome',
+           [({'outcome': k}, v) for k, v in sorted(state['aus'].items())])
+    metric('preprocess_au_bytes_total', 'counter', 'Size of the AU tarballs processed, by outcome',
+           [({'outcome': k}, v) for k, v in sorted(state['au_bytes'].items())])
+
+    stages = sorted(state['stages'].items())
+    histogram = []
+    for stage, stats in stages:
+        for bound, count in zip(DURATION_BUCKETS, stats['buckets']):
+            histogram.append(('_bucket', {'stage': stage, 'le': f"{bound:g}"}, count))
+        histogram.append(('_bucket', {'stage': stage, 'le': '+Inf'}, stats['count']))
+        histogram.append(('_sum', {'stage': stage}, round(stats['sum'], 3)))
+        histogram.append(('_count', {'stage': stage}, stats['count']))
+    lines.append('# HELP preprocess_stage_duration_seconds Wall time of each pipeline stage, per AU')
+    lines.append('# TYPE preprocess_stage_duration_seconds histogram')
+    for suffix, labels, value in histogram:
+        label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f"preprocess_stage_duration_seconds{suffix}{{{label_text}}} {value}")
+
+    metric('preprocess_stage_read_bytes_total', 'counter', 'Bytes read during each stage, including the tools it ran',
+           [({'stage': stage}, stats['bytes_read']) for stage, stats in stages])
+    metric('preprocess_stage_written_bytes_total', 'counter', 'Bytes written during each stage, including the tools it ran',
+           [({'stage': stage}, stats['bytes_written']) for stage, stats in stages])
+    metric('preprocess_stage_outcomes_total', 'counter', 'Stage runs by outcome (ok, failed, error)',
+           [({'stage': stage, 'outcome': outcome}, count)
+            for stage, stats in stages for outcome, count in sorted(stats['outcomes'].items())])
+
+    last_run = state.get('last_run')
+    if last_run:
+        metric('preprocess_last_run_timestamp_seconds', 'gauge', 'Start of the last run, unix time',
+               [({}, round(last_run['timestamp'], 3))])
+        metric('preprocess_last_run_duration_seconds', 'gauge', 'Wall time of the last run',
+               [({}, round(last_run['seconds'], 3))])
+        metric('preprocess_last_run_aus', 'gauge', 'AUs processed by the last run, by outcome',
+               [({'outcome': k}, v) for k, v in sorted(last_run['aus'].items())])
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(textfile: str, state: dict) -> None:
+    _atomic_write(_state_path(textfile), json.dumps(state))
+    _atomic_write(textfile, render_textfile(state))
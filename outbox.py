@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+On-disk outbox for preprocess.py notification emails.
+
+Every email is written to the spool as one JSON file (envelope, a plain summary for the debug
+view, and the full serialized MIME message) before anything touches the network. A sender,
+the background thread in preprocess.py or `preprocess.py --send-outbox`, delivers them, retrying
+with exponential backoff and moving a message to failed/ once it runs out of attempts.
+
+    outbox/pending/   waiting for delivery (or for their next retry)
+    outbox/sending/   claimed by a sender; a file is claimed by renaming it here, so two senders
+                      never deliver the same message
+    outbox/failed/    gave up, kept for an admin to inspect or move back to pending/
+"""
+
+import itertools
+import json
+import os
+import time
+from typing import Optional
+
+PENDING = 'pending'
+SENDING = 'sending'
+FAILED = 'failed'
+STALE_CLAIM_SECONDS = 3600  # a claim this old belongs to a sender that died, release it
+
+_counter = itertools.count()
+
+# =============================================================================
+# Spooling
+# =============================================================================
+
+def ensure_dirs(outbox_dir: str) -> None:
+    for name in (PENDING, SENDING, FAILED):
+        os.makedirs(os.path.join(outbox_dir, name), exist_ok=True)
+
+
+def _write_json(path: str, data: dict) -> None:
+    """Write atomically (temp file + rename) so a sender never reads half a message."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def spool(outbox_dir: str, from_email: str, recipients: list[str], message: str, summary: dict, name: str) -> str:
+    """
+    Add a message to the outbox. Returns its path.
+
+    summary holds the readable parts (to, cc, subject, date, body, attachments) used by the
+    debug view; name is a filename-safe label for the message.
+    """
+    ensure_dirs(outbox_dir)
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_counter):04d}-{name}.json"
+    path = os.path.join(outbox_dir, PENDING, filename)
+    _write_json(path, {
+        'from': from_email,
+        'recipients': recipients,
+        'summary': summary,
+        'message': message,
+        'attempts': 0,
+        'next_attempt': 0,
+        'last_error': None,
+    })
+    return path
+
+# =============================================================================
+# Delivery
+# =============================================================================
+
+def release_stale_claims(outbox_dir: str) -> None:
+    """Put messages claimed by a sender that died mid-delivery back in pending/."""
+    sending_dir = os.path.join(outbox_dir, SENDING)
+    if not os.path.isdir(sending_dir):
+        return
+    for filename in os.listdir(sending_dir):
+        path = os.path.join(sending_dir, filename)
+        if time.time() - os.path.getmtime(path) > STALE_CLAIM_SECONDS:
+            os.replace(path, os.path.join(outbox_dir, PENDING, filename))
+
+
+def due_messages(outbox_dir: str, now: Optional[float] = None) -> list[str]:
+    """Pending message filenames whose next attempt is due, oldest first."""
+    pending_dir = os.path.join(outbox_dir, PENDING)
+    if not os.path.isdir(pending_dir):
+        return []
+    now = time.time() if now is None else now
+    due = []
+    for filename in sorted(os.listdir(pending_dir)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(pending_dir, filename), 'r', encoding='utf-8') as f:
+                if json.load(f)['next_attempt'] <= now:
+                    due.append(filename)
+        except (OSError, ValueError):
+            continue  #claimed by another sender meanwhile
+    return due
+
+
+def claim(outbox_dir: str, filename: str) -> Optional[dict]:
+    """Take a pending message for delivery, None if another sender got it first."""
+    claimed_path = os.path.join(outbox_dir, SENDING, filename)
+    try:
+        os.replace(os.path.join(outbox_dir, PENDING, filename), claimed_path)
+    except FileNotFoundError:
+        return None
+    os.utime(claimed_path)  #the claim's age is measured from now
+    with open(claimed_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def delivered(outbox_dir: str, filename: str) -> None:
+    os.remove(os.path.join(outbox_dir, SENDING, filename))
+
+
+def retry_later(outbox_dir: str, filename: str, envelope: dict, error: str,
+                retry_delay: float, max_attempts: int) -> bool:
+    """
+    Record a failed attempt. The message goes back to pending/ with its next attempt pushed
+    out (retry_delay, doubling each time), or to failed/ after max_attempts.
+    Returns True if it will be retried.
+    """
+    envelope['attempts'] += 1
+    envelope['last_error'] = error
+    claimed_path = os.path.join(outbox_dir, SENDING, filename)
+    if envelope['attempts'] >= max_attempts:
+        _write_json(claimed_path, envelope)
+        os.replace(claimed_path, os.path.join(outbox_dir, FAILED, filename))
+        return False
+    envelope['next_attempt'] = time.time() + retry_delay * 2 ** (envelope['attempts'] - 1)
+    _write_json(claimed_path, envelope)
+    os.replace(claimed_path, os.path.join(outbox_dir, PENDING, filename))
+    return True
+
+
+def give_up(outbox_dir: str, filename: str, envelope: dict, error: str) -> None:
+    """A permanent failure (eg every recipient refused), straight to failed/."""
+    retry_later(outbox_dir, filename, envelope, error, 0, 0)
+
+
+def counts(outbox_dir: str) -> dict[str, int]:
+    return {name: len([f for f in os.listdir(os.path.join(outbox_dir, name)) if f.endswith('.json')])
+            if os.path.isdir(os.path.join(outbox_dir, name)) else 0
+            for name in (PENDING, SENDING, FAILED)}
@@ -20,97 +20,348 @@
 #########################################################
 
 import os
+import sys
 import re
 import subprocess
 import tarfile
+import hashlib
 import shutil
+import gzip
 import urllib.parse
 import xml.etree.ElementTree as ET
 import csv
+import html
+import json
 import datetime
-import pandas as pd
 import configparser
+import contextlib
 import time
+import argparse
+import concurrent.futures
+import multiprocessing
 import smtplib
+import socket
+import struct
+import signal
+import threading
+import tempfile
+import zipfile
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 
+import tar_index
+import droid_store
+import ledger
+import upload_watcher
+import staging_transfer
+import outbox
+import metrics
+import profiling
+
 ############################## Obtain configuration file ################################
 config = configparser.ConfigParser()
-config.read(os.path.join(os.path.dirname(__file__),'config.ini'))
+config.read(os.environ.get('PREPROCESS_CONFIG') or os.path.join(os.path.dirname(__file__),'config.ini'))  #PREPROCESS_CONFIG points a run at another config, eg scripts/benchmark.py
 #########################################################################################
 
+CLAMD_CHUNK_SIZE = 1024 * 1024  #bytes per INSTREAM chunk, must stay below clamd's StreamMaxLength
+HASH_CHUNK_SIZE = 4 * 1024 * 1024  #bytes per read while streaming tarball members
+MAX_REPORTED_FIXITY_ERRORS = 50  #fixity problems listed in the depositor email, the console gets all of them
+
+DROID_PENDING = "Pending DROID"  #status of an AU waiting for the batch DROID run
+ALREADY_STAGED = "Error: AU already staged, upload not processed"  #status of a re-upload of a staged AU, left in source_dir
+TITLEDB_TAIL_BYTES = 64 * 1024  #how much of the end of titledb.xml is searched for the insertion point
+BACKUP_CATALOG_FIELDS = ['timestamp', 'sha256', 'size']
+MIN_SHA256_PREFIX = 7  #shortest sha256 prefix --restore-titledb accepts, like an abbreviated git commit
+
+ledger_conn = None  #processing ledger, opened on first use by open_ledger
+ledger_pid = None  #process that opened ledger_conn, a forked worker must open its own
+stop_requested = False  #set by SIGTERM in watch mode, the loop exits after the AUs in hand
+smtp_server = None  #SMTP connection shared by every email the outbox sender delivers, see smtp_connection
+pending_digests = {}  #Contact-Email -> AU results waiting for send_digests in digest mode
+pending_titledb_entries = []  #AU entries waiting for commit_titledb, filled by queue_titledb_entry
+run_metrics = None  #metrics.RunMetrics for the current process_tar_files run, None if [METRICS] isn't configured
+profile_override = None  #--profile DIR, takes precedence over [DEFAULT] profile_dir
+
 ### functions
+class ClamdError(Exception):
+    """clamd answered with an error (size limit, unreadable file, ...) rather than a verdict"""
+
 def run_clamav_scan(file_path):
+    #scanner backend is chosen in config.ini, clamscan is the default and the fallback if clamd can't be reached
+    backend = config.get('CLAMAV', 'backend', fallback='').strip().lower() or 'clamscan'
+    if backend == 'clamd':
+        try:
+            return run_clamd_scan(file_path)
+        except (OSError, ClamdError) as error:
+            print(f"Warning: clamd scan unavailable for {file_path}, falling back to clamscan", error)
+
     result = subprocess.run(['clamscan', file_path], capture_output=True, text=True)
     with open(file_path + '-clamav.txt', 'w', encoding='utf-8') as f:
         f.write(result.stdout)
     return result.returncode == 0
 
+def clamd_connect():
+    #connect to the local clamd, UNIX socket if configured otherwise TCP
+    clamd_socket = config.get('CLAMAV', 'clamd_socket', fallback='').strip()
+    timeout = float(config.get('CLAMAV', 'clamd_timeout', fallback='') or 3600)
+    if clamd_socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = clamd_socket
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = (config.get('CLAMAV', 'clamd_host', fallback='').strip() or '127.0.0.1',
+                   int(config.get('CLAMAV', 'clamd_port', fallback='') or 3310))
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def clamd_command(command, file_path=None):
+    #send a single null terminated command to clamd and return its reply, streams the file for INSTREAM
+    with clamd_connect() as sock:
+        if command == 'INSTREAM':
+            sock.sendall(b'zINSTREAM\0')
+            with open(file_path, 'rb') as f:
+                while chunk := f.read(CLAMD_CHUNK_SIZE):
+                    sock.sendall(struct.pack('!L', len(chunk)) + chunk)
+            sock.sendall(struct.pack('!L', 0))
+        elif file_path:
+            sock.sendall(f'z{command} {os.path.abspath(file_path)}\0'.encode())
+        else:
+            sock.sendall(f'z{command}\0'.encode())
+
+        reply = b''
+        while not reply.endswith(b'\0'):
+            data = sock.recv(4096)
+            if not data:
+                break
+            reply += data
+    return reply.rstrip(b'\0').decode('utf-8', errors='replace').strip()
+
+def run_clamd_scan(file_path):
+    #scan through the long-lived clamd daemon, no signature reload per AU, writes the same -clamav.txt report
+    command = config.get('CLAMAV', 'clamd_command', fallback='').strip().upper() or 'SCAN'
+    if command not in ('SCAN', 'INSTREAM'):
+        raise ClamdError(f"unsupported clamd_command {command}")
+
+    reply = clamd_command(command, file_path)
+    #replies look like "<path or stream>: OK", "<path or stream>: <signature> FOUND" or "<...> ERROR"
+    verdict = reply.rsplit(':', 1)[-1].strip()
+    if verdict.endswith('ERROR') or not (verdict == 'OK' or verdict.endswith('FOUND')):
+        raise ClamdError(reply)
+    infected = verdict.endswith('FOUND')
+
+    try:
+        engine = clamd_command('VERSION')
+    except (OSError, ClamdError):
+        engine = 'unknown'
+
+    with open(file_path + '-clamav.txt', 'w', encoding='utf-8') as f:
+        f.write(f"{file_path}: {verdict}\n")
+        f.write("\n----------- SCAN SUMMARY -----------\n")
+        f.write("Scanned files: 1\n")
+        f.write(f"Infected files: {1 if infected else 0}\n")
+        f.write(f"Engine version: {engine}\n")
+        f.write(f"Scanner: clamd ({command})\n")
+    return not infected
+
 #has the file size definitions
 def is_right_size(file_path):
     file_size = os.path.getsize(file_path)
     return file_size > 0 and file_size < int(config['DEFAULT']['max_au_size'])
 
 def extract_and_convert_manifest(tar_file_path, extract_to):
-    with tarfile.open(tar_file_path) as tar:
-        file_name = os.path.basename(tar_file_path)
-        fname = os.path.splitext(file_name) #filename minus extension
-
-        #extract the bag-info file
-        member = tar.getmember(fname[0] + '/bag-info.txt')
-        tar.extract(member, path=extract_to, filter='data')
-        baginfo_file_path = os.path.join(extract_to, fname[0], 'bag-info.txt')
-
-        #extract the manifest file
-        member = tar.getmember(fname[0] + '/manifest-sha256.txt')
-        tar.extract(member, path=extract_to, filter='data')
-        manifest_file_path = os.path.join(extract_to, fname[0], 'manifest-sha256.txt')
-
-        #parse bag info, push bag-info fields into html manifest
-        with open(baginfo_file_path, 'r') as file:
-            content = file.readlines()
-
-        # Parse bag-info into a dictionary for easy access
-        baginfo_dict = {}
-        for line in content:
-            if ':' in line:
-                key, value = line.split(':', 1)
-                baginfo_dict[key.strip()] = value.strip()
+    file_name = os.path.basename(tar_file_path)
+    fname = os.path.splitext(file_name) #filename minus extension
+
+    #one sequential pass over the tarball, pulls out bag-info and the manifest and hashes the payload
+    digests, tar_sha256 = stream_bag(tar_file_path, extract_to, fname[0])
+    baginfo_file_path = os.path.join(extract_to, fname[0], 'bag-info.txt')
+    manifest_file_path = os.path.join(extract_to, fname[0], 'manifest-sha256.txt')
+    for path in (baginfo_file_path, manifest_file_path):
+        if not os.path.exists(path):
+            raise KeyError(f"{os.path.basename(path)} not found in {file_name}")
 
+    #parse bag info, push bag-info fields into html manifest
+    with open(baginfo_file_path, 'r') as file:
+        content = file.readlines()
+
+    # Parse bag-info into a dictionary for easy access
+    baginfo_dict = {}
+    for line in content:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            baginfo_dict[key.strip()] = value.strip()
+
+    fixity_errors = verify_fixity(manifest_file_path, digests, fname[0])
+    if not fixity_errors:
         url = config['DEFAULT']['staging_url'] + fname[0]
         convert_to_html(manifest_file_path, baginfo_file_path, url, content[10].split(" ", 1)[1].strip()) #manifest_file_path, baginfo_file_path, url, title
-    return baginfo_dict
+    return baginfo_dict, fixity_errors, tar_sha256
+
+def stream_bag(tar_file_path, extract_to, bag_name):
+    """
+    Walk the tarball once in stream mode, hashing every payload member as it is read
+
+    bag-info.txt and manifest-sha256.txt are written to extract_to/bag_name on the way past,
+    so the archive is never re-read or scanned for headers with getmember. The member offset
+    index (see tar_index.py) and the digest of the tarball itself come from the same pass.
+
+    Returns:
+        tuple: (sha256 hex digest for each payload member keyed on the member name, sha256 of the tarball)
+    """
+    digests = {}
+    tag_files = {bag_name + '/bag-info.txt', bag_name + '/manifest-sha256.txt'}
+    payload_prefix = bag_name + '/data/'
+    index_entries = [] if tar_index.is_plain_tar(tar_file_path) else None #offsets are only usable in an uncompressed tar
+
+    with open(tar_file_path, 'rb') as raw:
+        reader = HashingReader(raw)
+        with tarfile.open(fileobj=reader, mode='r|*') as tar:
+            for member in tar:
+                if index_entries is not None:
+                    index_entries.append(tar_index.entry_for(member))
+                if not member.isfile():
+                    continue
+                if member.name in tag_files:
+                    os.makedirs(os.path.join(extract_to, bag_name), exist_ok=True)
+                    with tar.extractfile(member) as src, open(os.path.join(extract_to, member.name), 'wb') as dst:
+                        shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+                elif member.name.startswith(payload_prefix):
+                    sha256 = hashlib.sha256()
+                    with tar.extractfile(member) as src:
+                        while chunk := src.read(HASH_CHUNK_SIZE):
+                            sha256.update(chunk)
+                    digests[member.name] = sha256.hexdigest()
+            reader.drain()  #end-of-archive padding, so the tarball digest covers every byte
+
+    #member offset index, written next to where the tarball will sit in the AU folder
+    if index_entries is not None:
+        os.makedirs(os.path.join(extract_to, bag_name), exist_ok=True)
+        au_tar_path = os.path.join(extract_to, bag_name, os.path.basename(tar_file_path))
+        tar_index.write_index(tar_index.index_path(au_tar_path), index_entries, os.path.getsize(tar_file_path))
+    return digests, reader.sha256.hexdigest()
+
+class HashingReader:
+    """Read-only file wrapper that hashes everything read through it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def drain(self):
+        while self.read(HASH_CHUNK_SIZE):
+            pass
+
+def verify_fixity(manifest_file_path, digests, bag_name):
+    #compare the payload digests from stream_bag against manifest-sha256.txt, returns a list of problems (empty if the bag is intact)
+    errors = []
+    remaining = dict(digests)
+    with open(manifest_file_path, 'r', encoding='utf-8') as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            expected, _, path = line.strip().partition(' ')
+            path = path.strip().lstrip('*')
+            #BagIt percent-encodes CR, LF and % in manifest paths
+            path = path.replace('%0A', '\n').replace('%0D', '\r').replace('%25', '%')
+            actual = remaining.pop(bag_name + '/' + path, None)
+            if actual is None:
+                errors.append(f"missing from payload: {path}")
+            elif actual != expected.lower():
+                errors.append(f"checksum mismatch: {path}")
+    for name in sorted(remaining):
+        errors.append(f"not listed in manifest: {name[len(bag_name) + 1:]}")
+    return errors
+
+def manifest_page_name(page):
+    #manifest.html is page 1 (the page LOCKSS starts its crawl from), the rest are manifest-0002.html, ...
+    return 'manifest.html' if page == 1 else f"manifest-{page:04d}.html"
+
+def write_manifest_page_head(file, heading, page_title):
+    file.write(f"<html><head><meta charset='UTF-8'><title>{page_title} - LOCKSS Manifest Page</title></head><body>{heading}")
 
 def convert_to_html(manifest_file_path, baginfo_file_path, url, title):
-    with open(manifest_file_path, 'r') as file:
-        content = file.read()
-        
-    with open(baginfo_file_path, 'r') as file:
-        baginfo = file.read()
+    """
+    Write manifest.html from bag-info.txt and manifest-sha256.txt, then remove manifest-sha256.txt
+
+    Both files are streamed line by line (HTML-escaped) into the output, so a bag with a million
+    payload files never has its manifest in memory. Past manifest_page_size lines the manifest
+    continues on manifest-0002.html, manifest-0003.html, ... each linked from the previous page;
+    manifest.html lists every page and carries the LOCKSS permission statement.
+
+    Returns:
+        int: number of manifest pages written
+    """
+    page_size = int(config.get('DEFAULT', 'manifest_page_size', fallback='') or 10000)
+    au_dir = os.path.dirname(manifest_file_path)
+    title = html.escape(title)
+    url = html.escape(url, quote=True)
+
+    def open_page(page):
+        file = open(os.path.join(au_dir, manifest_page_name(page)), 'w', encoding='utf-8')
+        nav = f"<p><a href='manifest.html'>{title}</a> | <a href='{manifest_page_name(page - 1)}'>previous</a></p>"
+        write_manifest_page_head(file, nav, f"{title} (page {page})")
+        file.write(f"<h3>manifest-sha256.txt (page {page})</h3><pre>")
+        return file
+
+    def close_page(file, next_page=None):
+        file.write('</pre>')
+        if next_page:
+            file.write(f"<p><a href='{manifest_page_name(next_page)}'>next</a></p>")
+        file.write('</body></html>')
+        file.close()
 
    ## html template for manifest file ##
-    html_content = f"<html><head><title>{title} - LOCKSS Manifest Page</title></head><body><h1><a href='{url}'>{title}</a></h1><a href='bag-info.txt'><h3>bag-info.txt</h3></a><pre>{baginfo}</pre><h3><a href='clamav.txt'>clamav.txt</a></h3><h3>manifest-sha256.txt</h3><pre>{content}</pre>"       
-    html_content += '<p>LOCKSS system has permission to collect, preserve, and serve this Archival Unit</p></body></html>'    
+    pages = 1
+    with open(os.path.join(au_dir, 'manifest.html'), 'w', encoding='utf-8') as entry, \
+            open(manifest_file_path, 'r', encoding='utf-8') as manifest:
+        write_manifest_page_head(entry, f"<h1><a href='{url}'>{title}</a></h1>", title)
+        entry.write("<a href='bag-info.txt'><h3>bag-info.txt</h3></a><pre>")
+        with open(baginfo_file_path, 'r', encoding='utf-8') as baginfo:
+            for line in baginfo:
+                entry.write(html.escape(line))
+        entry.write("</pre><h3><a href='clamav.txt'>clamav.txt</a></h3><h3>manifest-sha256.txt</h3><pre>")
 
-    html_file_path = os.path.join(os.path.dirname(manifest_file_path), 'manifest.html')
+        out, lines = entry, 0
+        try:
+            for line in manifest:
+                if lines == page_size:
+                    #page full, carry on in the next one
+                    pages += 1
+                    if out is entry:
+                        entry.write('</pre>')
+                    else:
+                        close_page(out, pages)
+                    out, lines = open_page(pages), 0
+                out.write(html.escape(line))
+                lines += 1
+        finally:
+            if out is not entry:
+                close_page(out)
 
-    with open(html_file_path, 'w') as html_file:
-        html_file.write(html_content)
+        if out is entry:
+            entry.write('</pre>')
+        if pages > 1:
+            links = ''.join(f"<li><a href='{manifest_page_name(page)}'>page {page}</a></li>" for page in range(2, pages + 1))
+            entry.write(f"<p>manifest continues on {pages - 1} more page(s):</p><ul>{links}</ul>")
+        entry.write('<p>LOCKSS system has permission to collect, preserve, and serve this Archival Unit</p></body></html>')
 
    # remove the manifest file
     os.remove(manifest_file_path)
+    return pages
 
-def insert_into_titledb(publisher, fname, title, journal_title):
-        #load the file
-        tree = ET.parse(config['DEFAULT']['titledb'])
-        tree.write(config['DEFAULT']['titledb'] + '_' + time.strftime("%Y%m%d-%H%M%S"), encoding='utf-8')  #backup the file with a date, copies for each au loaded
-        root = tree.getroot()
-        parent_element = root.findall("property") 
-        
-        #append - AU first (fname)
+def build_titledb_entry(publisher, fname, title, journal_title):
+        #build the AU element for the titledb - AU first (fname)
         new_au = ET.Element("property")
         new_au.attrib["name"] = fname #property name for AU element
         #publisher (publisher)
@@ -181,10 +432,250 @@ def insert_into_titledb(publisher, fname, title, journal_title):
         param99.append(sub_param991)
         new_au.append(param99)
         
-        #merge into the main element
-        parent_element[1].append(new_au) #append to the second instance of property
-        ET.indent(tree, space="\t", level=0)
-        tree.write(config['DEFAULT']['titledb'], encoding='utf-8')
+        return new_au
+
+def insert_into_titledb(publisher, fname, title, journal_title):
+    #single AU insert, queues the entry and commits it straight away
+    queue_titledb_entry(publisher, fname, title, journal_title)
+    commit_titledb()
+
+def queue_titledb_entry(publisher, fname, title, journal_title):
+    #queue an AU entry, written with the rest of the run's entries by commit_titledb
+    pending_titledb_entries.append(build_titledb_entry(publisher, fname, title, journal_title))
+
+def commit_titledb():
+    """
+    Write every queued AU entry to titledb.xml in one atomic commit (temp file + rename) with one backup
+
+    titledb.xml is first streamed once with iterparse to check it is well-formed and laid out as
+    root > [titleSet, title], and to collect the AUs it already lists; no tree is kept, so memory
+    stays flat but the scan still reads the whole file. An AU already listed is not added again,
+    so an entry left queued by a run that stopped after writing it can't be duplicated. The
+    entries are then spliced in ahead of the closing tag of the title property, copying the rest
+    of the file as it is rather than re-serializing and re-indenting it. If the file isn't laid
+    out as expected the whole tree is rewritten with ElementTree as before.
+    """
+    if not pending_titledb_entries:
+        return
+    titledb = config['DEFAULT']['titledb']
+    queued = len(pending_titledb_entries)
+    top_level, listed = scan_titledb(titledb)
+    entries = {}  #AU name -> entry, an AU queued twice is added once
+    for entry in pending_titledb_entries[:queued]:
+        if entry.get('name') in listed:
+            print(f"Warning: {entry.get('name')} is already in {titledb}, not added again")
+        else:
+            entries.setdefault(entry.get('name'), entry)
+    entries = list(entries.values())
+
+    if entries:
+        backup_titledb(titledb)  #one compressed, deduplicated backup per commit
+        tmp_path = titledb + '.tmp'
+        try:
+            if top_level != 2 or not append_titledb_entries(titledb, tmp_path, entries):
+                rewrite_titledb(titledb, tmp_path, entries)
+            shutil.copymode(titledb, tmp_path)
+            os.replace(tmp_path, titledb)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Added {len(entries)} AU(s) to {titledb}")
+    del pending_titledb_entries[:queued]
+
+def scan_titledb(titledb):
+    #streaming well-formedness check without building the tree, each AU element is dropped once its name is read
+    #returns the number of property elements directly under the root and the AU names in the second (title) one
+    top_level = 0
+    names = set()
+    stack = []
+    for event, elem in ET.iterparse(titledb, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if len(stack) == 2 and elem.tag == 'property':
+                top_level += 1
+            elif len(stack) == 3 and top_level == 2 and elem.tag == 'property' and elem.get('name'):
+                names.add(elem.get('name'))
+            continue
+        stack.pop()
+        if len(stack) == 2:
+            stack[-1].remove(elem)
+        elif len(stack) < 2:
+            elem.clear()
+    return top_level, names
+
+def append_titledb_entries(titledb, tmp_path, entries):
+    #append path, copies titledb into tmp_path with the entries spliced in before the title property's closing tag
+    #only the tail is read to find the splice point, commit_titledb has already checked the layout with scan_titledb
+    #returns False if the tail isn't the expected closing tags so the caller can fall back
+    file_size = os.path.getsize(titledb)
+    with open(titledb, 'rb') as src:
+        src.seek(max(0, file_size - TITLEDB_TAIL_BYTES))
+        tail = src.read()
+    match = re.search(rb'\s*</property>\s*</[\w:.-]+>\s*$', tail)
+    if not match:
+        return False
+    insert_at = file_size - len(tail) + match.start()
+
+    #same layout ET.indent gives the rest of the file, AU entries sit two tabs in
+    new_content = ''
+    for entry in entries:
+        ET.indent(entry, space="\t", level=2)
+        new_content += "\n\t\t" + ET.tostring(entry, encoding='unicode')
+
+    with open(titledb, 'rb') as src, open(tmp_path, 'wb') as dst:
+        remaining = insert_at
+        while remaining > 0:
+            chunk = src.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                return False
+            dst.write(chunk)
+            remaining -= len(chunk)
+        dst.write(new_content.encode('utf-8'))
+        shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return True
+
+def rewrite_titledb(titledb, tmp_path, entries):
+    #fallback, parse the whole document, append and re-indent
+    tree = ET.parse(titledb)
+    root = tree.getroot()
+    parent_element = root.findall("property")
+    for entry in entries:
+        parent_element[1].append(entry) #append to the second instance of property
+    ET.indent(tree, space="\t", level=0)
+    tree.write(tmp_path, encoding='utf-8')
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+
+### titledb backup store, versions are gzip objects named by their sha256 so identical snapshots are stored once,
+### catalog.csv lists every version (timestamp, sha256, size) oldest first
+def titledb_backup_dir():
+    backup_dir = config.get('TITLEDB', 'backup_dir', fallback='').strip()
+    return backup_dir or os.path.join(os.path.dirname(os.path.abspath(config['DEFAULT']['titledb'])), 'titledb_backups')
+
+def read_backup_catalog(backup_dir):
+    catalog_path = os.path.join(backup_dir, 'catalog.csv')
+    if not os.path.exists(catalog_path):
+        return []
+    with open(catalog_path, 'r', newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+def write_backup_catalog(backup_dir, rows):
+    #atomic rewrite of the catalog, it's small (one line per retained version)
+    catalog_path = os.path.join(backup_dir, 'catalog.csv')
+    with open(catalog_path + '.tmp', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=BACKUP_CATALOG_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(catalog_path + '.tmp', catalog_path)
+
+def backup_titledb(titledb):
+    """
+    Store the current titledb.xml as a compressed, content-addressed version, then apply retention
+
+    Returns:
+        str: sha256 of the stored version
+    """
+    backup_dir = titledb_backup_dir()
+    os.makedirs(os.path.join(backup_dir, 'objects'), exist_ok=True)
+
+    sha256 = hashlib.sha256()
+    with open(titledb, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+
+    object_path = os.path.join(backup_dir, 'objects', digest + '.xml.gz')
+    if not os.path.exists(object_path):
+        with open(titledb, 'rb') as src, gzip.open(object_path + '.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+        os.replace(object_path + '.tmp', object_path)
+
+    rows = read_backup_catalog(backup_dir)
+    if not rows or rows[-1]['sha256'] != digest:  #unchanged since the last backup, nothing new to record
+        rows.append({'timestamp': datetime.datetime.now().isoformat(timespec='microseconds'),
+                     'sha256': digest,
+                     'size': os.path.getsize(titledb)})
+    prune_titledb_backups(backup_dir, rows)
+    return digest
+
+def prune_titledb_backups(backup_dir, rows):
+    #retention: keep the newest keep_recent versions plus the newest version of each of the last keep_daily days and keep_monthly months
+    keep_recent = int(config.get('TITLEDB', 'keep_recent', fallback='') or 10)
+    keep_daily = int(config.get('TITLEDB', 'keep_daily', fallback='') or 14)
+    keep_monthly = int(config.get('TITLEDB', 'keep_monthly', fallback='') or 12)
+
+    keep = set(range(max(0, len(rows) - keep_recent), len(rows)))
+    days, months = {}, {}
+    for i in reversed(range(len(rows))):
+        day, month = rows[i]['timestamp'][:10], rows[i]['timestamp'][:7]
+        if day not in days and len(days) < keep_daily:
+            days[day] = i
+        if month not in months and len(months) < keep_monthly:
+            months[month] = i
+    keep |= set(days.values()) | set(months.values())
+
+    retained = [row for i, row in enumerate(rows) if i in keep]
+    write_backup_catalog(backup_dir, retained)
+
+    #drop objects no version refers to any more
+    referenced = {row['sha256'] + '.xml.gz' for row in retained}
+    for name in os.listdir(os.path.join(backup_dir, 'objects')):
+        if name.endswith('.xml.gz') and name not in referenced:
+            os.remove(os.path.join(backup_dir, 'objects', name))
+
+def list_titledb_backups():
+    rows = read_backup_catalog(titledb_backup_dir())
+    if not rows:
+        print(f"No titledb backups in {titledb_backup_dir()}")
+    for row in rows:
+        print(f"{row['timestamp']}  {row['sha256'][:12]}  {row['size']} bytes")
+
+def restore_titledb(version):
+    """
+    Restore titledb.xml from the backup store
+
+    Args:
+        version: "latest", a timestamp exactly as --list-titledb-backups shows it, or a sha256 or
+                 a prefix of at least MIN_SHA256_PREFIX characters
+
+    Raises:
+        ValueError: if no version matches, or the sha256 prefix matches more than one version
+    """
+    titledb = config['DEFAULT']['titledb']
+    backup_dir = titledb_backup_dir()
+    rows = read_backup_catalog(backup_dir)
+    if version != 'latest':
+        matches = [row for row in rows if row['timestamp'] == version]
+        if not matches:
+            prefix = version.lower()
+            if len(prefix) < MIN_SHA256_PREFIX or not re.fullmatch(r'[0-9a-f]+', prefix):
+                raise ValueError(f"{version} is not a backup timestamp or a sha256 prefix of at least {MIN_SHA256_PREFIX} "
+                                 f"characters, see --list-titledb-backups")
+            matches = [row for row in rows if row['sha256'].startswith(prefix)]
+        if len({row['sha256'] for row in matches}) > 1:  #one version backed up at several times isn't ambiguous
+            candidates = "\n".join(f"  {row['timestamp']}  {row['sha256']}" for row in matches)
+            raise ValueError(f"{version} matches more than one titledb backup, give more of the sha256:\n{candidates}")
+        rows = matches
+    if not rows:
+        raise ValueError(f"No titledb backup matches {version}")
+    row = rows[-1]
+
+    #read the version out before backing up the current titledb.xml, that backup's retention may prune it
+    object_path = os.path.join(backup_dir, 'objects', row['sha256'] + '.xml.gz')
+    try:
+        with gzip.open(object_path, 'rb') as src, open(titledb + '.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        if os.path.exists(titledb):
+            backup_titledb(titledb)  #so the restore itself can be undone
+        os.replace(titledb + '.tmp', titledb)
+    finally:
+        if os.path.exists(titledb + '.tmp'):
+            os.remove(titledb + '.tmp')
+    print(f"Restored {titledb} from the {row['timestamp']} backup ({row['sha256'][:12]})")
 
 def is_web_safe_filename(filename):
     #check to see if a filename is websafe
@@ -196,7 +687,7 @@ def is_web_safe_filename(filename):
         return True
     return False
 
-def log_to_csv(filename, publisher, title, size, status, au_id, csv_filename=config['DEFAULT']['logfile']):
+def log_to_csv(filename, publisher, title, size, status, au_id, csv_filename=config['DEFAULT']['logfile'], date=None):
     # Define the header
     headers = ["Date", "Package Name", "Source-Organization", "External-Identifier", "Size (B)", "Status", "LOCKSS AU Id"]
     
@@ -217,18 +708,80 @@ def log_to_csv(filename, publisher, title, size, status, au_id, csv_filename=con
             writer.writerow(headers)
         
         # Write the row with the provided information
-        writer.writerow([datetime.datetime.now(), filename, publisher, title, size, status, au_id])
+        row = [date or datetime.datetime.now(), filename, publisher, title, size, status, au_id]
+        writer.writerow(row)
+    return [str(value) for value in row]
 
-def csv_to_html(csv_filename, html_filename):
-    # Read the CSV file into a DataFrame
-    df = pd.read_csv(csv_filename)
-    
-    # Convert DataFrame to HTML format with table styling
-    html_content = df.to_html(index=False, classes="table table-striped", border=0)
-    
-    # Create a basic HTML structure and embed the table
-    #should refactor this to use a single template
-    html_page = f"""
+### log.html is an index page linking to fixed-size pages (log-0001.html, log-0002.html, ...) of log.csv rows,
+### new rows are appended to the newest page so only that page and the index are rewritten per AU
+def weblog_page_path(html_filename, page):
+    stem, ext = os.path.splitext(html_filename)
+    return f"{stem}-{page:04d}{ext}"
+
+def weblog_state_path(html_filename):
+    #page bookkeeping (rows and date range per page), kept next to log.html
+    return os.path.splitext(html_filename)[0] + '-pages.json'
+
+def write_html_file(path, content):
+    with open(path + '.tmp', 'w') as file:
+        file.write(content)
+    os.replace(path + '.tmp', path)
+
+def render_weblog_page(html_filename, header, rows, page, has_next):
+    #one page of the log, same table styling pandas' to_html gave the single page log
+    head_cells = ''.join(f"\n          <th>{html.escape(cell)}</th>" for cell in header)
+    body_rows = ''.join(render_weblog_row(row) for row in rows)
+    return f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>MDPN Import Log - Page {page}</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; }}
+            .table {{ width: 100%; border-collapse: collapse; }}
+            .table th, .table td {{ padding: 8px; border: 1px solid #ddd; text-align: left; }}
+            .table th {{ background-color: #f2f2f2; }}
+        </style>
+    </head>
+    <body>
+        <h2>MDPN Import Log - Page {page}</h2>
+        {render_weblog_nav(html_filename, page, has_next)}
+        <table border="0" class="dataframe table table-striped">
+      <thead>
+        <tr style="text-align: right;">{head_cells}
+        </tr>
+      </thead>
+      <tbody>{body_rows}
+      </tbody>
+    </table>
+        <a href="log.csv">log.csv download</a> 
+    </body>
+    </html>
+    """
+
+def render_weblog_row(row):
+    cells = ''.join(f"\n          <td>{html.escape(cell)}</td>" for cell in row)
+    return f"\n        <tr>{cells}\n        </tr>"
+
+def render_weblog_nav(html_filename, page, has_next):
+    links = [f'<a href="{os.path.basename(html_filename)}">index</a>']
+    if page > 1:
+        links.append(f'<a href="{os.path.basename(weblog_page_path(html_filename, page - 1))}">previous</a>')
+    if has_next:
+        links.append(f'<a href="{os.path.basename(weblog_page_path(html_filename, page + 1))}">next</a>')
+    return '<!-- nav --><p>' + ' | '.join(links) + '</p><!-- /nav -->'
+
+def write_weblog_index(html_filename, state):
+    #small landing page, one line per page, newest first
+    items = ''
+    for page in range(len(state['pages']), 0, -1):
+        info = state['pages'][page - 1]
+        href = os.path.basename(weblog_page_path(html_filename, page))
+        items += f"\n            <tr><td><a href=\"{href}\">Page {page}</a></td><td>{info['rows']}</td><td>{html.escape(info['first'])}</td><td>{html.escape(info['last'])}</td></tr>"
+    total = sum(info['rows'] for info in state['pages'])
+    write_html_file(html_filename, f"""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -244,19 +797,106 @@ def csv_to_html(csv_filename, html_filename):
     </head>
     <body>
         <h2>MDPN Import Log</h2>
-        {html_content}
+        <p>{total} entries, {state['page_size']} per page</p>
+        <table border="0" class="table table-striped">
+            <tr><th>Page</th><th>Entries</th><th>First</th><th>Last</th></tr>{items}
+        </table>
         <a href="log.csv">log.csv download</a> 
     </body>
     </html>
-    """
-    
-    # Write the HTML content to a file
-    with open(html_filename, "w") as file:
-        file.write(html_page)
+    """)
+    with open(weblog_state_path(html_filename) + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(weblog_state_path(html_filename) + '.tmp', weblog_state_path(html_filename))
+
+def csv_to_html(csv_filename, html_filename):
+    #full rebuild of the paged log from log.csv, streamed so the whole log is never held in memory
+    page_size = int(config.get('DEFAULT', 'weblog_page_size', fallback='') or 1000)
+    state = {'page_size': page_size, 'header': [], 'pages': []}
+
+    def flush(rows, has_next):
+        page = len(state['pages']) + 1
+        write_html_file(weblog_page_path(html_filename, page), render_weblog_page(html_filename, state['header'], rows, page, has_next))
+        state['pages'].append({'rows': len(rows), 'first': rows[0][0] if rows else '', 'last': rows[-1][0] if rows else ''})
+
+    with open(csv_filename, 'r', newline='') as file:
+        reader = csv.reader(file)
+        state['header'] = next(reader, [])
+        rows = []
+        for row in reader:
+            if len(rows) == page_size:
+                flush(rows, True)
+                rows = []
+            rows.append(row)
+        if rows or not state['pages']:
+            flush(rows, False)
+    write_weblog_index(html_filename, state)
+
+def append_to_weblog(row, csv_filename, html_filename):
+    #add one log.csv row to the paged log, rewriting only the newest page (or starting the next one) and the index
+    state_path = weblog_state_path(html_filename)
+    if not os.path.exists(state_path):
+        csv_to_html(csv_filename, html_filename)  #first run, or the log predates paging, the row is already in log.csv
+        return
+    with open(state_path, 'r') as file:
+        state = json.load(file)
+
+    page = len(state['pages'])
+    current = state['pages'][-1]
+    if current['rows'] >= state['page_size']:
+        #roll over, the full page gets its "next" link and a new page is started
+        full_path = weblog_page_path(html_filename, page)
+        with open(full_path, 'r') as file:
+            content = file.read()
+        content = re.sub(r'<!-- nav -->.*?<!-- /nav -->', lambda m: render_weblog_nav(html_filename, page, True), content, count=1, flags=re.S)
+        write_html_file(full_path, content)
+        page += 1
+        write_html_file(weblog_page_path(html_filename, page), render_weblog_page(html_filename, state['header'], [row], page, False))
+        state['pages'].append({'rows': 1, 'first': row[0], 'last': row[0]})
+    else:
+        page_path = weblog_page_path(html_filename, page)
+        with open(page_path, 'r') as file:
+            content = file.read()
+        marker = content.rindex('\n      </tbody>')
+        write_html_file(page_path, content[:marker] + render_weblog_row(row) + content[marker:])
+        current['rows'] += 1
+        current['last'] = row[0]
+        if not current['first']:
+            current['first'] = row[0]
+    write_weblog_index(html_filename, state)
+
+def log_droid_report(report_path, package_name, publisher, title):
+    #central DROID log, the indexed SQLite store if droid_db is configured, otherwise the flat droid_log csv
+    droid_db = config.get('DROID', 'droid_db', fallback='').strip()
+    if droid_db:
+        conn = droid_store.connect(droid_db)
+        try:
+            droid_store.append_report(conn, report_path, package_name, publisher, title, str(datetime.datetime.now()))
+        finally:
+            conn.close()
+    else:
+        append_droid_log(report_path, config['DROID']['droid_log'], package_name, publisher, title)
+
+def append_droid_log(report_path, droid_log, package_name, publisher, title):
+    #stream an AU's droid_report.csv into the central DROID log row by row, adding the package columns
+    date = datetime.datetime.now()
+    write_header = not os.path.exists(droid_log)
+    with open(report_path, 'r', newline='', encoding='utf-8') as report:
+        reader = csv.reader(report)
+        header = next(reader, None)
+        if header is None:
+            return
+        with open(droid_log, 'a', newline='', encoding='utf-8') as log:
+            writer = csv.writer(log)
+            # Write the header only if the file doesn't exist
+            if write_header:
+                writer.writerow(header + ['Package_Name', 'Source_Organization', 'External-Identifier', 'Date'])
+            for row in reader:
+                writer.writerow(row + [package_name, publisher, title, date])
 
 def send_notification_email(au_name, to_email, success=True, error_message=None, attachments=None):
     """
-    Send email notification after AU processing
+    Queue the email notification after AU processing, the outbox sender delivers it
 
     Args:
         au_name: Name of the archival unit
@@ -267,7 +907,7 @@ def send_notification_email(au_name, to_email, success=True, error_message=None,
     """
     try:
         # Check if email is enabled in config
-        if not config.has_section('EMAIL') or not config.getboolean('EMAIL', 'enabled', fallback=False):
+        if not email_enabled():
             return  # Email notifications disabled
 
         # Validate to_email
@@ -275,244 +915,1018 @@ def send_notification_email(au_name, to_email, success=True, error_message=None,
             print(f"Warning: No Contact-Email found for {au_name}, skipping email notification")
             return
 
-        # Email configuration
-        smtp_host = config.get('EMAIL', 'smtp_host', fallback='')
-        smtp_port = config.getint('EMAIL', 'smtp_port', fallback=587)
-        smtp_username = config.get('EMAIL', 'smtp_username', fallback='')
-        smtp_password = config.get('EMAIL', 'smtp_password', fallback='')
-        use_tls = config.getboolean('EMAIL', 'use_tls', fallback=True)
-        cc_emails = config.get('EMAIL', 'cc_emails', fallback='').strip()
-        from_email = "do_not_reply@mipres.org"
-
-        # Debug mode configuration
-        debug_mode = config.getboolean('EMAIL', 'debug_mode', fallback=False)
-        debug_output_dir = config.get('EMAIL', 'debug_output_dir', fallback='./email_debug')
-
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = from_email
-        msg['To'] = to_email.strip()
-        if cc_emails:
-            msg['Cc'] = cc_emails
-        msg['Date'] = datetime.datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z")
-
         if success:
-            msg['Subject'] = "AU Processing Complete"
+            subject = "AU Processing Complete"
             body = f"AU processing is complete for {au_name}"
         else:
-            msg['Subject'] = "AU Processing Failed"
+            subject = "AU Processing Failed"
             body = f"AU processing failed for {au_name}"
             if error_message:
                 body += f"\n\nError details:\n{error_message}"
 
-        msg.attach(MIMEText(body, 'plain'))
-
-        # Attach files if provided
-        attachment_info = []
-        if attachments:
-            for file_path in attachments:
-                if os.path.exists(file_path):
-                    try:
-                        with open(file_path, 'rb') as f:
-                            part = MIMEBase('application', 'octet-stream')
-                            part.set_payload(f.read())
-                            encoders.encode_base64(part)
-                            part.add_header('Content-Disposition', f'attachment; filename={os.path.basename(file_path)}')
-                            msg.attach(part)
-                            attachment_info.append(f"{os.path.basename(file_path)} ({os.path.getsize(file_path)} bytes)")
-                    except Exception as e:
-                        print(f"Warning: Could not attach file {file_path}: {e}")
-                        attachment_info.append(f"{os.path.basename(file_path)} (FAILED: {e})")
-
-        # Debug mode: save email to file instead of sending
-        if debug_mode:
-            # Create debug output directory if it doesn't exist
-            os.makedirs(debug_output_dir, exist_ok=True)
-
-            # Generate debug filename with timestamp
-            timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-            debug_filename = os.path.join(debug_output_dir, f"email_{au_name}_{timestamp}.txt")
-
-            # Build recipient list for debug output
-            recipients = [to_email.strip()]
-            if cc_emails:
-                recipients.extend([email.strip() for email in cc_emails.split(',')])
-
-            # Write email details to debug file
-            with open(debug_filename, 'w', encoding='utf-8') as debug_file:
-                debug_file.write("=" * 80 + "\n")
-                debug_file.write("EMAIL DEBUG OUTPUT\n")
-                debug_file.write("=" * 80 + "\n\n")
-                debug_file.write(f"From: {from_email}\n")
-                debug_file.write(f"To: {to_email.strip()}\n")
-                if cc_emails:
-                    debug_file.write(f"Cc: {cc_emails}\n")
-                debug_file.write(f"Subject: {msg['Subject']}\n")
-                debug_file.write(f"Date: {msg['Date']}\n")
-                debug_file.write(f"\nRecipient list: {', '.join(recipients)}\n")
-                debug_file.write("\n" + "-" * 80 + "\n")
-                debug_file.write("MESSAGE BODY:\n")
-                debug_file.write("-" * 80 + "\n\n")
-                debug_file.write(body)
-                debug_file.write("\n\n" + "-" * 80 + "\n")
-                debug_file.write("ATTACHMENTS:\n")
-                debug_file.write("-" * 80 + "\n")
-                if attachment_info:
-                    for att in attachment_info:
-                        debug_file.write(f"  - {att}\n")
-                else:
-                    debug_file.write("  (none)\n")
-                debug_file.write("\n" + "=" * 80 + "\n")
-                debug_file.write("END OF EMAIL DEBUG OUTPUT\n")
-                debug_file.write("=" * 80 + "\n")
-
-            print(f"DEBUG MODE: Email saved to {debug_filename}")
-            return
+        spool_email(to_email.strip(), subject, body, [(path, os.path.basename(path)) for path in attachments or []], au_name,
+                    bundle_name=f"{au_name}-reports.zip")
+
+    except Exception as e:
+        # Don't let email failures interrupt the main processing pipeline
+        print(f"Warning: Failed to send email notification for {au_name}: {e}")
+
+def email_enabled():
+    return config.has_section('EMAIL') and config.getboolean('EMAIL', 'enabled', fallback=False)
+
+def spool_email(to_email, subject, body, attachments, label, debug_name=None, bundle_name='reports.zip'):
+    """
+    Build a notification and write it to the outbox, the background sender delivers it
+
+    Attachments are streamed into one compressed zip. If the zip would be larger than
+    [EMAIL] max_attachment_size, nothing is attached and the body links to the staged
+    files under staging_url instead.
+
+    Args:
+        to_email: Primary recipient
+        subject: Subject line
+        body: Plain text body
+        attachments: List of (file path, name in the zip) pairs
+        label: What the email is about, for the run output and the debug filename
+        debug_name: Debug filename part when label isn't filename-safe
+        bundle_name: Filename of the attached zip
+    """
+    cc_emails = config.get('EMAIL', 'cc_emails', fallback='').strip()
+    from_email = "do_not_reply@mipres.org"
+
+    # Bundle the attachments, or link to them if the bundle is over the cap
+    attachment_info = []
+    bundle = None
+    attachments = [(file_path, name) for file_path, name in attachments if os.path.exists(file_path)]
+    if attachments:
+        max_size = int(config.get('EMAIL', 'max_attachment_size', fallback='') or 10 * 1024 * 1024)
+        bundle = build_attachment_bundle(attachments, max_size)
+        if bundle is None:
+            body += f"\n\nThe reports are larger than the {max_size} byte attachment limit, they can be downloaded from:\n"
+            for file_path, name in attachments:
+                url = staged_file_url(file_path)
+                body += f"  {url}\n" if url else f"  {name} (not available online)\n"
+                attachment_info.append(f"{name} (linked: {url or 'not available'})")
+
+    # Create message
+    msg = MIMEMultipart()
+    msg['From'] = from_email
+    msg['To'] = to_email
+    if cc_emails:
+        msg['Cc'] = cc_emails
+    msg['Date'] = datetime.datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z")
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+
+    # Attach the bundle, its size is capped by max_attachment_size
+    if bundle is not None:
+        part = MIMEBase('application', 'zip')
+        part.set_payload(bundle['data'])
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', f'attachment; filename={bundle_name}')
+        msg.attach(part)
+        attachment_info.append(f"{bundle_name} ({len(bundle['data'])} bytes): " + ", ".join(bundle['members']))
+
+    # Build recipient list (To + CC)
+    recipients = [to_email]
+    if cc_emails:
+        recipients.extend([email.strip() for email in cc_emails.split(',')])
+
+    summary = {
+        'label': label,
+        'name': debug_name or label,
+        'to': to_email,
+        'cc': cc_emails,
+        'subject': msg['Subject'],
+        'date': msg['Date'],
+        'body': body,
+        'attachments': attachment_info,
+    }
+    outbox.spool(outbox_dir(), from_email, recipients, msg.as_string(), summary, re.sub(r'[^A-Za-z0-9._-]', '_', debug_name or label))
+
+def build_attachment_bundle(attachments, max_size):
+    """
+    Stream files into a deflated zip, a chunk at a time, without reading any of them whole
+
+    Args:
+        attachments: List of (file path, name in the zip) pairs
+        max_size: Largest zip allowed, building stops as soon as it is passed
+
+    Returns:
+        dict: the zip bytes and a description of each member, or None if it is over max_size
+    """
+    members = []
+    with tempfile.TemporaryFile() as bundle_file:
+        with zipfile.ZipFile(bundle_file, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+            for file_path, name in attachments:
+                try:
+                    with open(file_path, 'rb') as src, bundle.open(name, 'w', force_zip64=True) as dest:
+                        shutil.copyfileobj(src, dest, HASH_CHUNK_SIZE)
+                    members.append(f"{name} ({os.path.getsize(file_path)} bytes)")
+                except Exception as e:
+                    print(f"Warning: Could not attach file {file_path}: {e}")
+                    members.append(f"{name} (FAILED: {e})")
+                if bundle_file.tell() > max_size:
+                    return None
+        if bundle_file.tell() > max_size:
+            return None
+        bundle_file.seek(0)
+        return {'data': bundle_file.read(), 'members': members}
+
+def staged_file_url(file_path):
+    #URL of a file in the staging area under staging_url, None if it isn't in destination_dir
+    relative = os.path.relpath(file_path, config['DEFAULT']['destination_dir'])
+    if relative.startswith(os.pardir):
+        return None
+    return config['DEFAULT']['staging_url'].rstrip('/') + '/' + '/'.join(urllib.parse.quote(part) for part in relative.split(os.sep))
+
+def outbox_dir():
+    #[EMAIL] outbox_dir, or outbox next to preprocess.py
+    path = config.get('EMAIL', 'outbox_dir', fallback='').strip()
+    return path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox')
+
+def deliver_outbox():
+    """
+    Deliver every outbox message that is due, over the shared SMTP connection
+
+    A failed send stays in the outbox and is retried after retry_delay seconds, doubling each
+    time, until max_attempts; then it is moved to the outbox's failed/ folder. In debug mode
+    delivering a message means writing its debug view instead of sending it.
+
+    Returns:
+        tuple: (delivered, retrying, failed) counts for this pass
+    """
+    directory = outbox_dir()
+    debug_mode = config.getboolean('EMAIL', 'debug_mode', fallback=False)
+    retry_delay = float(config.get('EMAIL', 'retry_delay', fallback='') or 60)
+    max_attempts = int(config.get('EMAIL', 'max_attempts', fallback='') or 8)
+    sent = retrying = failed = 0
+
+    outbox.release_stale_claims(directory)
+    for filename in outbox.due_messages(directory):
+        envelope = outbox.claim(directory, filename)
+        if envelope is None:
+            continue  #another sender took it
+        label = envelope['summary']['label']
+        try:
+            if debug_mode:
+                write_debug_email(envelope)
+            else:
+                send_spooled_email(envelope)
+                print(f"Email notification sent for {label} to {envelope['summary']['to']}" + (f" (CC: {envelope['summary']['cc']})" if envelope['summary']['cc'] else ""))
+            outbox.delivered(directory, filename)
+            sent += 1
+        except smtplib.SMTPRecipientsRefused as error:
+            outbox.give_up(directory, filename, envelope, str(error))
+            print(f"Error: Email for {label} refused by the server, moved to {os.path.join(directory, outbox.FAILED)}: {error}")
+            failed += 1
+        except Exception as error:
+            close_smtp_connection()  #start the next attempt on a fresh connection
+            if outbox.retry_later(directory, filename, envelope, str(error), retry_delay, max_attempts):
+                print(f"Warning: Email for {label} not sent, will retry: {error}")
+                retrying += 1
+            else:
+                print(f"Error: Email for {label} not sent after {max_attempts} attempts, moved to {os.path.join(directory, outbox.FAILED)}: {error}")
+                failed += 1
+    return sent, retrying, failed
+
+def send_spooled_email(envelope):
+    message = envelope['message'].encode('utf-8')
+    try:
+        smtp_connection().sendmail(envelope['from'], envelope['recipients'], message)
+    except smtplib.SMTPServerDisconnected:
+        #the server dropped the shared connection (idle timeout), reconnect once
+        close_smtp_connection()
+        smtp_connection().sendmail(envelope['from'], envelope['recipients'], message)
+
+def write_debug_email(envelope):
+    #debug mode, the view of a spooled email that used to be written in place of sending it
+    summary = envelope['summary']
+    debug_output_dir = config.get('EMAIL', 'debug_output_dir', fallback='./email_debug')
+
+    # Create debug output directory if it doesn't exist
+    os.makedirs(debug_output_dir, exist_ok=True)
+
+    # Generate debug filename with timestamp
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    debug_filename = os.path.join(debug_output_dir, f"email_{summary['name']}_{timestamp}.txt")
+
+    # Write email details to debug file
+    with open(debug_filename, 'w', encoding='utf-8') as debug_file:
+        debug_file.write("=" * 80 + "\n")
+        debug_file.write("EMAIL DEBUG OUTPUT\n")
+        debug_file.write("=" * 80 + "\n\n")
+        debug_file.write(f"From: {envelope['from']}\n")
+        debug_file.write(f"To: {summary['to']}\n")
+        if summary['cc']:
+            debug_file.write(f"Cc: {summary['cc']}\n")
+        debug_file.write(f"Subject: {summary['subject']}\n")
+        debug_file.write(f"Date: {summary['date']}\n")
+        debug_file.write(f"\nRecipient list: {', '.join(envelope['recipients'])}\n")
+        debug_file.write("\n" + "-" * 80 + "\n")
+        debug_file.write("MESSAGE BODY:\n")
+        debug_file.write("-" * 80 + "\n\n")
+        debug_file.write(summary['body'])
+        debug_file.write("\n\n" + "-" * 80 + "\n")
+        debug_file.write("ATTACHMENTS:\n")
+        debug_file.write("-" * 80 + "\n")
+        if summary['attachments']:
+            for att in summary['attachments']:
+                debug_file.write(f"  - {att}\n")
+        else:
+            debug_file.write("  (none)\n")
+        debug_file.write("\n" + "=" * 80 + "\n")
+        debug_file.write("END OF EMAIL DEBUG OUTPUT\n")
+        debug_file.write("=" * 80 + "\n")
+
+    print(f"DEBUG MODE: Email saved to {debug_filename}")
+
+def start_outbox_sender():
+    #background delivery, the pipeline only ever writes to the spool and never waits on SMTP
+    stop = threading.Event()
+    thread = threading.Thread(target=run_outbox_sender, args=(stop,), name='outbox-sender', daemon=True)
+    thread.start()
+    return stop, thread
+
+def run_outbox_sender(stop):
+    interval = float(config.get('EMAIL', 'outbox_poll_interval', fallback='') or 5)
+    while not stop.is_set():
+        try:
+            deliver_outbox()
+        except Exception as error:
+            print("Error delivering the email outbox", error)
+        stop.wait(interval)
+    try:  #a last pass for emails spooled at the end of the run, eg digests
+        deliver_outbox()
+    except Exception as error:
+        print("Error delivering the email outbox", error)
+    finally:
+        close_smtp_connection()
+
+def stop_outbox_sender(sender):
+    stop, thread = sender
+    stop.set()
+    thread.join(float(config.get('EMAIL', 'flush_timeout', fallback='') or 60))
+    if thread.is_alive():
+        print(f"Warning: Email delivery still in progress, undelivered emails stay in {outbox_dir()} for the next run or --send-outbox")
+
+def smtp_connection():
+    #one connection, STARTTLS and login shared by every email the sender delivers, instead of one per AU
+    global smtp_server
+    if smtp_server is None:
+        # Email configuration
+        smtp_host = config.get('EMAIL', 'smtp_host', fallback='')
+        smtp_port = config.getint('EMAIL', 'smtp_port', fallback=587)
+        smtp_username = config.get('EMAIL', 'smtp_username', fallback='')
+        smtp_password = config.get('EMAIL', 'smtp_password', fallback='')
+        use_tls = config.getboolean('EMAIL', 'use_tls', fallback=True)
+        timeout = float(config.get('EMAIL', 'smtp_timeout', fallback='') or 60)
 
-        # Send email (normal mode)
         if use_tls:
-            server = smtplib.SMTP(smtp_host, smtp_port)
+            server = smtplib.SMTP(smtp_host, smtp_port, timeout=timeout)
             server.starttls()
         else:
-            server = smtplib.SMTP_SSL(smtp_host, smtp_port)
+            server = smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=timeout)
 
         if smtp_username and smtp_password:
             server.login(smtp_username, smtp_password)
+        smtp_server = server
+    return smtp_server
 
-        # Build recipient list (To + CC)
-        recipients = [to_email.strip()]
-        if cc_emails:
-            recipients.extend([email.strip() for email in cc_emails.split(',')])
+def close_smtp_connection():
+    global smtp_server
+    if smtp_server is not None:
+        try:
+            smtp_server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass  #already dropped by the server
+        smtp_server = None
 
-        server.send_message(msg, to_addrs=recipients)
-        server.quit()
+def digest_mode():
+    #[EMAIL] digest, one summary email per Contact-Email per run instead of one per AU
+    return email_enabled() and config.getboolean('EMAIL', 'digest', fallback=False)
 
-        print(f"Email notification sent for {au_name} to {to_email}" + (f" (CC: {cc_emails})" if cc_emails else ""))
+def queue_digest_entry(result):
+    #held until send_digests at the end of the run, grouped on Contact-Email
+    contact_email = result['baginfo_dict'].get('Contact-Email', '').strip()
+    pending_digests.setdefault(contact_email, []).append(result)
 
-    except Exception as e:
-        # Don't let email failures interrupt the main processing pipeline
-        print(f"Warning: Failed to send email notification for {au_name}: {e}")
+def send_digests():
+    """
+    Send one email per Contact-Email covering every AU it deposited this run
 
-################################### MAIN ENTRY #################################################
-### main entry point triggered by __main__ below, handles all processing as branch statements
-### and hands off to functions above
-def process_tar_files(directory):
+    The body is a summary table of the AUs with their status and size, followed by the error
+    details of any that failed. The staged AUs' bag-info.txt, clamav.txt and droid_report.csv
+    are attached, prefixed with the AU name. Each AU's email stage is marked done, so
+    finish_checkpoints can clear it.
+    """
+    for contact_email, results in list(pending_digests.items()):
+        try:
+            if not contact_email:
+                print(f"Warning: No Contact-Email found for {', '.join(r['fname'] for r in results)}, skipping email notification")
+                continue
+
+            failed = [r for r in results if r['status'] != "Staged"]
+            name_width = max(len("AU"), *(len(r['fname']) for r in results))
+            status_width = max(len("Status"), *(len(r['status']) for r in results))
+            lines = [f"AU processing summary: {len(results)} AU(s), {len(results) - len(failed)} staged, {len(failed)} failed", ""]
+            lines.append(f"{'AU':<{name_width}}  {'Status':<{status_width}}  Size (B)")
+            lines.append(f"{'-' * name_width}  {'-' * status_width}  --------")
+            for r in results:
+                lines.append(f"{r['fname']:<{name_width}}  {r['status']:<{status_width}}  {r['size']}")
+            for r in failed:
+                if r['error_details']:
+                    lines += ["", f"Error details for {r['fname']}:", r['error_details']]
+
+            attachments = []
+            for r in results:
+                if r['status'] == "Staged":
+                    for filename in ('bag-info.txt', 'clamav.txt', 'droid_report.csv'):
+                        attachments.append((os.path.join(config['DEFAULT']['destination_dir'], r['fname'], filename), f"{r['fname']}/{filename}"))
+
+            subject = f"AU Processing Summary: {len(results)} AU(s)" + (f", {len(failed)} failed" if failed else "")
+            spool_email(contact_email, subject, "\n".join(lines), attachments, f"{len(results)} AU(s)",
+                          "digest_" + re.sub(r'[^A-Za-z0-9._-]', '_', contact_email), bundle_name="reports.zip")
+        except Exception as e:
+            print(f"Warning: Failed to send digest email to {contact_email}: {e}")
+        finally:
+            for r in results:
+                r['completed'].append('email')
+            del pending_digests[contact_email]
+
+def find_tar_files(directory):
+    #list every uploaded tarball up front, so AU folders created while processing aren't walked into
+    tar_files = []
     for root, _, files in os.walk(directory):
         for file in files:
             if file.endswith('.tar'):
-                file_path = os.path.join(root, file)    #file path
-                file_name = os.path.basename(file_path) #file name
-                fname = os.path.splitext(file_name)     #file name without path or ext in array
-                size = os.path.getsize(file_path)
-                new_file_path = os.path.join(root, fname[0]) #new file path after the tar is put into a folder with the logging files
-                    
-                #validity checks
-                if is_web_safe_filename(fname[0]):      #check filename is websafe
-                    if is_right_size(file_path):        #check the file is under max_au_size
-                        if run_clamav_scan(file_path):  #run the clamav scan, proceed if clear
-                                baginfo_dict = {}  # Initialize in case extraction fails
-                                try:    #try and parse the tarball, get the manifest and bag-info, and create manifest
-                                    baginfo_dict = extract_and_convert_manifest(file_path, root)
-                                except Exception as error:
-                                    print(f"Error: Failed to extract manifest from {file_path}, possibly corrupted, uploading", error)
-
-                                try:     #move the tarball into the folder with the manifest and bag-info file
-                                    shutil.move(file_path, os.path.join(root, fname[0], file))         #move tarball into the AU folder
-                                    shutil.move(file_path + '-clamav.txt', os.path.join(root, fname[0], 'clamav.txt'))         #move clamav.txt into the AU folder
-                                except Exception as error:
-                                    print("Error moving tar or clamav.txt into au folder", error)
-
-                                try:  #try to parse bag-info.txt and create the titledb
-                                    # Use baginfo_dict from extract_and_convert_manifest
-                                    publisher = baginfo_dict.get('Source-Organization', '')
-                                    title = baginfo_dict.get('External-Identifier', '')
-                                    journal_title = baginfo_dict.get('Bag-Group-Identifier', '')
-
-                                    #check that journal title (Bag-Group-Identifier) has data, if not, default to External-Identifer for the titledb
-                                    if not journal_title:
-                                        journal_title = title  #default to External-Identifer
-
-                                    insert_into_titledb(publisher, fname[0], title, journal_title)    #publisher, fname, title, journal_title
-                                except Exception as error:
-                                    print("Error inserting into titledb", error)
-                                    
-                                try: #try and run the droid format scan, generate reports
-                                    #generate the droid_report.csv file
-                                    result = subprocess.run([config['DROID']['java_path'], "-Xmx1024m", "-jar", config['DROID']['droid_path'], "-R", "-A", new_file_path, "-o", new_file_path + "/droid_report.csv" ], capture_output=True, text=True)                                   
-                                    #generate the droid_report.droid file, not really sure we need this... 
-                                    # subprocess.run([java_path, "-Xmx1024m", "-jar", droid_path, "-R", "-A", new_file_path, "-p", new_file_path + "/droid_profile.droid" ], capture_output=True, text=True)
-                                except Exception as error:
-                                    print(f"Error conducting droid format scan", result, error)
-                                
-                                try: #try to move the file to production folder
-                                    #note, ran into a bug below if the staging folder isn't created, dumps file contents in the desination root
-                                    shutil.move(new_file_path, config['DEFAULT']['destination_dir'])     #move into the production folder
-                                    status = "Staged"                           #update status for the log to "Staged"
-                                except Exception as error:
-                                    print(f"Error: Copy to production error, {file} may already exist, be uploading, or corrupted", error)
-                                    status = "Error: Copy to production error, file may already exist, be uploading, or corrupted"
-                        else:
-                            print(f"Error: ClamAV scan failed for {file_path}, file deleted")
-                            os.remove(file_path) #remove file
-                            os.remove(file_path + '-clamav.txt') #remove the scan results file
-                            status = "Error: ClamAV scan failed, file deleted"
-                    else:
-                        print(f"Error: {file_path} is either zero bytes or greater than {config['DEFAULT']['max_au_size']}, file deleted")
-                        os.remove(file_path) #remove file
-                        status = "Error: File is either zero bytes or greater than max size"
-                else:
-                    print(f"Error: The AU named {fname[0]} is not web safe, file deleted")
-                    os.remove(file_path) #remove file
-                    status = "Error: Package Name is not web safe, file deleted" 
-                
-                #update the log, logging reports user "if" conditions, not exceptions which are admin side, except for production copy (duplicate)
-                try:
-                    # Use baginfo_dict for consistency
-                    publisher = baginfo_dict.get('Source-Organization', '')
-                    title = baginfo_dict.get('External-Identifier', '')
-
-                    log_to_csv(fname[0], publisher, title, size, status, "edu|auburn|adpn|directory|AuburnDirectoryPlugin&base_url~" + urllib.parse.quote_plus(config['DEFAULT']['staging_url']).replace(".", "%2E") + "&directory~" + fname[0]) #filename, publisher, title, size, status, au_id
-                    csv_to_html(config['DEFAULT']['logfile'], config['DEFAULT']['weblog']) #convert the logfile over to an HTML file
-
-                    ### Log the droid data to the central log ###
-                    df = pd.read_csv(config['DEFAULT']['destination_dir'] + "/" + fname[0] + "/droid_report.csv")
-
-                    # Add the new columns to add in the package data
-                    df['Package_Name'] = fname[0]
-                    df['Source_Organization'] = publisher
-                    df['External-Identifier'] = title
-                    df['Date'] = datetime.datetime.now()
-
-                    # Check if the output file already exists
-                    if os.path.exists(config['DROID']['droid_log']):
-                        # Append to the existing file without writing the header
-                        df.to_csv(config['DROID']['droid_log'], mode='a', index=False, header=False)
-                    else:
-                        # Create a new file with the header
-                        df.to_csv(config['DROID']['droid_log'], index=False)
+                tar_files.append(os.path.join(root, file))
+    return tar_files
 
-                except Exception as error:
-                    print("Error inserting into logfile", error)
+def settled_uploads(tar_files):
+    #skip tarballs modified in the last settle_seconds, they may still be arriving over SFTP
+    settle_seconds = float(config.get('DEFAULT', 'settle_seconds', fallback='') or 60)
+    now = time.time()
+    settled = []
+    for file_path in tar_files:
+        if now - os.path.getmtime(file_path) < settle_seconds:
+            print(f"Skipping {file_path}, modified in the last {settle_seconds:g}s and may still be uploading")
+        else:
+            settled.append(file_path)
+    return settled
 
-                # Send email notification
-                try:
-                    # Get Contact-Email from baginfo_dict
-                    contact_email = baginfo_dict.get('Contact-Email', '')
-
-                    # Prepare attachment paths
-                    attachments = []
-                    if status == "Staged":  # Only attach files if processing succeeded
-                        baginfo_path = os.path.join(config['DEFAULT']['destination_dir'], fname[0], 'bag-info.txt')
-                        clamav_path = os.path.join(config['DEFAULT']['destination_dir'], fname[0], 'clamav.txt')
-                        droid_path = os.path.join(config['DEFAULT']['destination_dir'], fname[0], 'droid_report.csv')
-                        attachments = [baginfo_path, clamav_path, droid_path]
-                        send_notification_email(fname[0], contact_email, success=True, attachments=attachments)
-                    else:  # Processing failed
-                        send_notification_email(fname[0], contact_email, success=False, error_message=status)
-                except Exception as error:
-                    print(f"Warning: Email notification failed for {fname[0]}: {error}")
+def new_au_result(file_path):
+    #the state of one AU as it moves through the stages, saved as its checkpoint after each stage
+    root = os.path.dirname(file_path)
+    file = os.path.basename(file_path)       #file name
+    fname = os.path.splitext(file)           #file name without path or ext in array
+    return {
+        'fname': fname[0],
+        'size': os.path.getsize(file_path),
+        'status': None,  #set by the stage that finishes the AU's own pipeline, "Staged" or an error
+        'error_details': None, #longer explanation for the depositor email, status is used if not set
+        'baginfo_dict': {},
+        'add_to_titledb': False,
+        'au_dir': os.path.join(root, fname[0]), #new file path after the tar is put into a folder with the logging files
+        'source_path': file_path,
+        'tar_sha256': None,
+        'started': str(datetime.datetime.now()),
+        'timings': {},
+        'io': {},  #stage -> [bytes read, bytes written], where /proc/self/io is available
+        'outcomes': {},  #stage -> metrics.OK, FAILED or ERROR
+        'completed': [],  #stages done, a resumed AU skips these
+        'attempt_id': None,
+    }
+
+def process_au(file_path, defer_droid=False, state=None, profile_to=None):
+    """
+    Run one AU's own pipeline: validity checks, scan, extract and fixity, DROID and the staging move
+
+    Only this AU's files are touched, so it is safe to run in a worker process. Shared files
+    (titledb.xml, log.csv, log.html, the DROID log) and the email are left to record_au_result,
+    which runs in the main process. A checkpoint is saved to the ledger after each stage, so an
+    AU interrupted part way is resumed at its first incomplete stage by the next run.
+
+    Args:
+        file_path: Path to the uploaded tarball
+        defer_droid: Stop before DROID and the staging move, leaving status DROID_PENDING for the batch run
+        state: The AU's last checkpoint when resuming, None for a new upload
+        profile_to: Profile directory (see profiling.py), None unless profiling is on
+
+    Returns:
+        dict: fname, size, status, error_details, baginfo_dict, whether a titledb entry is due,
+              the tarball digest, per-stage timings and the stages completed
+    """
+    result = state or new_au_result(file_path)
+    result.setdefault('io', {})  #checkpoints written before stage metrics were recorded
+    result.setdefault('outcomes', {})
+    with profiling.profiled(profile_to, profile_name(result), 'pipeline'):
+        for stage, run_stage in AU_PIPELINE_STAGES:
+            if result['status'] is not None:
+                break  #rejected by an earlier stage, only the record stages are left
+            if stage in result['completed']:
+                continue
+            if stage == 'droid' and defer_droid:
+                #batch mode, DROID and the staging move happen once every AU in the run is ready
+                result['status'] = DROID_PENDING
+                break
+            try:
+                timed(result['timings'], stage, run_stage, result, io=result['io'], outcomes=result['outcomes'])
+            except Exception as error:
+                error.au_result = result  #what the AU got through, so the caller can still report its metrics
+                raise
+            result['outcomes'][stage] = stage_outcome(result)
+            checkpoint_stage(result, stage)
+    return result
+
+def profile_dir():
+    #where profiling mode writes its profiles, None when it is off
+    return profile_override or config.get('DEFAULT', 'profile_dir', fallback='').strip() or None
+
+def profile_name(result):
+    #an AU's profiles are named after the start of its attempt, so a resumed attempt adds to the same files
+    return f"{result['fname']}-{datetime.datetime.fromisoformat(result['started']):%Y%m%d-%H%M%S}"
+
+def stage_outcome(result):
+    #a pipeline stage failed if it left an error status, a stage that raised is marked ERROR by stage_timer
+    return metrics.OK if result['status'] in (None, "Staged", DROID_PENDING) else metrics.FAILED
+
+def check_upload(result):
+    #validity checks
+    file_path = result['source_path']
+    if not is_web_safe_filename(result['fname']):      #check filename is websafe
+        print(f"Error: The AU named {result['fname']} is not web safe, file deleted")
+        os.remove(file_path) #remove file
+        result['status'] = "Error: Package Name is not web safe, file deleted"
+    elif not is_right_size(file_path):        #check the file is under max_au_size
+        print(f"Error: {file_path} is either zero bytes or greater than {config['DEFAULT']['max_au_size']}, file deleted")
+        os.remove(file_path) #remove file
+        result['status'] = "Error: File is either zero bytes or greater than max size"
+
+def scan_upload(result):
+    #run the clamav scan, proceed if clear
+    file_path = result['source_path']
+    if not run_clamav_scan(file_path):
+        print(f"Error: ClamAV scan failed for {file_path}, file deleted")
+        os.remove(file_path) #remove file
+        os.remove(file_path + '-clamav.txt') #remove the scan results file
+        result['status'] = "Error: ClamAV scan failed, file deleted"
+
+def extract_upload(result):
+    #parse the tarball, verify the payload, then put the tarball into the AU folder next to its manifest
+    file_path = result['source_path']
+    root = os.path.dirname(file_path)
+    fixity_errors = []
+    try:    #try and parse the tarball, get the manifest and bag-info, verify the payload and create manifest
+        result['baginfo_dict'], fixity_errors, result['tar_sha256'] = extract_and_convert_manifest(file_path, root)
+    except Exception as error:
+        print(f"Error: Failed to extract manifest from {file_path}, possibly corrupted, uploading", error)
+
+    if fixity_errors:
+        print(f"Error: Bag fixity check failed for {file_path}, file deleted")
+        for problem in fixity_errors:
+            print(f"  {problem}")
+        os.remove(file_path) #remove file
+        os.remove(file_path + '-clamav.txt') #remove the scan results file
+        shutil.rmtree(result['au_dir'], ignore_errors=True) #remove the extracted bag-info and manifest
+        result['status'] = "Error: Bag fixity check failed, file deleted"
+        result['error_details'] = f"{result['status']} ({len(fixity_errors)} problems)\n" + "\n".join(fixity_errors[:MAX_REPORTED_FIXITY_ERRORS])
+        return
+
+    try:     #move the tarball into the folder with the manifest and bag-info file
+        staging_transfer.move(file_path, result['au_dir'])         #move tarball into the AU folder
+        shutil.move(file_path + '-clamav.txt', os.path.join(result['au_dir'], 'clamav.txt'))         #move clamav.txt into the AU folder
+    except Exception as error:
+        print("Error moving tar or clamav.txt into au folder", error)
+
+    result['add_to_titledb'] = True #the titledb entry is written by record_au_result
+
+def droid_au(result):
+    run_droid([result['au_dir']])
+
+def move_au(result):
+    staged_path = os.path.join(config['DEFAULT']['destination_dir'], result['fname'])
+    if not os.path.exists(result['au_dir']) and os.path.isdir(staged_path):
+        result['status'] = "Staged"  #moved before the last run stopped, ahead of its checkpoint
+        return
+    result['status'] = stage_au(result['au_dir'], result['tar_sha256'])
+
+#the AU's own stages in order, run by process_au; titledb, log and email follow in record_au_result
+AU_PIPELINE_STAGES = [
+    ('size_check', check_upload),
+    ('scan', scan_upload),
+    ('extract', extract_upload),
+    ('droid', droid_au),
+    ('move', move_au),
+]
+AU_RECORD_STAGES = ['titledb', 'log', 'email']
+
+def checkpoint_stage(result, stage):
+    #mark a stage done and save the AU's state to the ledger, the next run resumes after it
+    result['completed'].append(stage)
+    ledger.save_checkpoint(open_ledger(), result['fname'], result)
+
+def timed(timings, stage, func, *args, io=None, outcomes=None):
+    #call func(*args), adding its wall time to timings[stage] (and its bytes read and written to io[stage])
+    with stage_timer(timings, stage, io, outcomes):
+        return func(*args)
+
+@contextlib.contextmanager
+def stage_timer(timings, stage, io=None, outcomes=None):
+    #time a block, adding its wall time in seconds to timings[stage] and, given io, its [bytes read, bytes written] to io[stage]
+    #given outcomes, a block that raises is recorded there as metrics.ERROR
+    start = time.monotonic()
+    counters = metrics.io_counters() if io is not None else None
+    try:
+        yield
+    except Exception:
+        if outcomes is not None:
+            outcomes[stage] = metrics.ERROR
+        raise
+    finally:
+        timings[stage] = round(timings.get(stage, 0) + time.monotonic() - start, 3)
+        if counters is not None:
+            now = metrics.io_counters()
+            previous = io.get(stage, [0, 0])
+            io[stage] = [previous[0] + now[0] - counters[0], previous[1] + now[1] - counters[1]]
+
+def run_droid(au_dirs):
+    """
+    Profile AU folders with DROID and write each folder's droid_report.csv
+
+    A single folder is profiled straight into its report. Several folders (batch mode) are
+    profiled by one DROID invocation, paying JVM startup and signature loading once, and the
+    combined CSV is split back into each folder's report with the same columns.
+    """
+    if not au_dirs:
+        return
+    if len(au_dirs) == 1:
+        output = os.path.join(au_dirs[0], 'droid_report.csv')
+    else:
+        output = os.path.join(os.path.dirname(au_dirs[0]), f"droid_batch_{os.getpid()}.csv")
+
+    result = None
+    try: #try and run the droid format scan, generate reports
+        #generate the droid_report.csv file
+        result = subprocess.run([config['DROID']['java_path'], "-Xmx1024m", "-jar", config['DROID']['droid_path'], "-R", "-A", *au_dirs, "-o", output], capture_output=True, text=True)
+        #generate the droid_report.droid file, not really sure we need this...
+        # subprocess.run([java_path, "-Xmx1024m", "-jar", droid_path, "-R", "-A", new_file_path, "-p", new_file_path + "/droid_profile.droid" ], capture_output=True, text=True)
+        if len(au_dirs) > 1:
+            split_droid_report(output, au_dirs)
+    except Exception as error:
+        print(f"Error conducting droid format scan", result, error)
+    finally:
+        if len(au_dirs) > 1 and os.path.exists(output):
+            os.remove(output)
+
+def split_droid_report(combined_path, au_dirs):
+    #split a batch DROID csv into each AU folder's droid_report.csv, rows are matched on FILE_PATH
+    prefixes = sorted(((os.path.abspath(d), d) for d in au_dirs), key=lambda p: len(p[0]), reverse=True)
+    writers = {}
+    files = []
+    try:
+        with open(combined_path, 'r', newline='', encoding='utf-8') as combined:
+            reader = csv.reader(combined)
+            header = next(reader)
+            path_column = header.index('FILE_PATH')
+            for au_dir in au_dirs:
+                f = open(os.path.join(au_dir, 'droid_report.csv'), 'w', newline='', encoding='utf-8')
+                files.append(f)
+                writers[au_dir] = csv.writer(f, quoting=csv.QUOTE_ALL)
+                writers[au_dir].writerow(header)
+            for row in reader:
+                path = os.path.abspath(row[path_column])
+                for prefix, au_dir in prefixes:
+                    if path == prefix or path.startswith(prefix + os.sep):
+                        writers[au_dir].writerow(row)
+                        break
+    finally:
+        for f in files:
+            f.close()
+
+def stage_au(new_file_path, tar_sha256=None):
+    #move the AU folder into the staging area, returns the status for the log
+    #a rename on the same filesystem, otherwise a kernel-side copy that is fsynced and verified before it appears in staging
+    name = os.path.basename(new_file_path)
+    expected_sha256 = {}
+    if tar_sha256 and config.get('DEFAULT', 'staging_verify', fallback='').strip().lower() == 'sha256':
+        expected_sha256[name + '.tar'] = tar_sha256  #re-read the staged copy and check it against the digest taken at extraction
+    try: #try to move the file to production folder
+        #the staging folder has to exist, a missing one is an error rather than a rename to destination_dir
+        stats = staging_transfer.move(new_file_path, config['DEFAULT']['destination_dir'], expected_sha256)     #move into the production folder
+        if stats.method != 'rename':
+            print(staging_transfer.describe(name, stats))
+        return "Staged"                           #update status for the log to "Staged"
+    except Exception as error:
+        print(f"Error: Copy to production error, {os.path.basename(new_file_path)}.tar may already exist, be uploading, or corrupted", error)
+        return "Error: Copy to production error, file may already exist, be uploading, or corrupted"
+
+def finish_droid_batch(results):
+    #batch mode, one DROID run over every AU waiting on it, then each of them is staged
+    pending = [result for result in results if result['status'] == DROID_PENDING]
+    batch_timings = {}
+    batch_io = {}
+    timed(batch_timings, 'droid', run_droid, [result['au_dir'] for result in pending], io=batch_io)
+    for result in pending:
+        result['status'] = None
+        result['timings']['droid'] = round(batch_timings['droid'] / len(pending), 3)  #each AU's share of the batch run
+        if 'droid' in batch_io:
+            result['io']['droid'] = [count // len(pending) for count in batch_io['droid']]
+        result['outcomes']['droid'] = metrics.OK
+        checkpoint_stage(result, 'droid')
+        with profiling.profiled(profile_dir(), profile_name(result), 'move'):
+            timed(result['timings'], 'move', move_au, result, io=result['io'], outcomes=result['outcomes'])
+        result['outcomes']['move'] = stage_outcome(result)
+        checkpoint_stage(result, 'move')
+
+def record_au_result(result):
+    """
+    Apply an AU's shared side effects: titledb.xml, log.csv, log.html, the DROID log and the email
+
+    Always runs in the main process, one AU at a time, so these files have a single writer
+    however many workers process_tar_files uses. Stages a resumed AU already completed are
+    skipped; the titledb stage is only checkpointed once commit_titledb has written the entry.
+    """
+    with profiling.profiled(profile_dir(), profile_name(result), 'record'):
+        record_au_stages(result)
+
+def record_au_stages(result):
+    fname = result['fname']
+    status = result['status']
+    baginfo_dict = result['baginfo_dict']
+    timings = result['timings']
+    completed = result['completed']
+    io = result.setdefault('io', {})
+    outcomes = result.setdefault('outcomes', {})
+    recording = 'log' not in completed  #this call records the attempt, its metrics are reported at the end
+
+    if result['add_to_titledb'] and 'titledb' not in completed:
+        try:  #try to parse bag-info.txt and create the titledb
+            # Use baginfo_dict from extract_and_convert_manifest
+            publisher = baginfo_dict.get('Source-Organization', '')
+            title = baginfo_dict.get('External-Identifier', '')
+            journal_title = baginfo_dict.get('Bag-Group-Identifier', '')
+
+            #check that journal title (Bag-Group-Identifier) has data, if not, default to External-Identifer for the titledb
+            if not journal_title:
+                journal_title = title  #default to External-Identifer
+
+            timed(timings, 'titledb', queue_titledb_entry, publisher, fname, title, journal_title, io=io)    #publisher, fname, title, journal_title, committed at the end of the run
+            outcomes['titledb'] = metrics.OK
+        except Exception as error:
+            print("Error inserting into titledb", error)
+            outcomes['titledb'] = metrics.ERROR
+
+    #update the log, logging reports user "if" conditions, not exceptions which are admin side, except for production copy (duplicate)
+    if 'log' not in completed:
+        try:
+            # Use baginfo_dict for consistency
+            publisher = baginfo_dict.get('Source-Organization', '')
+            title = baginfo_dict.get('External-Identifier', '')
+
+            au_id = "edu|auburn|adpn|directory|AuburnDirectoryPlugin&base_url~" + urllib.parse.quote_plus(config['DEFAULT']['staging_url']).replace(".", "%2E") + "&directory~" + fname
+            finished = str(datetime.datetime.now())
+
+            outcomes['log'] = metrics.ERROR  #until the block below finishes
+            with stage_timer(timings, 'log', io):
+                #the ledger is the record of the attempt, log.csv and log.html are exports of it
+                result['attempt_id'] = ledger.record_attempt(open_ledger(), fname, result['size'], status, publisher, title, au_id,
+                                                             result['tar_sha256'], result['source_path'], result['started'], finished, timings)
+
+                row = log_to_csv(fname, publisher, title, result['size'], status, au_id, date=finished) #filename, publisher, title, size, status, au_id
+                append_to_weblog(row, config['DEFAULT']['logfile'], config['DEFAULT']['weblog']) #add the entry to the paged HTML log
+
+                ### Log the droid data to the central log ###
+                droid_report = config['DEFAULT']['destination_dir'] + "/" + fname + "/droid_report.csv"
+                if os.path.exists(droid_report):  #only staged AUs have one, a rejected AU never reached DROID
+                    log_droid_report(droid_report, fname, publisher, title)
+            outcomes['log'] = metrics.OK
+
+        except Exception as error:
+            print("Error inserting into logfile", error)
+        checkpoint_stage(result, 'log')  #not retried, a second attempt would log the AU twice
+
+    # Send email notification
+    if 'email' not in completed and digest_mode():
+        queue_digest_entry(result)  #sent at the end of the run, the email stage is checkpointed then
+    elif 'email' not in completed:
+        try:
+            # Get Contact-Email from baginfo_dict
+            contact_email = baginfo_dict.get('Contact-Email', '')
+
+            # Prepare attachment paths
+            attachments = []
+            if status == "Staged":  # Only attach files if processing succeeded
+                baginfo_path = os.path.join(config['DEFAULT']['destination_dir'], fname, 'bag-info.txt')
+                clamav_path = os.path.join(config['DEFAULT']['destination_dir'], fname, 'clamav.txt')
+                droid_path = os.path.join(config['DEFAULT']['destination_dir'], fname, 'droid_report.csv')
+                attachments = [baginfo_path, clamav_path, droid_path]
+                with stage_timer(timings, 'email', io):
+                    send_notification_email(fname, contact_email, success=True, attachments=attachments)
+            else:  # Processing failed
+                with stage_timer(timings, 'email', io):
+                    send_notification_email(fname, contact_email, success=False, error_message=result['error_details'] or status)
+            outcomes['email'] = metrics.OK
+        except Exception as error:
+            print(f"Warning: Email notification failed for {fname}: {error}")
+            outcomes['email'] = metrics.ERROR
+        checkpoint_stage(result, 'email')
+
+    if result['attempt_id'] is not None:
+        try:
+            ledger.update_timings(open_ledger(), result['attempt_id'], timings)
+        except Exception as error:
+            print("Error updating the ledger", error)
+
+    if recording and run_metrics is not None:
+        report_au_metrics(result)
+
+def report_au_metrics(result):
+    #one event per stage the AU went through, then one for the AU
+    #stages without an outcome were timed before stage metrics were recorded (an older checkpoint), they are left out
+    try:
+        for stage, seconds in result['timings'].items():
+            if stage in result['outcomes']:
+                run_metrics.stage(result['fname'], stage, seconds, result['io'].get(stage), result['outcomes'][stage])
+        status = result['status'] or "Error: Processing failed"
+        run_metrics.au(result['fname'], status, result['size'], sum(result['timings'].values()), status == "Staged")
+    except Exception as error:
+        print(f"Warning: Could not record metrics for {result['fname']}", error)
+
+def open_run_metrics():
+    #metrics for one process_tar_files run, None unless [METRICS] names a textfile or an event log
+    textfile = config.get('METRICS', 'textfile', fallback='').strip()
+    event_log = config.get('METRICS', 'event_log', fallback='').strip()
+    if not textfile and not event_log:
+        return None
+    return metrics.RunMetrics(textfile or None, event_log or None)
+
+def finish_checkpoints(results, titledb_committed):
+    #titledb.xml is written once per run, so the titledb stage (and with it the AU) is only finished here
+    for result in results:
+        if titledb_committed or not result['add_to_titledb']:
+            if 'titledb' not in result['completed']:
+                result['completed'].append('titledb')
+        try:
+            if all(stage in result['completed'] for stage in AU_RECORD_STAGES):
+                ledger.clear_checkpoint(open_ledger(), result['fname'])
+            else:
+                ledger.save_checkpoint(open_ledger(), result['fname'], result)
+        except Exception as error:
+            print(f"Error saving the checkpoint for {result['fname']}", error)
+
+def open_ledger():
+    #the processing ledger, opened once per process (each worker opens its own connection)
+    #a new ledger is seeded from the existing log.csv so AUs staged before the upgrade are known
+    global ledger_conn, ledger_pid
+    if ledger_conn is None or ledger_pid != os.getpid():
+        ledger_conn = ledger.connect(ledger.ledger_path(config))
+        ledger_pid = os.getpid()
+        if ledger.is_empty(ledger_conn) and os.path.exists(config['DEFAULT']['logfile']):
+            count = ledger.import_log_csv(ledger_conn, config['DEFAULT']['logfile'])
+            print(f"Ledger seeded with {count} entries from {config['DEFAULT']['logfile']}")
+    return ledger_conn
+
+def plan_au_jobs(tar_files):
+    """
+    Work out what a run does: AUs left part way by an earlier run, resumed from their checkpoints,
+    then new uploads in upload order. An upload of an AU the ledger shows as staged, whose staging
+    folder still exists, is rejected before any work is done on it and left where it is.
+
+    Returns:
+        tuple: (jobs as (file_path, checkpoint state or None), results for the rejected uploads)
+    """
+    checkpoints = ledger.load_checkpoints(open_ledger())
+    resumed, jobs, rejected = [], [], []
+
+    for file_path in tar_files:
+        fname = os.path.splitext(os.path.basename(file_path))[0]
+        state = checkpoints.pop(fname, None)
+        if state is not None and 'extract' in state['completed']:
+            resumed.append((state['source_path'], state))  #the tarball already moved into its AU folder
+            continue
+        if state is not None and (state['size'] != os.path.getsize(file_path) or
+                                  ('scan' in state['completed'] and not os.path.exists(file_path + '-clamav.txt'))):
+            print(f"Warning: {fname} changed since its last checkpoint, starting it again")
+            state = None
+        #the ledger alone isn't enough, it outlives staging (eg reset_after_test.py, or a staging folder removed by hand)
+        if (state is None and ledger.is_staged(open_ledger(), fname)
+                and os.path.isdir(os.path.join(config['DEFAULT']['destination_dir'], fname))):
+            if rejected_before(file_path, fname):
+                print(f"Skipping {file_path}, {fname} has already been staged and this upload was rejected by an earlier run")
+                continue
+            print(f"Error: The AU named {fname} has already been staged, upload left in {os.path.dirname(file_path)}")
+            result = new_au_result(file_path)
+            result['status'] = ALREADY_STAGED
+            rejected.append(result)
+            continue
+        jobs.append((file_path, state))
+
+    #checkpointed AUs whose tarball is no longer in source_dir, ie already staged or rejected
+    for fname, state in checkpoints.items():
+        if state['status'] is not None or 'move' in state['completed'] or os.path.isdir(state['au_dir']):
+            resumed.append((state['source_path'], state))
+        else:
+            print(f"Warning: {fname} was interrupted but its files are gone, dropping its checkpoint")
+            ledger.clear_checkpoint(open_ledger(), fname)
+
+    for _, state in resumed:
+        print(f"Resuming {state['fname']} after {state['completed'][-1]}")
+    return resumed + jobs, rejected
+
+def rejected_before(file_path, fname):
+    #True if the AU's latest attempt already rejected this upload: same path and size, not modified since
+    #the rejection is recorded (ledger, log.csv, email) once, not again on every run while the upload sits in source_dir
+    attempt = ledger.latest_attempt(open_ledger(), fname)
+    if attempt is None or attempt['status'] != ALREADY_STAGED or attempt['source_path'] != file_path or not attempt['started']:
+        return False
+    return (attempt['size'] == os.path.getsize(file_path)
+            and os.path.getmtime(file_path) < datetime.datetime.fromisoformat(attempt['started']).timestamp())
+
+def export_logs():
+    #regenerate log.csv and log.html from the ledger
+    count = ledger.export_log_csv(open_ledger(), config['DEFAULT']['logfile'])
+    csv_to_html(config['DEFAULT']['logfile'], config['DEFAULT']['weblog'])
+    print(f"Exported {count} entries to {config['DEFAULT']['logfile']} and {config['DEFAULT']['weblog']}")
+
+def print_attempts(attempts):
+    for attempt in attempts:
+        print(f"{attempt['finished']}\t{attempt['au_name']}\t{attempt['publisher'] or ''}\t{attempt['size']}\t{attempt['status']}")
+        if attempt['tar_sha256']:
+            print(f"    sha256 {attempt['tar_sha256']}  from {attempt['source_path']}")
+        timings = json.loads(attempt['stage_timings'] or '{}')
+        if timings:
+            print("    " + ", ".join(f"{stage} {seconds}s" for stage, seconds in timings.items()))
+
+################################### MAIN ENTRY #################################################
+### main entry point triggered by __main__ below, handles all processing as branch statements
+### and hands off to functions above
+def process_tar_files(directory, tar_files=None):
+    #tar_files: uploads already known to be complete (watch mode), otherwise source_dir is scanned
+    if tar_files is None:
+        tar_files = settled_uploads(find_tar_files(directory))
+    jobs, rejected = plan_au_jobs(tar_files)
+    workers = int(config.get('DEFAULT', 'workers', fallback='') or 1)
+    droid_batch = config.getboolean('DROID', 'batch', fallback=False)
+
+    global run_metrics
+    pending = []
+    recorded = []  #AUs whose checkpoints are finished once titledb.xml is committed
+    titledb_committed = False
+    run_metrics = open_run_metrics()
+    run_started = datetime.datetime.now()
+    sender = start_outbox_sender() if email_enabled() else None
+    try:
+        for result in rejected:
+            record_au_result(result)
+            recorded.append(result)
+
+        for result in iter_au_results(jobs, workers, droid_batch, profile_dir()):
+            if droid_batch:
+                pending.append(result)  #recorded after the batch DROID run
+            else:
+                record_au_result(result)
+                recorded.append(result)
+
+        if droid_batch:
+            finish_droid_batch(pending)
+            for result in pending:
+                record_au_result(result)
+                recorded.append(result)
+    finally:
+        commit_timings, commit_io = {}, {}
+        titledb_queued = bool(pending_titledb_entries)
+        #the run-wide work, profiled as run-{started} when there is any
+        with profiling.profiled(profile_dir() if titledb_queued or pending_digests else None, f"run-{run_started:%Y%m%d-%H%M%S}", 'titledb and digests'):
+            try: #one titledb write for the whole run, even if the run stopped part way
+                timed(commit_timings, 'titledb_commit', commit_titledb, io=commit_io)
+                titledb_committed = True
+                finish_checkpoints(recorded, titledb_committed)  #saved straight away, a run stopped from here on must not queue them again
+            except Exception as error:
+                print("Error inserting into titledb", error)
+                del pending_titledb_entries[:]  #queued again from their checkpoints by the next run
+            send_digests()
+        finish_checkpoints(recorded, titledb_committed)  #the digests are spooled, delivering them is the outbox's job
+        if sender is not None:
+            stop_outbox_sender(sender)  #waits up to flush_timeout for the last emails, the rest stay spooled
+        if run_metrics is not None:
+            try:
+                if titledb_queued:
+                    run_metrics.stage(None, 'titledb_commit', commit_timings['titledb_commit'], commit_io.get('titledb_commit'),
+                                      metrics.OK if titledb_committed else metrics.ERROR)
+                run_metrics.finish()
+            except Exception as error:
+                print("Warning: Could not write the run metrics", error)
+            run_metrics = None
+
+def watch_uploads(directory):
+    """
+    Long-running alternative to the cron job: process each upload as soon as it is complete
+
+    inotify (or polling where it isn't available) reports tarballs as they change; once one's
+    size and mtime have held for settle_seconds it is processed straight away with everything
+    process_tar_files does. Config, the ledger and imports stay loaded between AUs. SIGTERM
+    stops the loop once the AUs in hand are finished.
+    """
+    global stop_requested
+    settle_seconds = float(config.get('DEFAULT', 'settle_seconds', fallback='') or 60)
+    poll_interval = float(config.get('DEFAULT', 'watch_poll_interval', fallback='') or 10)
+    use_inotify = config.get('DEFAULT', 'watch_backend', fallback='').strip().lower() != 'poll'
+
+    signal.signal(signal.SIGTERM, request_stop)
+    watcher = upload_watcher.open_watcher(directory, poll_interval, use_inotify)
+    tracker = upload_watcher.SettleTracker(settle_seconds)
+    print(f"Watching {directory} ({watcher.name}), uploads are processed once unchanged for {settle_seconds:g}s")
+
+    process_tar_files(directory, [])  #resume anything an earlier run left part way
+    changed = None  #None rescans source_dir, at startup and whenever the watcher can't say what changed
+    try:
+        while not stop_requested:
+            tracker.observe(find_tar_files(directory) if changed is None else changed)
+            ready = tracker.ready()
+            if ready:
+                process_tar_files(directory, ready)
+            due = tracker.next_due()
+            changed = watcher.wait(poll_interval if due is None else min(due, poll_interval))
+    finally:
+        watcher.close()
+    print("Watch mode stopped")
+
+def request_stop(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+def iter_au_results(jobs, workers, defer_droid, profile_to=None):
+    #run process_au over every job, yielding results in upload order, the same order a sequential run would use
+    if workers <= 1 or len(jobs) <= 1:
+        for file_path, state in jobs:
+            try:
+                result = process_au(file_path, defer_droid, state, profile_to)
+            except Exception as error:
+                report_failed_au(error)
+                raise  #as before, a stage that raises stops a sequential run
+            yield result
+        return
+
+    #parallel mode, each AU's pipeline runs in a worker process and results come back here to be recorded
+    #workers come from a fork server, so they aren't forked from a process running the outbox sender thread
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+        futures = [(file_path, pool.submit(process_au, file_path, defer_droid, state, profile_to)) for file_path, state in jobs]
+        for file_path, future in futures:
+            try:
+                result = future.result()
+            except Exception as error:
+                print(f"Error: Processing failed for {file_path}", error)
+                report_failed_au(error)
+                continue
+            yield result
+
+def report_failed_au(error):
+    #metrics for an AU whose pipeline raised: the stages it got through, the one that raised (ERROR), and the AU
+    #it isn't recorded otherwise, its checkpoint has the next run retry the stage
+    result = getattr(error, 'au_result', None)
+    if result is not None and run_metrics is not None:
+        report_au_metrics(result)
 
 if __name__ == "__main__":
-    #do the main processing process_tar_files
-    process_tar_files(config['DEFAULT']['source_dir'])
+    parser = argparse.ArgumentParser(description="Examine uploaded tar files, make a manifest, add them to titledb and move them into production")
+    parser.add_argument('--list-titledb-backups', action='store_true', help="list the stored titledb.xml versions and exit")
+    parser.add_argument('--restore-titledb', metavar='VERSION', help="restore titledb.xml from a backup: latest, an exact timestamp or a sha256 (7+ character prefixes work) and exit")
+    parser.add_argument('--watch', action='store_true', help="keep running and process each upload as soon as it finishes arriving")
+    parser.add_argument('--send-outbox', action='store_true', help="deliver the queued notification emails that are due and exit")
+    parser.add_argument('--export-logs', action='store_true', help="regenerate log.csv and log.html from the ledger and exit")
+    parser.add_argument('--history', metavar='AU', help="print every ledger entry for an AU and exit")
+    parser.add_argument('--failures', metavar='PUBLISHER', nargs='?', const='', help="print every failed attempt, optionally for one Source-Organization, and exit")
+    parser.add_argument('--profile', metavar='DIR', help="profile each AU with cProfile and tracemalloc, writing .prof files and memory reports to DIR")
+    args = parser.parse_args()
+    profile_override = args.profile
 
+    if args.list_titledb_backups:
+        list_titledb_backups()
+    elif args.restore_titledb:
+        try:
+            restore_titledb(args.restore_titledb)
+        except (ValueError, OSError, EOFError) as error:
+            print(f"Error: {error}")
+            sys.exit(1)
+    elif args.watch:
+        watch_uploads(config['DEFAULT']['source_dir'])
+    elif args.send_outbox:
+        try:
+            sent, retrying, failed = deliver_outbox()
+        finally:
+            close_smtp_connection()
+        print(f"Outbox: {sent} delivered, {retrying} to retry, {failed} failed")
+    elif args.export_logs:
+        export_logs()
+    elif args.history:
+        attempts = ledger.history(open_ledger(), args.history)
+        print_attempts(attempts)
+        print(f"{len(attempts)} attempt(s) for {args.history}")
+    elif args.failures is not None:
+        attempts = ledger.failures(open_ledger(), args.failures or None)
+        print_attempts(attempts)
+        print(f"{len(attempts)} failed attempt(s)")
+    else:
+        #do the main processing process_tar_files
+        process_tar_files(config['DEFAULT']['source_dir'])
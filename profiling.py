@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Opt-in profiling for preprocess.py runs (--profile DIR or [DEFAULT] profile_dir).
+
+Each AU's processing is run under cProfile and tracemalloc. An AU is handled in two places:
+its own pipeline (scan, extract, DROID, staging move), possibly in a worker process, and its
+record stages (titledb, logs, email) in the main process. Both sections go into the same files
+in the profile directory, named after the AU and the time its attempt started:
+
+    {au}-{started}.prof          cProfile stats for every section, merged; open with pstats or snakeviz
+    {au}-{started}-memory.txt    per section: peak traced memory and the top allocation sites
+
+The run-wide titledb.xml commit and digest emails are profiled the same way as run-{started}.
+"""
+
+import contextlib
+import cProfile
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Optional
+
+TRACEMALLOC_FRAMES = 10  # frames kept per allocation, enough to see who called into tarfile/ElementTree
+TOP_ALLOCATIONS = 25     # allocation sites listed per section
+
+# allocation sites left out of the report: tracemalloc's own and the import system's bookkeeping
+IGNORED_FILES = {tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>', '<unknown>'}
+
+# =============================================================================
+# Profiling
+# =============================================================================
+
+def profile_paths(profile_dir: str, name: str) -> tuple[str, str]:
+    """(cProfile stats path, memory report path) for a profile name."""
+    base = os.path.join(profile_dir, name)
+    return base + '.prof', base + '-memory.txt'
+
+
+@contextlib.contextmanager
+def profiled(profile_dir: Optional[str], name: str, section: str):
+    """
+    Profile the block as one section of name's profile. Does nothing if profile_dir is None.
+
+    Stats are merged into an existing name.prof, so sections run in different processes (or a
+    run resumed later) add up to one profile; the memory report gets a section appended.
+    """
+    if not profile_dir:
+        yield
+        return
+
+    os.makedirs(profile_dir, exist_ok=True)
+    #traced for this section only, so the snapshot holds just what the section allocated and kept
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    start = time.monotonic()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        seconds = time.monotonic() - start
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        try:
+            write_profile(profile_dir, name, section, profiler, seconds, snapshot, current, peak)
+        except Exception as error:  #a profile that can't be written mustn't fail the AU
+            print(f"Warning: Could not write the {section} profile for {name}", error)
+
+
+def write_profile(profile_dir: str, name: str, section: str, profiler: cProfile.Profile, seconds: float,
+                  snapshot: tracemalloc.Snapshot, current: int, peak: int) -> None:
+    prof_path, memory_path = profile_paths(profile_dir, name)
+    stats = pstats.Stats(profiler)
+    if os.path.exists(prof_path):
+        stats.add(prof_path)
+    stats.dump_stats(prof_path + '.tmp')
+    os.replace(prof_path + '.tmp', prof_path)
+
+    lines = [f"== {section} (pid {os.getpid()}, {time.strftime('%Y-%m-%d %H:%M:%S')}) ==",
+             f"wall time: {seconds:.3f}s",
+             f"peak traced memory: {format_size(peak)}, still allocated at the end: {format_size(current)}",
+             f"top {TOP_ALLOCATIONS} sites of memory allocated in the section and still held at its end:"]
+    kept = [stat for stat in snapshot.statistics('traceback') if stat.traceback[-1].filename not in IGNORED_FILES]
+    for stat in kept[:TOP_ALLOCATIONS]:
+        frames = list(stat.traceback)[::-1]  #tracemalloc lists the oldest frame first
+        lines.append(f"  {format_size(stat.size):>10} in {stat.count} block(s)  {frames[0].filename}:{frames[0].lineno}")
+        for caller in frames[1:4]:
+            lines.append(f"  {'':>10}   called from {caller.filename}:{caller.lineno}")
+    with open(memory_path, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n\n')
+
+
+def format_size(nbytes: float) -> str:
+    for unit in ['B', 'KiB', 'MiB']:
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} GiB"
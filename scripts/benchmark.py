@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - End-to-end throughput benchmark for preprocess.py
+
+Generates synthetic BagIt tarballs for a set of size/file-count profiles, runs the full
+pipeline (preprocess.py, as cron would) against a throwaway config in a temporary directory
+with stand-in clamscan and DROID executables, and reports per-stage wall time, bytes per
+second and peak RSS. Needs nothing beyond Python and a POSIX shell, so it runs offline.
+
+The stand-in clamscan reads the whole tarball (the I/O a real scan does, without the
+signature matching) and the stand-in DROID walks the AU folder and writes a report with
+DROID's columns, so the scan and droid figures measure preprocess.py's own overhead rather
+than ClamAV or the JVM.
+
+Usage:
+    python3 benchmark.py                          # every profile
+    python3 benchmark.py --profile many-tiny --bags 4 --workers 4
+    python3 benchmark.py --scale 4 --json results.json
+"""
+
+import os
+import sys
+import io
+import json
+import random
+import shutil
+import hashlib
+import argparse
+import tarfile
+import tempfile
+import textwrap
+import subprocess
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ledger
+
+PREPROCESS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess.py')
+MIB = 1024 * 1024
+BLOCK_SIZE = MIB  # synthetic payload is drawn from one random block, generating it isn't what we measure
+
+# name -> (files per bag, bytes per file) at --scale 1
+PROFILES = {
+    'few-huge': (2, 128 * MIB),
+    'many-tiny': (5000, 1024),
+    'mixed': (200, 256 * 1024),
+}
+
+STAGES = ['size_check', 'scan', 'extract', 'droid', 'move', 'titledb', 'log', 'email']
+
+CLAMSCAN_STUB = """\
+#!/bin/sh
+cat "$1" > /dev/null
+echo "$1: OK"
+echo
+echo "----------- SCAN SUMMARY -----------"
+echo "Infected files: 0"
+"""
+
+DROID_STUB = """\
+#!/usr/bin/env python3
+import csv, os, sys
+args = sys.argv[1:]
+output = args[args.index('-o') + 1]
+roots = []
+for arg in args[args.index('-A') + 1:]:
+    if arg.startswith('-'):
+        break
+    roots.append(arg)
+columns = ["ID", "PARENT_ID", "URI", "FILE_PATH", "NAME", "METHOD", "STATUS", "SIZE", "TYPE", "EXT",
+           "LAST_MODIFIED", "EXTENSION_MISMATCH", "HASH", "FORMAT_COUNT", "PUID", "MIME_TYPE",
+           "FORMAT_NAME", "FORMAT_VERSION"]
+with open(output, 'w', newline='') as f:
+    writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+    writer.writerow(columns)
+    row_id = 0
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if path == output:
+                    continue
+                row_id += 1
+                writer.writerow([row_id, "", "file:" + path, path, name, "Signature", "Done",
+                                 os.path.getsize(path), "File", name.rsplit('.', 1)[-1], "", "false", "",
+                                 1, "x-fmt/111", "text/plain", "Plain Text File", ""])
+"""
+
+TITLEDB = """\
+<lockss-config>
+	<property name="org.lockss.titleSet">
+		<property name="MDPN">
+			<property name="name" value="All MDPN AUs" />
+		</property>
+	</property>
+	<property name="org.lockss.title">
+	</property>
+</lockss-config>
+"""
+
+class SyntheticPayload:
+    """File-like payload of a given size, hashed as tarfile reads it"""
+    def __init__(self, block, size, seed):
+        self.block = block
+        self.remaining = size
+        self.offset = seed % len(block)  # files start at different points in the block so they differ
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        out = bytearray()
+        while len(out) < size:
+            take = min(size - len(out), len(self.block) - self.offset)
+            out += self.block[self.offset:self.offset + take]
+            self.offset = (self.offset + take) % len(self.block)
+        self.remaining -= size
+        data = bytes(out)
+        self.sha256.update(data)
+        return data
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+def make_bag(path, bag_name, file_count, file_size, block):
+    """
+    Write a BagIt tarball with file_count payload files of file_size bytes each
+
+    Payload is streamed into the tar, the manifest is built from the digests on the way.
+
+    Returns:
+        int: size of the tarball in bytes
+    """
+    manifest = []
+    with tarfile.open(path, 'w') as tar:
+        folder = tarfile.TarInfo(bag_name)
+        folder.type = tarfile.DIRTYPE
+        folder.mode = 0o755
+        tar.addfile(folder)
+        for i in range(file_count):
+            relative = f"data/{i // 1000:03d}/file{i:06d}.txt"
+            payload = SyntheticPayload(block, file_size, i * 7919)
+            info = tarfile.TarInfo(f"{bag_name}/{relative}")
+            info.size = file_size
+            info.mtime = int(time.time())
+            tar.addfile(info, payload)
+            manifest.append(f"{payload.sha256.hexdigest()}  {relative}\n")
+
+        #bag-info field order matters, preprocess.py takes the title from line 11
+        baginfo = [
+            "Source-Organization: Benchmark University",
+            "Organization-Address: 1 Benchmark Road",
+            "Contact-Name: Benchmark",
+            "Contact-Phone: 555-0100",
+            "Contact-Email: benchmark@example.com",
+            f"Bagging-Date: {time.strftime('%Y-%m-%d')}",
+            f"Bag-Size: {file_count * file_size} B",
+            f"Payload-Oxum: {file_count * file_size}.{file_count}",
+            "Bag-Group-Identifier: benchmark",
+            f"Internal-Sender-Identifier: {bag_name}",
+            f"External-Identifier: Benchmark {bag_name}",
+        ]
+        add_member(tar, f"{bag_name}/bag-info.txt", ('\n'.join(baginfo) + '\n').encode())
+        add_member(tar, f"{bag_name}/bagit.txt", b"BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n")
+        add_member(tar, f"{bag_name}/manifest-sha256.txt", ''.join(manifest).encode())
+    return os.path.getsize(path)
+
+def write_executable(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+def build_environment(workdir, workers):
+    """
+    Lay out a throwaway preprocess environment in workdir: uploads, staging, logs,
+    titledb.xml, the stand-in tools and a config.ini pointing at all of it
+
+    Returns:
+        dict: paths, keyed on what they are
+    """
+    paths = {name: os.path.join(workdir, name) for name in ('uploads', 'staging', 'log', 'bin')}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    write_executable(os.path.join(paths['bin'], 'clamscan'), CLAMSCAN_STUB)
+    write_executable(os.path.join(paths['bin'], 'droid'), DROID_STUB)
+    open(os.path.join(workdir, 'droid.jar'), 'w').close()
+    paths['titledb'] = os.path.join(workdir, 'titledb.xml')
+    with open(paths['titledb'], 'w') as f:
+        f.write(TITLEDB)
+    paths['ledger'] = os.path.join(workdir, 'ledger.sqlite')
+    paths['config'] = os.path.join(workdir, 'config.ini')
+    with open(paths['config'], 'w') as f:
+        f.write(textwrap.dedent(f"""\
+            [DEFAULT]
+            source_dir = {paths['uploads']}
+            destination_dir = {paths['staging']}
+            titledb = {paths['titledb']}
+            staging_url = http://127.0.0.1/staging/
+            logfile = {paths['log']}/log.csv
+            weblog = {paths['log']}/log.html
+            ledger = {paths['ledger']}
+            max_au_size = {1 << 62}
+            settle_seconds = 0
+            workers = {workers}
+
+            [TITLEDB]
+            backup_dir = {workdir}/titledb_backups
+
+            [DROID]
+            java_path = {paths['bin']}/droid
+            droid_path = {workdir}/droid.jar
+            droid_log = {paths['log']}/droid_log.csv
+
+            [EMAIL]
+            enabled = false
+            """))
+    return paths
+
+def run_preprocess(paths, log_path):
+    """
+    Run preprocess.py once against the benchmark config
+
+    Returns:
+        tuple: (exit status, wall seconds, peak RSS in bytes of preprocess.py and everything it ran)
+    """
+    env = dict(os.environ, PREPROCESS_CONFIG=paths['config'], PATH=paths['bin'] + os.pathsep + os.environ.get('PATH', ''))
+    start = time.monotonic()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, PREPROCESS], stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, time.monotonic() - start, usage.ru_maxrss * 1024  # ru_maxrss is KiB on Linux
+
+def stage_totals(ledger_file):
+    """
+    Sum the per-stage timings preprocess.py recorded in the ledger
+
+    Returns:
+        tuple: ({stage: seconds}, number of AUs staged, number of attempts)
+    """
+    totals = {}
+    staged = attempts = 0
+    conn = ledger.connect_readonly(ledger_file)
+    if conn is None:
+        return totals, staged, attempts
+    try:
+        for row in conn.execute('SELECT status, stage_timings FROM au_attempts'):
+            attempts += 1
+            staged += row['status'] == ledger.STAGED
+            for stage, seconds in json.loads(row['stage_timings'] or '{}').items():
+                totals[stage] = totals.get(stage, 0) + seconds
+    finally:
+        conn.close()
+    return totals, staged, attempts
+
+def format_rate(nbytes, seconds):
+    return f"{nbytes / seconds / MIB:9.1f} MiB/s" if seconds > 0 else "        - MiB/s"
+
+def run_profile(name, bags, scale, workers, workdir):
+    """Generate one profile's bags, process them, return its results"""
+    file_count, file_size = PROFILES[name]
+    if name == 'many-tiny':
+        file_count = max(1, int(file_count * scale))
+    else:
+        file_size = max(1, int(file_size * scale))
+
+    paths = build_environment(workdir, workers)
+    block = random.Random(name).randbytes(BLOCK_SIZE)
+    generate_start = time.monotonic()
+    total_bytes = 0
+    for i in range(bags):
+        bag_name = f"bench-{name}-{i:03d}"
+        total_bytes += make_bag(os.path.join(paths['uploads'], bag_name + '.tar'), bag_name, file_count, file_size, block)
+    generate_seconds = time.monotonic() - generate_start
+
+    log_path = os.path.join(workdir, 'preprocess.log')
+    status, wall, peak_rss = run_preprocess(paths, log_path)
+    stages, staged, attempts = stage_totals(paths['ledger'])
+    return {
+        'profile': name,
+        'bags': bags,
+        'files_per_bag': file_count,
+        'bytes_per_file': file_size,
+        'total_bytes': total_bytes,
+        'workers': workers,
+        'generate_seconds': round(generate_seconds, 3),
+        'exit_status': status,
+        'staged': staged,
+        'attempts': attempts,
+        'wall_seconds': round(wall, 3),
+        'bytes_per_second': round(total_bytes / wall) if wall > 0 else None,
+        'peak_rss_bytes': peak_rss,
+        'stage_seconds': {stage: round(seconds, 3) for stage, seconds in stages.items()},
+        'log': log_path,
+    }
+
+def ok(result):
+    return result['exit_status'] == 0 and result['staged'] == result['bags']
+
+def print_result(result):
+    print(f"\n{result['profile']}: {result['bags']} bag(s) x {result['files_per_bag']} file(s) x "
+          f"{result['bytes_per_file']} B = {result['total_bytes'] / MIB:.1f} MiB, workers={result['workers']}")
+    if not ok(result):
+        print(f"  WARNING: exit status {result['exit_status']}, {result['staged']} of {result['bags']} AU(s) staged, "
+              f"see {result['log']}")
+    print(f"  {'total':<12}{result['wall_seconds']:9.3f} s  {format_rate(result['total_bytes'], result['wall_seconds'])}")
+    stages = result['stage_seconds']
+    for stage in STAGES + sorted(set(stages) - set(STAGES)):
+        if stage in stages:
+            print(f"  {stage:<12}{stages[stage]:9.3f} s  {format_rate(result['total_bytes'], stages[stage])}")
+    print(f"  {'peak RSS':<12}{result['peak_rss_bytes'] / MIB:9.1f} MiB")
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark for preprocess.py")
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                        help="profile to run, repeat for several (default: all)")
+    parser.add_argument('--bags', type=int, default=2, help="bags per profile (default: 2)")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply the file size (file count for many-tiny) of each profile (default: 1)")
+    parser.add_argument('--workers', type=int, default=1, help="[DEFAULT] workers for the run (default: 1)")
+    parser.add_argument('--workdir', help="where to build the environment (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="keep the generated bags, staging and logs")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    base = args.workdir or tempfile.mkdtemp(prefix='preprocess-benchmark-')
+    results = []
+    try:
+        for name in args.profile or list(PROFILES):
+            workdir = os.path.join(base, name)
+            shutil.rmtree(workdir, ignore_errors=True)
+            print(f"Generating and processing {name}...")
+            result = run_profile(name, args.bags, args.scale, args.workers, workdir)
+            results.append(result)
+            print_result(result)
+            if ok(result) and not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        if args.keep or not all(ok(r) for r in results):
+            print(f"\nBenchmark files kept in {base}")
+        elif not args.workdir:
+            shutil.rmtree(base, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    sys.exit(0 if all(ok(r) for r in results) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+query_droid_log.py - Query and export the central DROID log store
+
+Answers format questions from the indexed SQLite store preprocess.py writes when
+[DROID] droid_db is set, and exports it back to the flat droid_log CSV shape.
+
+Usage:
+    python3 query_droid_log.py puid fmt/276
+    python3 query_droid_log.py au example-au-2024
+    python3 query_droid_log.py org "Example University"
+    python3 query_droid_log.py export droid_log.csv [--puid fmt/276] [--au NAME] [--org NAME]
+    python3 query_droid_log.py import /var/www/html/mdpn/log/droid_log.csv
+"""
+
+import os
+import sys
+import argparse
+import configparser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import droid_store
+
+def load_config():
+    """Load configuration from config.ini"""
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.ini')
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return config
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Query and export the central DROID log store")
+    parser.add_argument('--db', help="path to the store (default: [DROID] droid_db in config.ini)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    puid = commands.add_parser('puid', help="AUs containing a PRONOM format")
+    puid.add_argument('puid')
+    au = commands.add_parser('au', help="formats found in an AU")
+    au.add_argument('package_name')
+    org = commands.add_parser('org', help="AUs from a Source-Organization")
+    org.add_argument('organization')
+    export = commands.add_parser('export', help="write the store in the flat droid_log CSV shape")
+    export.add_argument('output')
+    export.add_argument('--puid')
+    export.add_argument('--au', dest='package_name')
+    export.add_argument('--org', dest='organization')
+    load = commands.add_parser('import', help="load an existing flat droid_log CSV into the store")
+    load.add_argument('csv_path')
+    args = parser.parse_args()
+
+    db_path = args.db or load_config().get('DROID', 'droid_db', fallback='').strip()
+    if not db_path:
+        print("Error: no store configured, set droid_db in the [DROID] section of config.ini or pass --db")
+        sys.exit(1)
+    conn = droid_store.connect(db_path)
+
+    if args.command == 'puid':
+        rows = droid_store.aus_with_puid(conn, args.puid)
+        for package_name, organization, count in rows:
+            print(f"{package_name}\t{organization}\t{count} file(s)")
+        print(f"{len(rows)} AU(s) contain {args.puid}")
+    elif args.command == 'au':
+        rows = droid_store.formats_in_au(conn, args.package_name)
+        for puid_value, format_name, count in rows:
+            print(f"{puid_value or '(unidentified)'}\t{format_name or ''}\t{count} file(s)")
+        if not rows:
+            print(f"No DROID rows for {args.package_name}")
+    elif args.command == 'org':
+        rows = droid_store.aus_for_organization(conn, args.organization)
+        for package_name, count, date in rows:
+            print(f"{package_name}\t{count} file(s)\t{date}")
+        print(f"{len(rows)} AU(s) from {args.organization}")
+    elif args.command == 'export':
+        filters = [(column, value) for column, value in
+                   (('PUID', args.puid), ('Package_Name', args.package_name), ('Source_Organization', args.organization))
+                   if value]
+        where = ('WHERE ' + ' AND '.join(f'"{column}" = ?' for column, _ in filters)) if filters else ''
+        count = droid_store.export_csv(conn, args.output, where, tuple(value for _, value in filters))
+        print(f"Exported {count} row(s) to {args.output}")
+    elif args.command == 'import':
+        count = droid_store.import_csv(conn, args.csv_path)
+        print(f"Imported {count} row(s) from {args.csv_path}")
+
+    conn.close()
+
+if __name__ == "__main__":
+    main()
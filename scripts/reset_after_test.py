@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 """Reset staging and uploads by deleting their contents and copying test_files -> staging.
 
+The processing ledger (its AU attempts and checkpoints) is deleted too, so re-uploaded test
+bags aren't taken for AUs that are already staged or part way through, and so is log.csv,
+its export, which would otherwise seed the new ledger with the same attempts.
+
 This script performs destructive actions immediately (no interactive confirmation).
 Use with care.
 """
+import configparser
 import os
 import shutil
 import sys
@@ -32,6 +37,18 @@ def rm_contents(path):
             err(f"Failed to remove {full}: {e}")
 
 
+def ledger_files(repo_root):
+    # [DEFAULT] ledger from config.ini (or ledger.sqlite next to preprocess.py), its write-ahead log, and logfile
+    config = configparser.ConfigParser()
+    config.read(os.path.join(repo_root, 'config.ini'))
+    ledger = config.get('DEFAULT', 'ledger', fallback='').strip() or os.path.join(repo_root, 'ledger.sqlite')
+    paths = [ledger, ledger + '-wal', ledger + '-shm']
+    logfile = config.get('DEFAULT', 'logfile', fallback='').strip()
+    if logfile:
+        paths.append(logfile)
+    return paths
+
+
 def main():
     # Run relative to the user's ~/preprocess directory (explicit override)
     repo_root = os.path.expanduser('~/preprocess')
@@ -53,6 +70,16 @@ def main():
     info(f"Removing contents of {uploads}")
     rm_contents(uploads)
 
+    # The ledger holds every attempt and checkpoint; log.csv is its export and would seed it again
+    for path in ledger_files(repo_root):
+        info(f"Removing {path}")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            err(f"Failed to remove {path}: {e}")
+
     # Copy test files into uploads (used as the source upload directory)
     info(f"Copying contents of {test_files} -> {uploads}")
     try:
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+test_add_aus_to_nodes.py - Tests for add_aus_to_nodes.py's per-node diff and submission record
+
+A stub LOCKSS node, an http.server on localhost, serves titledb.xml, an AU listing (as a list of
+AU objects, or in a shape add_aus_to_nodes.py doesn't recognise) and /ws/aus/add, answering with
+a per-AU result and rejecting the AUs it's told to. add_aus_to_nodes.py runs against a throwaway
+config in a temporary directory. It needs its own dependencies (requests and lockss-pybasic) and
+is skipped without them.
+
+Usage:
+    python3 test_add_aus_to_nodes.py
+    python3 -m pytest scripts/test_add_aus_to_nodes.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import textwrap
+import threading
+import subprocess
+import importlib.util
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ADD_AUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'add_aus_to_nodes.py')
+AU_NAMES = ['example-au-2024', 'example-au-2025', 'example-au-2026']
+
+
+def titledb_xml(base_url):
+    aus = ''
+    for name in AU_NAMES:
+        aus += textwrap.dedent(f"""\
+            <property name="{name}">
+                <property name="attributes.publisher" value="Example University" />
+                <property name="journalTitle" value="Example" />
+                <property name="title" value="{name}" />
+                <property name="type" value="journal" />
+                <property name="plugin" value="edu.auburn.adpn.directory.AuburnDirectoryPlugin" />
+                <property name="param.1"><property name="key" value="base_url" /><property name="value" value="{base_url}" /></property>
+                <property name="param.2"><property name="key" value="directory" /><property name="value" value="{name}" /></property>
+                <property name="param.99"><property name="key" value="pub_down" /><property name="value" value="false" /></property>
+            </property>
+            """)
+    return (f'<lockss-config><property name="org.lockss.titleSet" />'
+            f'<property name="org.lockss.title">{aus}</property></lockss-config>').encode()
+
+
+class NodeStubHandler(BaseHTTPRequestHandler):
+    #state lives on the server: held AUIDs, the listing shape, AUs to reject and every add request
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        node = self.server
+        if self.path == '/titledb.xml':
+            self.reply(titledb_xml(f"http://127.0.0.1:{node.server_address[1]}/staging/"), 'text/xml')
+        elif self.path == '/ws/aus' and node.listing == 'aus':
+            self.reply(json.dumps([{'auId': auid, 'name': auid.rsplit('~', 1)[-1]} for auid in sorted(node.held)]).encode())
+        elif self.path == '/ws/aus' and node.listing == 'unrecognised':
+            self.reply(json.dumps({'count': len(node.held)}).encode())
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_POST(self):
+        node = self.server
+        if self.path != '/ws/aus/add':
+            self.send_response(404)
+            self.end_headers()
+            return
+        auids = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        node.posts.append(auids)
+        results = []
+        for auid in auids:
+            if auid.rsplit('~', 1)[-1] in node.reject:
+                results.append({'id': auid, 'isSuccess': False, 'message': 'Plugin not loaded'})
+            else:
+                node.held.add(auid)
+                results.append({'id': auid, 'isSuccess': True, 'message': 'Added'})
+        self.reply(json.dumps(results).encode())
+
+    def reply(self, body, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@unittest.skipUnless(importlib.util.find_spec('requests') and importlib.util.find_spec('lockss'),
+                     "needs add_aus_to_nodes.py's dependencies, requests and lockss-pybasic")
+class SubmitMissingAuidsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='add-aus-')
+        self.node = ThreadingHTTPServer(('127.0.0.1', 0), NodeStubHandler)
+        self.node.held, self.node.posts, self.node.reject = set(), [], set()
+        self.node.listing = 'aus'
+        threading.Thread(target=self.node.serve_forever, daemon=True).start()
+        self.server_url = f"http://127.0.0.1:{self.node.server_address[1]}"
+        self.record = os.path.join(self.workdir, 'submitted_auids.json')
+
+    def tearDown(self):
+        self.node.shutdown()
+        self.node.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def add_aus(self, *args):
+        config = os.path.join(self.workdir, 'config.ini')
+        with open(config, 'w') as f:
+            f.write(textwrap.dedent(f"""\
+                [DEFAULT]
+                titledb_url = {self.server_url}/titledb.xml
+                ledger = {os.path.join(self.workdir, 'ledger.sqlite')}
+
+                [LOCKSS]
+                servers = {self.server_url}
+                username = lockss
+                password = secret
+                au_list_path = /ws/aus
+                submission_record = {self.record}
+                """))
+        result = subprocess.run([sys.executable, ADD_AUS, *args], env=dict(os.environ, PREPROCESS_CONFIG=config),
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def recorded(self):
+        with open(self.record) as f:
+            return {auid.rsplit('~', 1)[-1] for auid in json.load(f).get(self.server_url, {})}
+
+    def test_recognised_listing_every_au_accepted(self):
+        output = self.add_aus()
+        self.assertIn('0 of 3 AUIDs already held', output)
+        self.assertEqual(len(self.node.posts), 1)
+        self.assertEqual(len(self.node.posts[0]), 3)
+        self.assertEqual(self.recorded(), set(AU_NAMES))
+
+        output = self.add_aus()  #the node now lists all three, nothing to submit
+        self.assertIn(f'3 of 3 AUIDs already held (per {self.server_url}/ws/aus)', output)
+        self.assertEqual(len(self.node.posts), 1)
+
+    def test_unrecognised_listing_falls_back_to_submission_record(self):
+        self.node.listing = 'unrecognised'
+        output = self.add_aus()
+        self.assertIn("isn't in a recognised format, using the submission record", output)
+        self.assertIn('0 of 3 AUIDs already held (per submission record)', output)
+        self.assertEqual(self.recorded(), set(AU_NAMES))
+
+        self.node.held.clear()  #the listing can't show it, the record is what counts
+        output = self.add_aus()
+        self.assertIn('3 of 3 AUIDs already held (per submission record)', output)
+        self.assertEqual(len(self.node.posts), 1)
+
+    def test_partial_acceptance_records_only_accepted_auids(self):
+        self.node.listing = 'unrecognised'  #so the next run's diff comes from the record alone
+        self.node.reject = {'example-au-2025'}
+        output = self.add_aus()
+        self.assertIn('1 of 3 AUIDs were not accepted', output)
+        self.assertEqual(self.recorded(), {'example-au-2024', 'example-au-2026'})
+
+        self.node.reject = set()
+        self.add_aus()  #only the rejected AU is submitted again
+        self.assertEqual([auid.rsplit('~', 1)[-1] for auid in self.node.posts[1]], ['example-au-2025'])
+        self.assertEqual(self.recorded(), set(AU_NAMES))
+
+    def test_dry_run_submits_nothing(self):
+        output = self.add_aus('--dry-run')
+        self.assertIn('0 of 3 AUIDs already held', output)
+        self.assertEqual(output.count('  + '), 3)
+        self.assertEqual(self.node.posts, [])
+        self.assertFalse(os.path.exists(self.record))
+
+
+if __name__ == '__main__':
+    unittest.main()
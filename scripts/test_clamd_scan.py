@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+test_clamd_scan.py - Tests for preprocess.py's clamd scanner backend ([CLAMAV] backend = clamd)
+
+A stub clamd listens on a UNIX socket in a temporary directory and speaks enough of the clamd
+protocol (zVERSION, zSCAN and zINSTREAM) to answer OK, FOUND (for files containing EICAR) or an
+ERROR reply (for files containing TOOBIG, like clamd's size limit). A stub clamscan on PATH stands
+in for the fallback. preprocess.py runs against a throwaway config, nothing else is needed.
+
+Usage:
+    python3 test_clamd_scan.py
+    python3 -m pytest scripts/test_clamd_scan.py
+"""
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import textwrap
+import threading
+import subprocess
+import socketserver
+import unittest
+
+PREPROCESS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess.py')
+
+STUB_CLAMSCAN = """\
+#!/bin/sh
+echo "$1: OK"
+echo
+echo "----------- SCAN SUMMARY -----------"
+echo "Scanner: clamscan stub"
+"""
+
+
+class ClamdStubHandler(socketserver.BaseRequestHandler):
+    #one null terminated command per connection, as preprocess.py sends them
+
+    def handle(self):
+        buffer = b''
+        while b'\0' not in buffer:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            buffer += data
+        command, buffer = buffer.split(b'\0', 1)
+        command = command.decode()
+        self.server.commands.append(command.split(' ', 1)[0])
+
+        if command == 'zVERSION':
+            self.reply('ClamAV 1.0.0-stub/27000')
+        elif command == 'zINSTREAM':
+            data = b''
+            while True:
+                buffer = self.read_exactly(buffer, 4)
+                length = struct.unpack('!L', buffer[:4])[0]
+                buffer = self.read_exactly(buffer[4:], length)
+                if length == 0:
+                    break
+                data += buffer[:length]
+                buffer = buffer[length:]
+            self.reply('stream: ' + self.verdict(data))
+        elif command.startswith('zSCAN '):
+            path = command[len('zSCAN '):]
+            with open(path, 'rb') as f:
+                self.reply(f'{path}: ' + self.verdict(f.read()))
+        else:
+            self.reply('UNKNOWN COMMAND')
+
+    def read_exactly(self, buffer, size):
+        while len(buffer) < size:
+            data = self.request.recv(65536)
+            if not data:
+                raise ConnectionError("client closed the stream early")
+            buffer += data
+        return buffer
+
+    def verdict(self, data):
+        if b'TOOBIG' in data:
+            return 'INSTREAM size limit exceeded. ERROR'
+        if b'EICAR' in data:
+            return 'Eicar-Test-Signature FOUND'
+        return 'OK'
+
+    def reply(self, text):
+        self.request.sendall(text.encode() + b'\0')
+
+
+class ClamdScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='clamd-scan-')
+        self.socket_path = os.path.join(self.workdir, 'clamd.sock')
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, ClamdStubHandler)
+        self.server.commands = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+        self.bin_dir = os.path.join(self.workdir, 'bin')
+        os.makedirs(self.bin_dir)
+        clamscan = os.path.join(self.bin_dir, 'clamscan')
+        with open(clamscan, 'w') as f:
+            f.write(STUB_CLAMSCAN)
+        os.chmod(clamscan, 0o755)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write_config(self, clamd_command='SCAN', clamd_socket=None):
+        config = os.path.join(self.workdir, 'config.ini')
+        with open(config, 'w') as f:
+            f.write(textwrap.dedent(f"""\
+                [DEFAULT]
+                logfile = {os.path.join(self.workdir, 'log.csv')}
+
+                [CLAMAV]
+                backend = clamd
+                clamd_socket = {clamd_socket or self.socket_path}
+                clamd_command = {clamd_command}
+                clamd_timeout = 10
+                """))
+        return config
+
+    def scan(self, content, **config):
+        #run preprocess.run_clamav_scan on a file with this content, returns (clean, report, stdout)
+        file_path = os.path.join(self.workdir, 'example-au.tar')
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        env = dict(os.environ, PREPROCESS_CONFIG=self.write_config(**config),
+                   PATH=self.bin_dir + os.pathsep + os.environ.get('PATH', ''))
+        code = (f"import sys; sys.path.insert(0, {os.path.dirname(PREPROCESS)!r}); import preprocess; "
+                f"print(preprocess.run_clamav_scan({file_path!r}))")
+        result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with open(file_path + '-clamav.txt') as f:
+            report = f.read()
+        return result.stdout.strip().splitlines()[-1] == 'True', report, result.stdout
+
+    def test_scan_ok(self):
+        clean, report, _ = self.scan(b'harmless payload')
+        self.assertTrue(clean)
+        self.assertIn(': OK', report)
+        self.assertIn('Infected files: 0', report)
+        self.assertIn('Engine version: ClamAV 1.0.0-stub/27000', report)
+        self.assertIn('Scanner: clamd (SCAN)', report)
+        self.assertEqual(self.server.commands, ['zSCAN', 'zVERSION'])
+
+    def test_instream_ok(self):
+        clean, report, _ = self.scan(os.urandom(3 * 1024 * 1024), clamd_command='INSTREAM')  #several chunks
+        self.assertTrue(clean)
+        self.assertIn('Scanner: clamd (INSTREAM)', report)
+        self.assertEqual(self.server.commands, ['zINSTREAM', 'zVERSION'])
+
+    def test_found(self):
+        for clamd_command in ('SCAN', 'INSTREAM'):
+            with self.subTest(clamd_command=clamd_command):
+                clean, report, _ = self.scan(b'X5O!P%@AP EICAR test', clamd_command=clamd_command)
+                self.assertFalse(clean)
+                self.assertIn('Eicar-Test-Signature FOUND', report)
+                self.assertIn('Infected files: 1', report)
+
+    def test_error_reply_falls_back_to_clamscan(self):
+        clean, report, stdout = self.scan(b'TOOBIG', clamd_command='INSTREAM')
+        self.assertTrue(clean)
+        self.assertIn('Scanner: clamscan stub', report)
+        self.assertIn('falling back to clamscan', stdout)
+        self.assertIn('size limit exceeded', stdout)
+
+    def test_unreachable_clamd_falls_back_to_clamscan(self):
+        clean, report, stdout = self.scan(b'harmless payload', clamd_socket=os.path.join(self.workdir, 'missing.sock'))
+        self.assertTrue(clean)
+        self.assertIn('Scanner: clamscan stub', report)
+        self.assertIn('falling back to clamscan', stdout)
+        self.assertEqual(self.server.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+test_smtp_digest.py - Test for preprocess.py digest emails over the shared SMTP connection
+
+With [EMAIL] digest on, each Contact-Email gets one summary email per run, and the outbox sender
+delivers every spooled email over one SMTP connection (one STARTTLS, one login) instead of one
+per AU. A stub SMTP server on localhost speaks enough of SMTP (EHLO, STARTTLS, AUTH PLAIN, MAIL,
+RCPT, DATA, QUIT) to count connections and keep the messages. STARTTLS uses a throwaway
+self-signed certificate made with the openssl command, the test is skipped without it.
+
+Usage:
+    python3 test_smtp_digest.py
+    python3 -m pytest scripts/test_smtp_digest.py
+"""
+
+import os
+import ssl
+import sys
+import json
+import email
+import shutil
+import tempfile
+import textwrap
+import threading
+import subprocess
+import socketserver
+import unittest
+
+PREPROCESS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess.py')
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    #one SMTP session, every accepted message is kept on the server with the session it came in on
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            session = server.connections
+        self.send('220 localhost ESMTP stub')
+        sender, recipients, tls = None, [], False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.send('250-localhost', '250-AUTH PLAIN', '250 STARTTLS' if not tls else '250 8BITMIME')
+            elif verb == 'STARTTLS':
+                self.send('220 Ready to start TLS')
+                self.request = server.tls_context.wrap_socket(self.request, server_side=True)
+                self.rfile = self.request.makefile('rb')
+                self.wfile = self.request.makefile('wb', buffering=0)
+                tls = True
+                with server.lock:
+                    server.starttls += 1
+            elif verb == 'AUTH':
+                with server.lock:
+                    server.logins += 1
+                self.send('235 Authentication successful')
+            elif verb == 'MAIL':
+                sender, recipients = command.split(':', 1)[1].strip().strip('<>'), []
+                self.send('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip().strip('<>'))
+                self.send('250 OK')
+            elif verb == 'DATA':
+                self.send('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                with server.lock:
+                    server.messages.append({'session': session, 'tls': tls, 'from': sender,
+                                            'recipients': recipients, 'message': email.message_from_bytes(b''.join(data))})
+                self.send('250 OK queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.send('250 OK')
+            elif verb == 'QUIT':
+                self.send('221 Bye')
+                return
+            else:
+                self.send('502 Command not implemented')
+
+    def send(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+
+
+@unittest.skipUnless(shutil.which('openssl'), "needs the openssl command for a STARTTLS certificate")
+class DigestDeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='smtp-digest-')
+        cert, key = os.path.join(self.workdir, 'cert.pem'), os.path.join(self.workdir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-keyout', key, '-out', cert], check=True, capture_output=True)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = self.server.starttls = self.server.logins = 0
+        self.server.messages = []
+        self.server.tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.server.tls_context.load_cert_chain(cert, key)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.destination_dir = os.path.join(self.workdir, 'staging')
+        self.outbox_dir = os.path.join(self.workdir, 'outbox')
+        self.config = os.path.join(self.workdir, 'config.ini')
+        with open(self.config, 'w') as f:
+            f.write(textwrap.dedent(f"""\
+                [DEFAULT]
+                logfile = {os.path.join(self.workdir, 'log.csv')}
+                destination_dir = {self.destination_dir}
+                staging_url = http://localhost/staging/
+
+                [EMAIL]
+                enabled = true
+                digest = true
+                debug_mode = false
+                smtp_host = 127.0.0.1
+                smtp_port = {self.server.server_address[1]}
+                smtp_username = preprocess
+                smtp_password = secret
+                use_tls = true
+                smtp_timeout = 10
+                outbox_dir = {self.outbox_dir}
+                """))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def au_result(self, fname, contact_email, status="Staged", error_details=None):
+        #the fields of an AU result that send_digests reads
+        au_dir = os.path.join(self.destination_dir, fname)
+        os.makedirs(au_dir, exist_ok=True)
+        with open(os.path.join(au_dir, 'bag-info.txt'), 'w') as f:
+            f.write(f"Contact-Email: {contact_email}\n")
+        return {'fname': fname, 'size': 1024, 'status': status, 'error_details': error_details,
+                'baginfo_dict': {'Contact-Email': contact_email}, 'completed': []}
+
+    def test_digests_share_one_connection(self):
+        results = [
+            self.au_result('example-au-2024', 'curator@example.edu'),
+            self.au_result('example-au-2025', 'curator@example.edu', "Error: Fixity check failed", "checksum mismatch: data/a.pdf"),
+            self.au_result('other-au-2024', 'librarian@example.org'),
+            self.au_result('third-au-2024', 'archivist@example.net'),
+        ]
+        code = (f"import sys, json; sys.path.insert(0, {os.path.dirname(PREPROCESS)!r}); import preprocess\n"
+                f"for result in json.loads({json.dumps(results)!r}):\n"
+                f"    preprocess.queue_digest_entry(result)\n"
+                f"preprocess.send_digests()\n"
+                f"print(preprocess.deliver_outbox())\n"
+                f"preprocess.close_smtp_connection()\n")
+        result = subprocess.run([sys.executable, '-c', code], env=dict(os.environ, PREPROCESS_CONFIG=self.config),
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], '(3, 0, 0)', result.stdout)
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.starttls, 1)
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertTrue(all(m['tls'] for m in self.server.messages))
+
+        by_recipient = {m['recipients'][0]: m['message'] for m in self.server.messages}
+        self.assertEqual(set(by_recipient), {'curator@example.edu', 'librarian@example.org', 'archivist@example.net'})
+        digest = by_recipient['curator@example.edu']
+        self.assertEqual(digest['Subject'], "AU Processing Summary: 2 AU(s), 1 failed")
+        body = digest.get_payload()[0].get_payload(decode=True).decode()
+        self.assertIn('example-au-2024', body)
+        self.assertIn('checksum mismatch: data/a.pdf', body)
+        self.assertEqual(os.listdir(os.path.join(self.outbox_dir, 'pending')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+test_titledb_restore.py - Regression test for preprocess.py --restore-titledb
+
+Restoring a version backs up the current titledb.xml first, and that backup applies retention.
+When the version being restored is the oldest one kept, retention used to prune it before it
+was read, so the restore failed and the version was lost. A version is named by its exact
+timestamp or a sha256 prefix of at least 7 characters; an ambiguous prefix is an error listing
+the candidates. Runs preprocess.py against a throwaway config in a temporary directory, nothing
+else is needed.
+
+Usage:
+    python3 test_titledb_restore.py
+    python3 -m pytest scripts/test_titledb_restore.py
+"""
+
+import os
+import sys
+import csv
+import gzip
+import shutil
+import tempfile
+import textwrap
+import subprocess
+import unittest
+
+PREPROCESS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess.py')
+
+
+class RestoreOldestBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='titledb-restore-')
+        self.titledb = os.path.join(self.workdir, 'titledb.xml')
+        self.backup_dir = os.path.join(self.workdir, 'titledb_backups')
+        self.config = os.path.join(self.workdir, 'config.ini')
+        with open(self.config, 'w') as f:
+            f.write(textwrap.dedent(f"""\
+                [DEFAULT]
+                titledb = {self.titledb}
+                logfile = {os.path.join(self.workdir, 'log.csv')}
+
+                [TITLEDB]
+                backup_dir = {self.backup_dir}
+                keep_recent = 3
+                keep_daily = 1
+                keep_monthly = 1
+                """))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def preprocess(self, *args, code=None):
+        #run preprocess.py against the test config, either one of its CLI options or a snippet of Python
+        env = dict(os.environ, PREPROCESS_CONFIG=self.config)
+        if code is not None:
+            command = [sys.executable, '-c', f"import sys; sys.path.insert(0, {os.path.dirname(PREPROCESS)!r}); "
+                                             f"import preprocess; {code}"]
+        else:
+            command = [sys.executable, PREPROCESS, *args]
+        return subprocess.run(command, env=env, capture_output=True, text=True)
+
+    def write_titledb(self, version):
+        with open(self.titledb, 'w') as f:
+            f.write(f'<lockss-config><property name="org.lockss.title" version="{version}" /></lockss-config>\n')
+
+    def catalog(self):
+        with open(os.path.join(self.backup_dir, 'catalog.csv'), newline='') as f:
+            return list(csv.DictReader(f))
+
+    def test_restore_oldest_retained_version(self):
+        for version in range(4):
+            self.write_titledb(version)
+            result = self.preprocess(code=f"preprocess.backup_titledb({self.titledb!r})")
+            self.assertEqual(result.returncode, 0, result.stderr)
+        rows = self.catalog()
+        self.assertEqual(len(rows), 3)  #keep_recent = 3, the first version has been pruned
+        oldest = rows[0]['sha256']
+
+        self.write_titledb('edited')  #a fourth kept version pushes the oldest out when it is backed up
+        result = self.preprocess('--restore-titledb', oldest)
+
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertNotIn('Traceback', result.stderr)
+        with open(self.titledb) as f:
+            self.assertIn('version="1"', f.read())
+        self.assertFalse(os.path.exists(self.titledb + '.tmp'))
+
+    def test_missing_object_is_reported(self):
+        self.write_titledb(0)
+        self.assertEqual(self.preprocess(code=f"preprocess.backup_titledb({self.titledb!r})").returncode, 0)
+        sha256 = self.catalog()[0]['sha256']
+        os.remove(os.path.join(self.backup_dir, 'objects', sha256 + '.xml.gz'))
+
+        result = self.preprocess('--restore-titledb', sha256)
+
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('Error:', result.stdout)
+        self.assertNotIn('Traceback', result.stderr)
+        with open(self.titledb) as f:
+            self.assertIn('version="0"', f.read())  #the current titledb.xml is left as it was
+
+    def write_backup(self, sha256, timestamp, version):
+        #a stored version under a chosen sha256, so two can share a prefix
+        os.makedirs(os.path.join(self.backup_dir, 'objects'), exist_ok=True)
+        with gzip.open(os.path.join(self.backup_dir, 'objects', sha256 + '.xml.gz'), 'wt') as f:
+            f.write(f'<lockss-config><property name="org.lockss.title" version="{version}" /></lockss-config>\n')
+        rows = self.catalog() if os.path.exists(os.path.join(self.backup_dir, 'catalog.csv')) else []
+        rows.append({'timestamp': timestamp, 'sha256': sha256, 'size': '80'})
+        with open(os.path.join(self.backup_dir, 'catalog.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['timestamp', 'sha256', 'size'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def test_version_must_be_exact_timestamp_or_long_sha256_prefix(self):
+        self.write_titledb('current')
+        self.write_backup('abcdef1' + '0' * 57, '2026-01-05T10:00:00.000000', 'a')
+        self.write_backup('abcdef2' + '0' * 57, '2026-01-06T10:00:00.000000', 'b')
+
+        for version in ('2026', '2026-01-05', 'abcdef'):  #a timestamp prefix, or a sha256 prefix under 7 characters
+            with self.subTest(version=version):
+                result = self.preprocess('--restore-titledb', version)
+                self.assertEqual(result.returncode, 1)
+                self.assertIn('Error:', result.stdout)
+
+        result = self.preprocess('--restore-titledb', 'abcdef')
+        self.assertIn('at least 7', result.stdout)
+
+        with open(self.titledb) as f:
+            self.assertIn('version="current"', f.read())  #nothing restored
+
+        result = self.preprocess('--restore-titledb', '2026-01-05T10:00:00.000000')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        with open(self.titledb) as f:
+            self.assertIn('version="a"', f.read())
+
+        result = self.preprocess('--restore-titledb', 'ABCDEF2')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        with open(self.titledb) as f:
+            self.assertIn('version="b"', f.read())
+
+    def test_ambiguous_sha256_prefix_lists_candidates(self):
+        self.write_titledb('current')
+        self.write_backup('abcdef1' + '0' * 57, '2026-01-05T10:00:00.000000', 'a')
+        self.write_backup('abcdef1' + '1' * 57, '2026-01-06T10:00:00.000000', 'b')
+
+        result = self.preprocess('--restore-titledb', 'abcdef1')
+
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('matches more than one titledb backup', result.stdout)
+        self.assertIn('abcdef1' + '0' * 57, result.stdout)
+        self.assertIn('abcdef1' + '1' * 57, result.stdout)
+        with open(self.titledb) as f:
+            self.assertIn('version="current"', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
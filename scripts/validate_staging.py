@@ -6,21 +6,38 @@ This script validates that all archival units in the staging directory have been
 properly processed and contain all required files with valid content.
 
 Usage:
-    python3 validate_staging.py [staging_directory]
+    python3 validate_staging.py [staging_directory] [--jobs N] [--incremental]
+                                [--deep [--deep-jobs N] [--max-bytes-per-second RATE]]
 
-If staging_directory is not provided, it reads from config.ini
+If staging_directory is not provided, it reads from config.ini. AUs are validated on a
+thread pool; with --incremental, AUs whose files haven't changed since the last run are
+taken from the validation cache instead of being checked again. --deep also re-hashes every
+staged tarball's payload against its bag manifest (see fixity_audit.py) to find bit-rot.
 
 Author: Generated for MDPN preprocess validation
 """
 
 import os
 import sys
+import argparse
 import configparser
+import threading
+import concurrent.futures
+import multiprocessing
 from pathlib import Path
 import json
 from datetime import datetime
 import xml.etree.ElementTree as ET
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tar_index
+import ledger
+import fixity_audit
+import titledb_index
+
+DEFAULT_JOBS = 16  # threads validating AUs at once, the work is waiting on (often network) storage
+CACHE_VERSION = 1
+
 # ANSI color codes for output
 class Colors:
     GREEN = '\033[92m'
@@ -86,13 +103,14 @@ def validate_file(file_path, file_type, au_name):
 
     return True, None, file_size
 
-def validate_au_directory(au_path, au_name):
+def validate_au_directory(au_path, au_name, ledger_conn=None):
     """
     Validate a single archival unit directory
 
     Args:
         au_path: Path to the AU directory
         au_name: Name of the AU
+        ledger_conn: Open processing ledger, or None to skip the ledger checks
 
     Returns:
         dict: Validation results
@@ -116,7 +134,8 @@ def validate_au_directory(au_path, au_name):
 
     # Optional files that should be present
     optional_files = {
-        'manifest.html': 'manifest.html'
+        'manifest.html': 'manifest.html',
+        'tar index': f"{au_name}.tar{tar_index.INDEX_SUFFIX}"
     }
 
     # Validate required files
@@ -150,6 +169,40 @@ def validate_au_directory(au_path, au_name):
         if not is_valid:
             results['warnings'].append(f"Optional file missing or empty: {file_type}")
 
+    # Cross-check the staged bag-info.txt against the copy inside the tarball,
+    # seeking straight to it with the member index rather than scanning the tar
+    tar_path = os.path.join(au_path, required_files['tarball'])
+    bag_info_path = os.path.join(au_path, 'bag-info.txt')
+    index = tar_index.load_index(tar_path)
+    if index is None:
+        if results['files']['tar index']['exists']:
+            results['warnings'].append("Tar index does not match the tarball (stale), bag-info.txt not cross-checked")
+    elif os.path.isfile(bag_info_path):
+        entry = index.get(f"{au_name}/bag-info.txt")
+        if entry is None:
+            results['valid'] = False
+            results['errors'].append("bag-info.txt not found in tarball")
+        else:
+            try:
+                with open(bag_info_path, 'rb') as f:
+                    if tar_index.read_member(tar_path, entry) != f.read():
+                        results['valid'] = False
+                        results['errors'].append("bag-info.txt does not match the copy in the tarball")
+            except (OSError, EOFError) as e:
+                results['valid'] = False
+                results['errors'].append(f"Could not read bag-info.txt from tarball: {e}")
+
+    # Check the AU against preprocess.py's record of staging it
+    if ledger_conn is not None:
+        attempt = ledger.latest_attempt(ledger_conn, au_name)
+        results['ledger'] = dict(attempt) if attempt is not None else None
+        if attempt is None or attempt['status'] != ledger.STAGED:
+            results['warnings'].append("No Staged entry for this AU in the ledger")
+        elif results['files']['tarball']['exists'] and attempt['size'] != results['files']['tarball']['size']:
+            results['valid'] = False
+            results['errors'].append(f"Tarball size {results['files']['tarball']['size']} does not match the "
+                                     f"{attempt['size']} bytes recorded in the ledger")
+
     return results
 
 def format_size(size_bytes):
@@ -160,13 +213,109 @@ def format_size(size_bytes):
         size_bytes /= 1024.0
     return f"{size_bytes:.2f} TB"
 
-def validate_staging_directory(staging_dir, verbose=True):
+thread_state = threading.local()
+
+def thread_ledger(ledger_file):
+    """The calling thread's read-only ledger connection (sqlite connections can't be shared), None without a ledger"""
+    if ledger_file is None:
+        return None
+    if getattr(thread_state, 'ledger_path', None) != ledger_file:
+        thread_state.ledger_conn = ledger.connect_readonly(ledger_file)
+        thread_state.ledger_path = ledger_file
+    return thread_state.ledger_conn
+
+def au_signature(au_path, au_name, ledger_conn=None):
+    """
+    What an AU's validation result depends on: the folder's mtime, the size and mtime of each
+    file in it and the AU's latest ledger entry. One scandir and a stat per file, no file is read.
+
+    Returns:
+        list: JSON-serializable signature, compared with the cached one
+    """
+    entries = []
+    with os.scandir(au_path) as it:
+        for entry in it:
+            stat = entry.stat(follow_symlinks=False)
+            entries.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    attempt = ledger.latest_attempt(ledger_conn, au_name) if ledger_conn is not None else None
+    return [os.stat(au_path).st_mtime_ns, sorted(entries), attempt['attempt_id'] if attempt is not None else None]
+
+def load_cache(cache_file, staging_dir):
+    """Per-AU signatures and results from the last incremental run, empty if there are none for staging_dir"""
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION or cache.get('staging_dir') != os.path.abspath(staging_dir):
+        return {}
+    return cache.get('aus', {})
+
+def save_cache(cache_file, staging_dir, entries):
+    """Write the validation cache atomically (temp file + rename)"""
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'staging_dir': os.path.abspath(staging_dir), 'aus': entries}, f)
+    os.replace(cache_file + '.tmp', cache_file)
+
+def check_au(au_name, au_path, ledger_file, cache):
+    """
+    Validate one AU on a pool thread, or reuse its cached result if its signature hasn't changed
+
+    Returns:
+        tuple: (results, signature or None when not caching, whether the result came from the cache)
+    """
+    ledger_conn = thread_ledger(ledger_file)
+    if cache is None:
+        return validate_au_directory(au_path, au_name, ledger_conn), None, False
+    try:
+        signature = au_signature(au_path, au_name, ledger_conn)
+    except OSError:
+        signature = None  #vanished or unreadable, validate_au_directory reports why
+    cached = cache.get(au_name)
+    if signature is not None and cached is not None and cached['signature'] == signature:
+        return cached['results'], signature, True
+    return validate_au_directory(au_path, au_name, ledger_conn), signature, False
+
+def diff_against_last_run(previous, current_aus, changed):
+    """
+    Compact comparison with the previous report: AUs added, removed, newly invalid, newly valid,
+    and (incremental runs) AUs revalidated because their files changed
+
+    Args:
+        previous: The last validation_report.json, or None
+        current_aus: This run's per-AU results
+        changed: Names of cached AUs whose signature changed, or None outside incremental mode
+
+    Returns:
+        dict: The diff section of the report
+    """
+    before = {au['au_name']: au['valid'] for au in (previous or {}).get('aus', [])}
+    after = {au['au_name']: au['valid'] for au in current_aus}
+    diff = {
+        'previous_timestamp': (previous or {}).get('timestamp'),
+        'added': sorted(set(after) - set(before)),
+        'removed': sorted(set(before) - set(after)),
+        'newly_invalid': sorted(name for name, valid in after.items() if not valid and before.get(name) is True),
+        'newly_valid': sorted(name for name, valid in after.items() if valid and before.get(name) is False),
+    }
+    if changed is not None:
+        diff['changed'] = sorted(changed)
+    return diff
+
+def validate_staging_directory(staging_dir, verbose=True, ledger_file=None, jobs=DEFAULT_JOBS, cache_file=None,
+                               previous_report=None):
     """
     Validate all AU directories in the staging directory
 
+    AUs are validated on a pool of jobs threads and reported in name order.
+
     Args:
         staging_dir: Path to staging directory
         verbose: Whether to print detailed output
+        ledger_file: Path of the processing ledger, or None to skip the ledger checks
+        jobs: Number of AUs validated at once
+        cache_file: Validation cache for incremental mode, None checks every AU
+        previous_report: The last run's report, for the diff section, or None
 
     Returns:
         dict: Overall validation results
@@ -181,12 +330,12 @@ def validate_staging_directory(staging_dir, verbose=True):
 
     print_header(f"Validating Staging Directory: {staging_dir}")
 
-    # Find all subdirectories (potential AUs)
+    # Find all subdirectories (potential AUs), scandir's entry types save a stat per AU
     au_dirs = []
-    for item in os.listdir(staging_dir):
-        item_path = os.path.join(staging_dir, item)
-        if os.path.isdir(item_path):
-            au_dirs.append((item, item_path))
+    with os.scandir(staging_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                au_dirs.append((entry.name, entry.path))
 
     if not au_dirs:
         print_warning("No archival unit directories found in staging directory")
@@ -199,46 +348,66 @@ def validate_staging_directory(staging_dir, verbose=True):
         }
 
     print_info(f"Found {len(au_dirs)} potential archival unit(s)")
+    cache = load_cache(cache_file, staging_dir) if cache_file else None
+    if previous_report is not None and os.path.abspath(previous_report.get('staging_dir', '')) != os.path.abspath(staging_dir):
+        previous_report = None  #a report for another directory, nothing to compare with
+    if cache is not None:
+        print_info(f"Incremental mode, {len(cache)} AU(s) in the validation cache")
     print()
 
-    # Validate each AU
+    # Validate each AU, results come back in name order as the pool works ahead
     all_results = []
     valid_count = 0
     invalid_count = 0
+    cache_entries = {}
+    changed = []
+    cached_count = 0
+
+    au_dirs = sorted(au_dirs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        checks = pool.map(lambda au: check_au(au[0], au[1], ledger_file, cache), au_dirs)
+        for (au_name, au_path), (results, signature, from_cache) in zip(au_dirs, checks):
+            if signature is not None:
+                cache_entries[au_name] = {'signature': signature, 'results': results}
+            if from_cache:
+                cached_count += 1
+            elif cache is not None and au_name in cache:
+                changed.append(au_name)
 
-    for au_name, au_path in sorted(au_dirs):
-        if verbose:
-            print(f"\n{Colors.BOLD}Validating AU: {au_name}{Colors.END}")
-            print("-" * 80)
+            if verbose:
+                print(f"\n{Colors.BOLD}Validating AU: {au_name}{' (unchanged, cached result)' if from_cache else ''}{Colors.END}")
+                print("-" * 80)
 
-        results = validate_au_directory(au_path, au_name)
-        all_results.append(results)
+            all_results.append(results)
 
-        if results['valid']:
-            valid_count += 1
-            if verbose:
-                print_success(f"AU '{au_name}' is valid")
-        else:
-            invalid_count += 1
+            if results['valid']:
+                valid_count += 1
+                if verbose:
+                    print_success(f"AU '{au_name}' is valid")
+            else:
+                invalid_count += 1
+                if verbose:
+                    print_error(f"AU '{au_name}' has errors:")
+                    for error in results['errors']:
+                        print(f"  • {error}")
+
+            # Display file information
             if verbose:
-                print_error(f"AU '{au_name}' has errors:")
-                for error in results['errors']:
-                    print(f"  • {error}")
+                print(f"\n  Files:")
+                for file_type, file_info in results['files'].items():
+                    status = "✓" if file_info['valid'] else "✗"
+                    color = Colors.GREEN if file_info['valid'] else Colors.RED
+                    size_str = format_size(file_info['size']) if file_info['exists'] else "N/A"
+                    print(f"    {color}{status}{Colors.END} {file_type:20s} {size_str:>12s}")
+
+            # Display warnings
+            if verbose and results['warnings']:
+                print(f"\n  {Colors.YELLOW}Warnings:{Colors.END}")
+                for warning in results['warnings']:
+                    print(f"    • {warning}")
 
-        # Display file information
-        if verbose:
-            print(f"\n  Files:")
-            for file_type, file_info in results['files'].items():
-                status = "✓" if file_info['valid'] else "✗"
-                color = Colors.GREEN if file_info['valid'] else Colors.RED
-                size_str = format_size(file_info['size']) if file_info['exists'] else "N/A"
-                print(f"    {color}{status}{Colors.END} {file_type:20s} {size_str:>12s}")
-
-        # Display warnings
-        if verbose and results['warnings']:
-            print(f"\n  {Colors.YELLOW}Warnings:{Colors.END}")
-            for warning in results['warnings']:
-                print(f"    • {warning}")
+    if cache is not None:
+        save_cache(cache_file, staging_dir, cache_entries)
 
     # Summary
     overall_results = {
@@ -249,14 +418,20 @@ def validate_staging_directory(staging_dir, verbose=True):
         'aus': all_results,
         'timestamp': datetime.now().isoformat()
     }
+    if cache is not None:
+        overall_results['cached_aus'] = cached_count
+    overall_results['diff'] = diff_against_last_run(previous_report, all_results, changed if cache is not None else None)
 
     print_header("Validation Summary")
     print(f"Total AUs:   {overall_results['total_aus']}")
+    if cache is not None:
+        print(f"Rechecked:   {len(au_dirs) - cached_count} ({cached_count} unchanged since the last run)")
     print(f"{Colors.GREEN}Valid AUs:   {overall_results['valid_aus']}{Colors.END}")
     if invalid_count > 0:
         print(f"{Colors.RED}Invalid AUs: {overall_results['invalid_aus']}{Colors.END}")
     else:
         print(f"Invalid AUs: {overall_results['invalid_aus']}")
+    print_diff(overall_results['diff'])
     print()
 
     if overall_results['valid_aus'] == overall_results['total_aus'] and overall_results['total_aus'] > 0:
@@ -272,10 +447,151 @@ def validate_staging_directory(staging_dir, verbose=True):
     overall_results['return_code'] = return_code
     return overall_results
 
+def print_diff(diff):
+    """Print the changes since the last run, names are listed when there are only a few"""
+    if diff['previous_timestamp'] is None:
+        return
+    print(f"\nSince the last run ({diff['previous_timestamp']}):")
+    labels = [('added', "Added"), ('removed', "Removed"), ('newly_invalid', "Newly invalid"),
+              ('newly_valid', "Newly valid"), ('changed', "Files changed")]
+    shown = False
+    for key, label in labels:
+        names = diff.get(key) or []
+        if names:
+            shown = True
+            listed = ', '.join(names[:10]) + (f" and {len(names) - 10} more" if len(names) > 10 else '')
+            color = Colors.RED if key == 'newly_invalid' else ''
+            print(f"  {color}{label + ':':<15}{len(names)}  {listed}{Colors.END if color else ''}")
+    if not shown:
+        print("  no changes")
+
+def load_report(report_file):
+    """The previous validation report, None if there isn't a readable one"""
+    try:
+        with open(report_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def deep_audit(au_dirs, ledger_file, jobs, bytes_per_second, audit_log, restart=False, verbose=True):
+    """
+    Re-hash each AU's tarball against its bag manifest and recorded digests, on a process pool
+
+    Each AU is written to the audit log as soon as it is done, so an interrupted audit resumes
+    where it stopped; AUs the current audit already covered are skipped unless their tarball
+    has changed since. The bytes-per-second budget is shared between the processes.
+
+    Args:
+        au_dirs: (AU name, AU path) pairs
+        ledger_file: Path of the processing ledger, or None
+        jobs: Number of tarballs read at once
+        bytes_per_second: Total read budget, None for unthrottled
+        audit_log: Path of the JSON lines audit log
+        restart: Start a new audit even if the last one was interrupted
+
+    Returns:
+        dict: The fixity_audit section of the report
+    """
+    jobs = max(1, jobs)
+    audit_id, done = fixity_audit.open_audit(audit_log, restart)
+    earlier = fixity_audit.previous_records(audit_log, audit_id)
+    ledger_conn = ledger.connect_readonly(ledger_file) if ledger_file else None
+    per_process = bytes_per_second / jobs if bytes_per_second else None
+
+    records = {}
+    pending = []
+    for au_name, au_path in sorted(au_dirs):
+        tar_path = os.path.join(au_path, f"{au_name}.tar")
+        if au_name in done and fixity_audit.unchanged(done[au_name], tar_path):
+            records[au_name] = done[au_name]
+        else:
+            pending.append((au_name, tar_path))
+
+    print_header(f"Deep Fixity Audit {audit_id}")
+    if records:
+        print_info(f"Resuming an interrupted audit, {len(records)} AU(s) already audited")
+    rate = f", {format_size(bytes_per_second)}/s budget" if bytes_per_second else ''
+    print_info(f"Re-hashing {len(pending)} tarball(s) on {jobs} process(es){rate}")
+
+    #spawned workers, the pool mustn't inherit the sqlite connection or half-written stdout
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        futures = {pool.submit(fixity_audit.audit_tarball, tar_path, au_name, per_process): au_name
+                   for au_name, tar_path in pending}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                au_name = futures[future]
+                try:
+                    record = future.result()
+                except Exception as error:  #eg a worker that died, recorded against this AU so the audit carries on
+                    record = {'tar_path': os.path.join(dict(au_dirs)[au_name], f"{au_name}.tar"),
+                              'status': fixity_audit.ERROR, 'problems': [f"audit failed: {error!r}"], 'payload_files': 0}
+                check_recorded_digest(record, au_name, ledger_conn, earlier.get(au_name))
+                fixity_audit.record_au(audit_log, audit_id, au_name, record)
+                records[au_name] = record
+                if verbose:
+                    if record['status'] == fixity_audit.OK:
+                        print_success(f"{au_name}: {record['payload_files']} payload file(s) match the manifest")
+                    else:
+                        print_error(f"{au_name}: {record['status']}")
+                        for problem in record['problems'][:10]:
+                            print(f"  • {problem}")
+                        if len(record['problems']) > 10:
+                            print(f"  • and {len(record['problems']) - 10} more")
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            print_warning(f"Audit interrupted after {len(records)} AU(s), run --deep again to resume it")
+            raise
+    fixity_audit.finish_audit(audit_log, audit_id)
+
+    bitrot = sorted(name for name, record in records.items() if record['status'] == fixity_audit.BITROT)
+    errors = sorted(name for name, record in records.items() if record['status'] == fixity_audit.ERROR)
+    summary = {
+        'audit_id': audit_id,
+        'audit_log': audit_log,
+        'audited_aus': len(records),
+        'resumed_aus': len(records) - len(pending),
+        'bytes_read': sum(records[name].get('tar_size', 0) for name, _ in pending),
+        'bitrot': bitrot,
+        'errors': errors,
+        'aus': {name: {'status': record['status'], 'tar_sha256': record.get('tar_sha256'), 'problems': record['problems']}
+                for name, record in sorted(records.items())},
+    }
+    print(f"\nAudited:  {summary['audited_aus']} ({summary['resumed_aus']} from the interrupted audit)")
+    if bitrot:
+        print_error(f"Bit-rot in {len(bitrot)} AU(s): {', '.join(bitrot)}")
+    if errors:
+        print_error(f"Could not audit {len(errors)} AU(s): {', '.join(errors)}")
+    if not bitrot and not errors:
+        print_success("No bit-rot found")
+    return summary
+
+def check_recorded_digest(record, au_name, ledger_conn, earlier):
+    """
+    Compare the tarball's sha256 with the one preprocess.py recorded when it staged the AU, or
+    failing that with the last audit's, as long as the tarball hasn't been replaced since
+    """
+    if 'tar_sha256' not in record:
+        return
+    attempt = ledger.latest_attempt(ledger_conn, au_name) if ledger_conn is not None else None
+    if attempt is not None and attempt['tar_sha256'] and attempt['size'] == record.get('tar_size'):
+        expected, source = attempt['tar_sha256'], "the ledger"
+    elif earlier is not None and fixity_audit.unchanged(earlier, record['tar_path']):
+        expected, source = earlier['tar_sha256'], f"audit {earlier['audit']}"
+    else:
+        return
+    if record['tar_sha256'] != expected:
+        record['problems'].append(f"tarball sha256 does not match {source}")
+        record['status'] = fixity_audit.BITROT
+
 def validate_titledb(titledb_path, au_names):
     """
     Validate titledb.xml file
 
+    The file is streamed once into an index of the AUs being checked (titledb_index.py), so time
+    and memory grow with the number of AUs checked, not with the size of titledb.xml.
+
     Args:
         titledb_path: Path to titledb.xml
         au_names: List of AU names that should be in titledb
@@ -303,10 +619,10 @@ def validate_titledb(titledb_path, au_names):
 
     results['exists'] = True
 
-    # Try to parse XML
+    # Index the AU entries in one pass
+    # titledb structure: root > property (title) > property elements where property.name is the AU name
     try:
-        tree = ET.parse(titledb_path)
-        root = tree.getroot()
+        au_properties = titledb_index.build_index(titledb_path, set(au_names))
         results['valid_xml'] = True
     except ET.ParseError as e:
         results['errors'].append(f"XML parsing error: {e}")
@@ -315,16 +631,6 @@ def validate_titledb(titledb_path, au_names):
         results['errors'].append(f"Error reading titledb.xml: {e}")
         return results
 
-    # Find all AU entries (properties with name attributes that match AU names)
-    # titledb structure: root > property elements where property.name is the AU name
-    au_properties = {}
-
-    # Get all property elements
-    for prop in root.findall('.//property'):
-        prop_name = prop.get('name')
-        if prop_name and prop_name in au_names:
-            au_properties[prop_name] = prop
-
     results['total_entries'] = len(au_properties)
     results['matching_entries'] = len(au_properties)
 
@@ -354,36 +660,27 @@ def validate_titledb(titledb_path, au_names):
             results['errors'].append(f"AU '{au_name}' not found in titledb.xml")
         else:
             au_result['found'] = True
-            au_prop = au_properties[au_name]
-
-            # Check for required fields (sub-properties)
-            found_fields = set()
-            for sub_prop in au_prop.findall('property'):
-                field_name = sub_prop.get('name')
-                if field_name:
-                    found_fields.add(field_name)
-                    au_result['present_fields'].append(field_name)
+            entry = au_properties[au_name]
+            au_result['present_fields'] = list(entry['fields'])
 
             # Check for missing required fields
             for required_field in required_fields:
-                if required_field not in found_fields:
+                if required_field not in entry['fields']:
                     au_result['missing_fields'].append(required_field)
                     au_result['valid'] = False
                     results['errors'].append(f"AU '{au_name}' missing required field: {required_field}")
 
             # Validate param.1 has correct sub-properties
-            param1 = au_prop.find("property[@name='param.1']")
-            if param1 is not None:
-                param1_props = {p.get('name'): p.get('value') for p in param1.findall('property')}
+            param1_props = entry['params'].get('param.1')
+            if param1_props is not None:
                 if 'key' not in param1_props or param1_props.get('key') != 'base_url':
                     results['warnings'].append(f"AU '{au_name}' param.1 may not have correct structure")
                 if 'value' not in param1_props or not param1_props.get('value'):
                     results['warnings'].append(f"AU '{au_name}' param.1 missing value")
 
             # Validate param.2 has correct sub-properties
-            param2 = au_prop.find("property[@name='param.2']")
-            if param2 is not None:
-                param2_props = {p.get('name'): p.get('value') for p in param2.findall('property')}
+            param2_props = entry['params'].get('param.2')
+            if param2_props is not None:
                 if 'key' not in param2_props or param2_props.get('key') != 'directory':
                     results['warnings'].append(f"AU '{au_name}' param.2 may not have correct structure")
                 if 'value' not in param2_props or param2_props.get('value') != au_name:
@@ -404,6 +701,22 @@ def save_report(results, output_file):
 
 def main():
     """Main entry point"""
+    parser = argparse.ArgumentParser(description="Validate the archival units in the staging directory")
+    parser.add_argument('staging_directory', nargs='?', help="staging directory (default: destination_dir in config.ini)")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help=f"AUs validated at once (default: {DEFAULT_JOBS})")
+    parser.add_argument('--incremental', action='store_true', help="only recheck AUs whose files changed since the last incremental run")
+    parser.add_argument('--cache', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'validation_cache.json'),
+                        help="validation cache for --incremental (default: validation_cache.json next to this script)")
+    parser.add_argument('--deep', action='store_true', help="also re-hash every tarball's payload against its bag manifest")
+    parser.add_argument('--deep-jobs', type=int, default=os.cpu_count() or 1,
+                        help="tarballs re-hashed at once by --deep, one process each (default: CPU count)")
+    parser.add_argument('--max-bytes-per-second', type=fixity_audit.parse_rate, default=None, metavar='RATE',
+                        help="total read budget for --deep, eg 200M or 1G (default: unthrottled)")
+    parser.add_argument('--audit-log', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixity_audit.jsonl'),
+                        help="--deep audit log, used to resume an interrupted audit (default: fixity_audit.jsonl next to this script)")
+    parser.add_argument('--restart-audit', action='store_true', help="start a new --deep audit even if the last one was interrupted")
+    args = parser.parse_args()
+
     print_header("MDPN Staging Directory Validation Tool")
 
     # Load config
@@ -414,8 +727,8 @@ def main():
 
     # Determine staging directory
     staging_dir = None
-    if len(sys.argv) > 1:
-        staging_dir = sys.argv[1]
+    if args.staging_directory:
+        staging_dir = args.staging_directory
     else:
         # Try to load from config
         if config.has_option('DEFAULT', 'destination_dir'):
@@ -426,12 +739,32 @@ def main():
             print(f"\nUsage: {sys.argv[0]} [staging_directory]")
             sys.exit(1)
 
+    # Use the processing ledger if preprocess.py has written one, each pool thread opens its own connection
+    ledger_file = ledger.ledger_path(config)
+    if not os.path.exists(ledger_file):
+        ledger_file = None
+        print_warning("No processing ledger found, skipping ledger checks")
+
     # Run staging directory validation
-    results = validate_staging_directory(staging_dir, verbose=True)
+    report_file = os.path.join(os.path.dirname(__file__), 'validation_report.json')
+    results = validate_staging_directory(staging_dir, verbose=True, ledger_file=ledger_file, jobs=args.jobs,
+                                         cache_file=args.cache if args.incremental else None,
+                                         previous_report=load_report(report_file))
 
     if results is None:
         sys.exit(1)
 
+    # Re-hash the tarballs
+    if args.deep and results['aus']:
+        try:
+            results['fixity_audit'] = deep_audit([(au['au_name'], au['path']) for au in results['aus']], ledger_file,
+                                                 args.deep_jobs, args.max_bytes_per_second, args.audit_log,
+                                                 restart=args.restart_audit)
+        except KeyboardInterrupt:
+            sys.exit(130)
+        if results['fixity_audit']['bitrot'] or results['fixity_audit']['errors']:
+            results['return_code'] = 1
+
     # Validate titledb.xml
     print()
     titledb_path = None
@@ -504,7 +837,6 @@ def main():
         print_error("✗ Validation failed - see errors above")
 
     # Save report
-    report_file = os.path.join(os.path.dirname(__file__), 'validation_report.json')
     save_report(results, report_file)
 
     sys.exit(results.get('return_code', 0))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Staging transfer layer for preprocess.py.
+
+Moving an AU folder into the staging area is a rename when the upload and staging directories
+are on the same filesystem. When they aren't, shutil.move silently turns into a full Python
+copy. move() here copies with the cheapest mechanism the kernel offers instead: a reflink
+(FICLONE) where the filesystem shares extents, otherwise copy_file_range or sendfile, which
+keep the data in the kernel. The copy goes to a temporary name next to the destination. Each
+file is fsynced and checked against its source (size, or sha256 where a digest is known). Only
+then is the copy renamed into place, so the staging area never shows a half-copied AU, and the
+source is removed last. Progress and throughput are printed as it goes.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+from collections import namedtuple
+from typing import Optional
+
+FICLONE = 0x40049409  # ioctl from <linux/fs.h>
+CHUNK_SIZE = 64 * 1024 * 1024
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+PROGRESS_BYTES = 1024 * 1024 * 1024  # print progress every GiB of a cross-device copy
+PARTIAL_SUFFIX = '.partial'
+
+# errors meaning "this copy mechanism isn't supported here", try the next one
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.EBADF}
+
+TransferStats = namedtuple('TransferStats', ['bytes', 'seconds', 'method'])
+
+# =============================================================================
+# Progress
+# =============================================================================
+
+class Progress:
+    """Counts copied bytes and prints a line every PROGRESS_BYTES."""
+
+    def __init__(self, label: str, total: int):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.next_report = PROGRESS_BYTES
+        self.start = time.monotonic()
+
+    def add(self, nbytes: int) -> None:
+        self.done += nbytes
+        if self.done >= self.next_report:
+            self.next_report += PROGRESS_BYTES
+            print(f"  {self.label}: {format_bytes(self.done)} of {format_bytes(self.total)} "
+                  f"({self.done * 100 // max(self.total, 1)}%, {format_rate(self.done, self.elapsed())})")
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+
+def format_bytes(nbytes: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+def format_rate(nbytes: int, seconds: float) -> str:
+    return f"{format_bytes(nbytes / seconds if seconds > 0 else nbytes)}/s"
+
+# =============================================================================
+# Copying
+# =============================================================================
+
+def same_device(src: str, dest_dir: str) -> bool:
+    """True if src can be renamed into dest_dir."""
+    return os.stat(src).st_dev == os.stat(dest_dir).st_dev
+
+
+def _copy_methods():
+    if hasattr(os, 'copy_file_range'):
+        yield 'copy_file_range', lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+    if hasattr(os, 'sendfile'):
+        yield 'sendfile', lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count)
+    yield 'read/write', lambda src_fd, dst_fd, offset, count: os.pwrite(dst_fd, os.pread(src_fd, count, offset), offset)
+
+
+def copy_data(src_fd: int, dst_fd: int, size: int, progress: Progress) -> str:
+    """Copy size bytes between open files with the best mechanism available. Returns its name."""
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        progress.add(size)
+        return 'reflink'
+    except OSError as error:
+        if error.errno not in UNSUPPORTED_ERRNOS:
+            raise
+
+    offset = 0
+    for name, copy_chunk in _copy_methods():
+        try:
+            while offset < size:
+                copied = copy_chunk(src_fd, dst_fd, offset, min(CHUNK_SIZE, size - offset))
+                if copied == 0:
+                    raise EOFError(f"source ended after {offset} of {size} bytes")
+                offset += copied
+                progress.add(copied)
+            return name
+        except OSError as error:
+            if offset or error.errno not in UNSUPPORTED_ERRNOS:
+                raise  #failed part way, not a missing capability
+    return 'read/write'
+
+
+def copy_file(src: str, dst: str, progress: Progress) -> str:
+    """Copy one file (data, mode and times) and fsync it. Returns the copy mechanism used."""
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        method = copy_data(fsrc.fileno(), fdst.fileno(), size, progress) if size else 'empty'
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, dst)
+    return method
+
+
+def fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tree_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def copy_tree(src: str, dst: str, progress: Progress, expected_sha256: dict[str, str]) -> set[str]:
+    """
+    Copy a file or folder to dst, verifying each file: size always, sha256 for the
+    files listed (relative path -> digest). Returns the copy mechanisms used.
+    """
+    methods = set()
+    if not os.path.isdir(src):
+        pairs = [(src, dst, os.path.basename(src))]
+    else:
+        pairs = []
+        for root, dirs, files in os.walk(src):
+            relative_root = os.path.relpath(root, src)
+            os.makedirs(os.path.normpath(os.path.join(dst, relative_root)), exist_ok=True)
+            for f in files:
+                relative = os.path.normpath(os.path.join(relative_root, f))
+                pairs.append((os.path.join(root, f), os.path.join(dst, relative), relative))
+
+    for src_file, dst_file, relative in pairs:
+        methods.add(copy_file(src_file, dst_file, progress))
+        if os.path.getsize(dst_file) != os.path.getsize(src_file):
+            raise IOError(f"{relative}: copied size {os.path.getsize(dst_file)} does not match the source")
+        if relative in expected_sha256 and sha256_file(dst_file) != expected_sha256[relative]:
+            raise IOError(f"{relative}: sha256 of the copy does not match")
+
+    if os.path.isdir(dst):
+        for root, dirs, _ in os.walk(dst, topdown=False):
+            for d in dirs:
+                shutil.copystat(os.path.join(src, os.path.relpath(os.path.join(root, d), dst)), os.path.join(root, d))
+                fsync_dir(os.path.join(root, d))
+        shutil.copystat(src, dst)
+        fsync_dir(dst)
+    return methods
+
+# =============================================================================
+# Moving
+# =============================================================================
+
+def move(src: str, dest_dir: str, expected_sha256: Optional[dict[str, str]] = None) -> TransferStats:
+    """
+    Move a file or folder into dest_dir, keeping its name.
+
+    A rename on the same filesystem. Otherwise copy to a temporary name in dest_dir, fsync,
+    verify, rename into place and only then remove the source. Raises FileExistsError if
+    dest_dir already holds something with that name.
+    """
+    name = os.path.basename(os.path.normpath(src))
+    final_path = os.path.join(dest_dir, name)
+    if os.path.lexists(final_path):
+        raise FileExistsError(errno.EEXIST, "Destination path already exists", final_path)
+
+    start = time.monotonic()
+    size = tree_size(src)
+    if same_device(src, dest_dir):
+        os.rename(src, final_path)
+        return TransferStats(size, time.monotonic() - start, 'rename')
+
+    partial_path = os.path.join(dest_dir, f".{name}{PARTIAL_SUFFIX}")
+    if os.path.isdir(partial_path):
+        shutil.rmtree(partial_path)  #left by an interrupted transfer
+    elif os.path.lexists(partial_path):
+        os.remove(partial_path)
+
+    progress = Progress(name, size)
+    try:
+        methods = copy_tree(src, partial_path, progress, expected_sha256 or {})
+        os.rename(partial_path, final_path)  #atomic: the AU appears in staging complete or not at all
+        fsync_dir(dest_dir)
+    except BaseException:
+        if os.path.isdir(partial_path):
+            shutil.rmtree(partial_path, ignore_errors=True)
+        elif os.path.lexists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    if os.path.isdir(src):
+        shutil.rmtree(src)
+    else:
+        os.remove(src)
+    return TransferStats(size, time.monotonic() - start, '+'.join(sorted(methods)))
+
+
+def describe(name: str, stats: TransferStats) -> str:
+    """One line for the run output."""
+    return (f"Moved {name}: {format_bytes(stats.bytes)} in {stats.seconds:.1f}s "
+            f"({format_rate(stats.bytes, stats.seconds)}, {stats.method})")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Member offset index for AU tarballs.
+
+preprocess.py writes a small sidecar next to each AU tarball ({au_name}.tar.idx) while it
+streams the archive for the first time. Each line records a member's name, the offset of its
+data in the tar, its size, mtime and type, so later tools can seek straight to a member's bytes
+instead of letting tarfile read every header in the archive.
+
+The sidecar is CSV with a leading "#tar_size=" line; an index whose size doesn't match the
+tarball is treated as stale and ignored.
+"""
+
+import csv
+import os
+from collections import namedtuple
+from typing import Optional
+
+INDEX_SUFFIX = '.idx'
+FIELDS = ['name', 'offset', 'size', 'mtime', 'type']
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# gzip, bzip2 and xz signatures - offsets are only meaningful for plain tarballs
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00')
+
+IndexEntry = namedtuple('IndexEntry', FIELDS)
+
+# =============================================================================
+# Writing
+# =============================================================================
+
+def index_path(tar_path: str) -> str:
+    """Sidecar path for a tarball."""
+    return tar_path + INDEX_SUFFIX
+
+
+def is_plain_tar(tar_path: str) -> bool:
+    """True if the tarball isn't compressed, ie member offsets can be seeked to directly."""
+    with open(tar_path, 'rb') as f:
+        head = f.read(6)
+    return not head.startswith(COMPRESSED_MAGIC)
+
+
+def entry_for(member) -> IndexEntry:
+    """Build an index entry from a tarfile.TarInfo read from a plain tarball."""
+    return IndexEntry(member.name, member.offset_data, member.size, int(member.mtime), member.type.decode('ascii'))
+
+
+def write_index(path: str, entries: list[IndexEntry], tar_size: int) -> None:
+    """Write the sidecar atomically (temp file + rename)."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        f.write(f"#tar_size={tar_size}\n")
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        writer.writerows(entries)
+    os.replace(tmp_path, path)
+
+# =============================================================================
+# Reading
+# =============================================================================
+
+def load_index(tar_path: str) -> Optional[dict[str, IndexEntry]]:
+    """
+    Load the sidecar for a tarball, keyed on member name.
+    Returns None if there is no sidecar or it doesn't match the tarball.
+    """
+    path = index_path(tar_path)
+    if not os.path.exists(path) or not os.path.exists(tar_path):
+        return None
+
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        header = f.readline().strip()
+        if header != f"#tar_size={os.path.getsize(tar_path)}":
+            return None
+        reader = csv.reader(f)
+        if next(reader, None) != FIELDS:
+            return None
+        return {row[0]: IndexEntry(row[0], int(row[1]), int(row[2]), int(row[3]), row[4]) for row in reader}
+
+
+def iter_member(tar_path: str, entry: IndexEntry, chunk_size: int = CHUNK_SIZE):
+    """Yield a member's bytes in chunks, seeking straight to its data offset."""
+    remaining = entry.size
+    with open(tar_path, 'rb') as f:
+        f.seek(entry.offset)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError(f"{tar_path} ends inside member {entry.name}")
+            remaining -= len(chunk)
+            yield chunk
+
+
+def read_member(tar_path: str, entry: IndexEntry) -> bytes:
+    """Read a (small) member fully into memory."""
+    return b''.join(iter_member(tar_path, entry))
+
+
+def extract_member(tar_path: str, entry: IndexEntry, dest_path: str) -> None:
+    """Copy a member's bytes to dest_path without reading any other part of the tarball."""
+    os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+    with open(dest_path, 'wb') as out:
+        for chunk in iter_member(tar_path, entry):
+            out.write(chunk)
+    os.utime(dest_path, (entry.mtime, entry.mtime))
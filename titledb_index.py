@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+One-pass index of the AU entries in a titledb.xml, for scripts/validate_staging.py and add_aus_to_nodes.py.
+
+titledb.xml is laid out as root > property (titleSet, title) > property (one per AU) > fields:
+
+    <property name="{au_name}">
+        <property name="plugin" value="..." />                  field with a value
+        <property name="param.1">                                parameter, a key/value pair
+            <property name="key" value="base_url" />
+            <property name="value" value="..." />
+        </property>
+    </property>
+
+The file is read with iterparse and each AU element is dropped as soon as it has been indexed,
+so memory grows with the AUs kept, not with the size of the titledb.
+"""
+
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Iterator, Optional, Union
+
+AU_DEPTH = 3  # root is depth 1, the titleSet and title properties depth 2
+
+# =============================================================================
+# Parsing
+# =============================================================================
+
+def _entry(elem: ET.Element) -> dict:
+    """An AU element as {'fields': {name: value}, 'params': {name: {key/value sub-properties}}}"""
+    fields = {}
+    params = {}
+    for child in elem:
+        name = child.get('name')
+        if child.tag != 'property' or not name:
+            continue
+        fields[name] = child.get('value')
+        if name.startswith('param.'):
+            params[name] = {p.get('name'): p.get('value') for p in child if p.tag == 'property'}
+    return {'fields': fields, 'params': params}
+
+
+def iter_entries(source: Union[str, BinaryIO]) -> Iterator[tuple[str, dict]]:
+    """
+    Stream (AU name, entry) pairs from titledb.xml in document order
+
+    Args:
+        source: Path or binary file object (eg a streamed HTTP response)
+
+    Raises:
+        ET.ParseError: if the document isn't well-formed, possibly after some entries were yielded
+    """
+    stack = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if len(stack) + 1 == AU_DEPTH:
+            stack[-1].remove(elem)  #drop each AU once indexed, so its parent never holds more than one
+            if elem.tag == 'property' and elem.get('name'):
+                yield elem.get('name'), _entry(elem)
+        elif len(stack) + 1 < AU_DEPTH:
+            elem.clear()
+
+
+def build_index(source: Union[str, BinaryIO], names: Optional[set] = None) -> dict[str, dict]:
+    """
+    AU name -> entry for every AU in titledb.xml, or only those in names
+
+    A name that appears more than once keeps its last entry.
+    """
+    index = {}
+    for name, entry in iter_entries(source):
+        if names is None or name in names:
+            index[name] = entry
+    return index
+
+# =============================================================================
+# Entry helpers
+# =============================================================================
+
+def param_values(entry: dict) -> dict[str, str]:
+    """The entry's parameters as {key: value}, eg {'base_url': ..., 'directory': ..., 'pub_down': 'false'}"""
+    values = {}
+    for param in entry['params'].values():
+        key, value = param.get('key'), param.get('value')
+        if key and value:
+            values[key] = value
+    return values
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Upload watching for preprocess.py --watch.
+
+InotifyWatcher reports the .tar files that changed under source_dir as they change, using the
+kernel's inotify API through ctypes (no extra packages). Where inotify isn't available (not
+Linux, a network filesystem, or the watch limit reached) PollingWatcher rescans on an interval.
+
+SettleTracker decides when an upload is complete: a tarball is ready once its size and mtime
+have stayed the same for settle_seconds, so a file still arriving over SFTP isn't picked up.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Optional
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+# =============================================================================
+# Watchers
+# =============================================================================
+
+class InotifyWatcher:
+    """Recursive inotify watch on a directory tree."""
+
+    name = 'inotify'
+
+    def __init__(self, directory: str):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}  # watch descriptor -> directory
+        for root, _, _ in os.walk(directory):
+            self._add_watch(root)
+
+    def _add_watch(self, path: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.paths[wd] = path
+
+    def _remove_watches(self, path: str) -> None:
+        #a directory moved out of the tree (an AU folder being staged) keeps its watch otherwise
+        for wd, watched in list(self.paths.items()):
+            if watched == path or watched.startswith(path + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def wait(self, timeout: Optional[float]) -> Optional[set[str]]:
+        """
+        Block until something changes or timeout seconds pass.
+        Returns the .tar paths that changed, or None if the tree has to be rescanned.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None  #events were dropped, only a rescan is reliable
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                if wd not in self.paths:
+                    continue
+                path = os.path.join(self.paths[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        #a new folder, watch it and anything already in it
+                        for root, _, files in os.walk(path):
+                            self._add_watch(root)
+                            changed.update(os.path.join(root, f) for f in files if f.endswith('.tar'))
+                    elif mask & IN_MOVED_FROM:
+                        self._remove_watches(path)
+                elif path.endswith('.tar'):
+                    changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback: wake up every poll_interval seconds and rescan."""
+
+    name = 'polling'
+
+    def __init__(self, directory: str, poll_interval: float):
+        self.directory = directory
+        self.poll_interval = poll_interval
+
+    def wait(self, timeout: Optional[float]) -> Optional[set[str]]:
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+def open_watcher(directory: str, poll_interval: float, use_inotify: bool = True):
+    """An InotifyWatcher if the platform allows it, otherwise a PollingWatcher."""
+    if use_inotify:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as error:  # AttributeError: libc without inotify
+            print(f"Warning: inotify unavailable ({error}), polling {directory} every {poll_interval}s")
+    return PollingWatcher(directory, poll_interval)
+
+# =============================================================================
+# Settle detection
+# =============================================================================
+
+def file_signature(path: str) -> Optional[tuple[int, int]]:
+    """(size, mtime_ns), None if the file is gone."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class SettleTracker:
+    """Tracks candidate uploads until their size and mtime stop changing."""
+
+    def __init__(self, settle_seconds: float):
+        self.settle_seconds = settle_seconds
+        self.pending = {}  # path -> (signature, time the signature was first seen)
+        self.handed_out = {}  # path -> signature when it was ready, an upload left in place isn't offered again until it changes
+
+    def observe(self, paths) -> None:
+        """Note uploads that are new or have changed."""
+        now = time.monotonic()
+        for path in paths:
+            signature = file_signature(path)
+            if signature is None:
+                self.pending.pop(path, None)
+                self.handed_out.pop(path, None)
+            elif self.handed_out.get(path) == signature:
+                continue
+            elif path not in self.pending or self.pending[path][0] != signature:
+                self.pending[path] = (signature, now)
+
+    def ready(self) -> list[str]:
+        """Uploads unchanged for settle_seconds, in the order they were first seen; they stop being tracked."""
+        now = time.monotonic()
+        ready = []
+        for path, (signature, since) in list(self.pending.items()):
+            current = file_signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, now)  #still being written
+            elif now - since >= self.settle_seconds:
+                ready.append(path)
+                self.handed_out[path] = signature
+                del self.pending[path]
+        return ready
+
+    def next_due(self) -> Optional[float]:
+        """Seconds until the next pending upload could be ready, None if nothing is pending."""
+        if not self.pending:
+            return None
+        now = time.monotonic()
+        return max(0.0, min(since + self.settle_seconds - now for _, since in self.pending.values()))